@@ -1,5 +1,21 @@
-from fastapi import APIRouter, HTTPException, Form, File, UploadFile, Query
+import itertools
+import zipfile
+from functools import partial
+from typing import Any, Dict, List
+
+from anyio import from_thread
+from fastapi import APIRouter, HTTPException, Form, File, UploadFile, Query, Header
+from starlette.concurrency import run_in_threadpool
+from db.vector_db import vector_pool
+from services.answer_cache import answer_cache
+from services.bulk_import import ImportEntry, archive_entries, bulk_importer, read_manifest, upload_entries
+from services.chat_service import session_manager
 from services.document_service import DocumentService
+from services.embedding_batcher import embedding_batcher
+from services.embedding_cache import embedding_cache
+from services.ingestion_jobs import IngestionQueueFull, ingestion_jobs
+from services.rerank_policy import rerank_policy
+from services.retrieval_stats import retrieval_stats
 from docs_processing.pageable import Pageable, PaginatedResponse
 
 
@@ -14,44 +30,70 @@ async def root():
     }
 
 
-# @page_router.get("/doclist")  # получение всех документов
-# async def get_docs():
-#     return DocumentService.get_all_docs()
+@page_router.get("/stats")  # состояние пулов соединений и кэшей
+async def get_stats():
+    return {
+        "vector_pool": vector_pool.stats(),
+        "db_pool": DocumentService.get_pool_stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "answer_cache": answer_cache.stats(),
+        "retrieval": retrieval_stats.stats(),
+        "rerank_policy": rerank_policy.stats(),
+        "ingestion": ingestion_jobs.stats(),
+        "chat_sessions": session_manager.stats(),
+    }
 
 
 @page_router.get("/doclist/paginated")  # получение всех документов с пагинацией
 async def get_docs_paginated(
         page: int = Query(0, ge=0, description="Номер страницы (начинается с 0)"),
         size: int = Query(10, ge=1, le=100, description="Размер страницы (1-100)"),
-        search: str | None = Query(None, max_length=255, description="Поиск по ID или названию")
+        search: str | None = Query(None, max_length=255, description="Поиск по ID или названию"),
+        cursor: str | None = Query(None, max_length=1024,
+                                   description="Курсор следующей страницы; пустое значение – первая страница")
 ):
     search_value = search.strip() if search else None
-    docs = DocumentService.get_all_docs(page=page, size=size, search=search_value)
-    total = DocumentService.get_total_documents(search=search_value)
+    next_cursor = None
+    if cursor is not None:
+        try:
+            docs, next_cursor, total, exact_total = await DocumentService.get_docs_by_cursor(
+                cursor=cursor, size=size, search=search_value
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    else:
+        docs, total, exact_total = await DocumentService.get_all_docs(page=page, size=size, search=search_value)
 
     return PaginatedResponse(
         items=docs,
         total=total,
         pageable=Pageable(page=page, size=size),
-        total_pages=(total + size - 1) // size
+        total_pages=(total + size - 1) // size,
+        next_cursor=next_cursor,
+        exact_total=exact_total
     )
 
 
 @page_router.delete("/doclist/{doc_id}")  # удаление документа по id
 async def delete_doc(doc_id: str):
-    if not DocumentService.delete_doc(doc_id):
+    if not await DocumentService.delete_doc(doc_id):
         raise HTTPException(status_code=404, detail="Файл для удаления не найден")
 
 
 @page_router.get("/doclist/{doc_id}")  # скачивание документа по id
-async def get_doc_id(doc_id: str):
-    document = DocumentService.get_doc(doc_id)
+async def get_doc_id(doc_id: str,
+                     range_header: str | None = Header(None, alias="Range"),
+                     if_none_match: str | None = Header(None, alias="If-None-Match"),
+                     if_range: str | None = Header(None, alias="If-Range")):
+    document = await DocumentService.get_doc(doc_id, range_header=range_header,
+                                             if_none_match=if_none_match, if_range=if_range)
     if document:
         return document
     raise HTTPException(status_code=404, detail="Файл не найден")
 
 
-@page_router.post("/createdoc")  # загрузка нового документа
+@page_router.post("/createdoc", status_code=202)  # загрузка нового документа
 async def upload_doc(doc_id: str = Form(..., description="ID документа"),
                      title: str = Form(..., description="Навзвание документа"),
                      mcb: str = Form("NULL", description="МКБ-10"),
@@ -66,16 +108,76 @@ async def upload_doc(doc_id: str = Form(..., description="ID документа"
     # if DocumentService.get_doc(doc_id):
     #     raise HTTPException(status_code=409, detail="Файл с таким названием уже существует")
 
-    file_data = await file.read()
+    # при заполненной очереди файл не читается в память
+    try:
+        ingestion_jobs.ensure_capacity()
+    except IngestionQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+    file_data = await file.read(ingestion_jobs.max_file_bytes + 1)
+    if len(file_data) > ingestion_jobs.max_file_bytes:
+        raise HTTPException(status_code=413, detail="Размер файла превышает допустимый")
+
     try:
-        DocumentService.create_doc(doc_id, title, mcb, age_category, developer, file_data)
-        return {
-            "message": "Новый документ загружен",
-            "doc_id": doc_id,
-            "title": title,
-            "MCB": mcb,
-            "age_category": age_category,
-            "developer": developer
-        }
+        # сохранение, нарезка и эмбеддинги выполняются в фоне, ход загрузки – GET /jobs/{job_id}
+        job = ingestion_jobs.submit(doc_id, title, mcb, age_category, developer, file_data)
+    except IngestionQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка в загрузке документе: {str(e)}")
+
+    return {
+        "message": "Документ поставлен в очередь на загрузку",
+        "job_id": job.id,
+        "doc_id": doc_id,
+        "title": title,
+        "MCB": mcb,
+        "age_category": age_category,
+        "developer": developer
+    }
+
+
+@page_router.post("/import")  # массовая загрузка документов
+async def import_docs(files: List[UploadFile] | None = File(None, description="PDF файлы"),
+                      archive: UploadFile | None = File(None, description="ZIP архив с PDF файлами"),
+                      manifest: UploadFile | None = File(None, description="CSV/XLSX с метаданными: file, doc_id, "
+                                                                           "title, mcb, age_category, developer, "
+                                                                           "placement_date")):
+    if not files and archive is None:
+        raise HTTPException(status_code=400, detail="Не переданы файлы или архив")
+
+    try:
+        metadata = read_manifest(manifest.filename or "", await manifest.read()) if manifest is not None else {}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Не удалось прочитать манифест: {str(e)}")
+
+    def _index(entry: ImportEntry) -> Dict[str, Any]:
+        # импорт идёт в потоке, а очередь фоновой загрузки принадлежит event loop
+        try:
+            job = from_thread.run_sync(partial(
+                ingestion_jobs.submit_stored, entry.doc_id, entry.title, entry.mcb, entry.age_category,
+                entry.developer, entry.placement_date,
+            ))
+        except (IngestionQueueFull, RuntimeError) as e:
+            return {"indexing": "not_indexed", "indexing_error": str(e)}
+        return {"indexing": "queued", "job_id": job.id}
+
+    def _import():
+        sources = [upload_entries(files or [])]
+        if archive is not None:
+            sources.append(archive_entries(archive.file))
+        return bulk_importer.import_entries(itertools.chain(*sources), metadata, on_imported=_index)
+
+    # импорт тысяч файлов занимает минуты, поэтому выполняется вне event loop
+    try:
+        return await run_in_threadpool(_import)
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Некорректный ZIP архив: {str(e)}")
+
+
+@page_router.get("/jobs/{job_id}")  # ход фоновой загрузки документа
+async def get_job(job_id: str):
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return job.to_dict()
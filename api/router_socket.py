@@ -1,29 +1,204 @@
+import asyncio
+import dataclasses
 import fastapi
 import json
 import os
 import logging
-from typing import Any, Dict, List, Optional
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Awaitable, Deque, Dict, List, Optional, Set, Tuple, TypeVar, Union
 
 import asyncpg
 import httpx
 from fastapi import WebSocket, WebSocketDisconnect
-from services.chat_service import ChatSessionManager
+from db.vector_db import vector_pool
+from services.answer_cache import answer_cache
+from services.chat_service import session_manager
+from services.embedding_batcher import embedding_batcher
+from services.embedding_cache import embedding_cache
+from services.http_clients import http_clients
+from services.rerank_policy import rerank_policy
+from services.retrieval_stats import retrieval_stats
 
 socket_router = fastapi.APIRouter()
-session_manager = ChatSessionManager()
 
 logger = logging.getLogger("example")
-EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8000/embed")
+T = TypeVar("T")
 RERANK_SERVICE_URL = os.getenv("RERANK_SERVICE_URL", "http://localhost:8001/rerank")
 LLM_SERVICE_URL = os.getenv("LLM_SERVICE_URL")
 
-VECTOR_DB_HOST = os.getenv("VECTOR_DB_HOST", os.getenv("DB_HOST", "localhost"))
-VECTOR_DB_PORT = int(os.getenv("VECTOR_DB_PORT", os.getenv("DB_PORT", "5433")))
-VECTOR_DB_NAME = os.getenv("VECTOR_DB_NAME", "rag")
-VECTOR_DB_USER = os.getenv("VECTOR_DB_USER", os.getenv("DB_USER", "dev"))
-VECTOR_DB_PASSWORD = os.getenv("VECTOR_DB_PASSWORD", os.getenv("DB_PASSWORD", "dev_password"))
-
 RETRIEVAL_LIMIT = int(os.getenv("RAG_RETRIEVAL_LIMIT", "20"))
+# rerank-service принимает не больше 20 фрагментов за запрос, больший список делится на части
+RERANK_MAX_PASSAGES = int(os.getenv("RERANK_MAX_PASSAGES", "20"))
+# поля ответа rerank-service с позицией фрагмента в запросе
+RERANK_INDEX_KEYS = ("index", "passage_index", "corpus_id")
+QUERY_EMBEDDING_TASK = "retrieval.query"
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
+
+# ORDER BY по оператору расстояния, а не по вычисленной близости: только так используется HNSW/IVFFlat индекс
+SIMILARITY_QUERY = """
+    SELECT id,
+           content,
+           metadata->>'document_name'  AS document_name,
+           metadata->>'source_url'     AS source_url,
+           metadata->>'recommendation_number' AS recommendation_number,
+           metadata->>'document_id'    AS document_id,
+           metadata->>'raw_document_id' AS raw_document_id,
+           1 - (embedding <=> $1::vector) AS similarity
+    FROM chunks
+    {where_clause}
+    ORDER BY embedding <=> $1::vector
+    LIMIT $2;
+"""
+
+# значения по умолчанию для поиска по индексу; 0 – настройка сервера БД
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_HNSW_EF_SEARCH", "0"))
+VECTOR_PROBES = int(os.getenv("VECTOR_IVFFLAT_PROBES", "0"))
+VECTOR_MAX_EF_SEARCH = 1000
+VECTOR_MAX_PROBES = int(os.getenv("VECTOR_MAX_PROBES", "1000"))
+# relaxed_order/strict_order для pgvector >= 0.8: индекс продолжает поиск, пока фильтры не наберут LIMIT строк
+VECTOR_ITERATIVE_SCAN = os.getenv("VECTOR_HNSW_ITERATIVE_SCAN", "")
+
+AGE_CATEGORY_BOTH = "Взрослые, дети"
+
+# полнотекстовый поиск по chunks.content ловит коды МКБ-10, названия препаратов и дозировки,
+# которые плохо находятся по эмбеддингу; выражение совпадает с индексом idx_chunks_content_fts
+LEXICAL_QUERY = """
+    SELECT id,
+           content,
+           metadata->>'document_name'  AS document_name,
+           metadata->>'source_url'     AS source_url,
+           metadata->>'recommendation_number' AS recommendation_number,
+           metadata->>'document_id'    AS document_id,
+           metadata->>'raw_document_id' AS raw_document_id,
+           NULL::double precision AS similarity
+    FROM chunks, websearch_to_tsquery('russian', $1) AS query
+    WHERE to_tsvector('russian', content) @@ query{filter_clause}
+    ORDER BY ts_rank_cd(to_tsvector('russian', content), query) DESC
+    LIMIT $2;
+"""
+
+RETRIEVAL_MODES = ("vector", "hybrid")
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "vector").lower()
+LEXICAL_LIMIT = int(os.getenv("RAG_LEXICAL_LIMIT", str(RETRIEVAL_LIMIT)))
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+
+
+def _optional_int(msg: Dict[str, Any], key: str, upper: int) -> Optional[int]:
+    value = msg.get(key)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(f"Параметр {key} должен быть положительным целым числом")
+    return min(value, upper)
+
+
+def _string_list(value: Any, key: str) -> List[str]:
+    if value is None:
+        return []
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, list) or not all(isinstance(item, str) for item in values):
+        raise ValueError(f"Фильтр {key} должен быть строкой или списком строк")
+    return [item.strip() for item in values if item.strip()]
+
+
+@dataclasses.dataclass
+class VectorSearchOptions:
+    """Фильтры по метаданным фрагментов и параметры поиска по ANN-индексу из сообщения чата."""
+
+    age_category: Optional[str] = None
+    mcb: Optional[str] = None
+    specialties: Optional[str] = None
+    document_ids: List[str] = dataclasses.field(default_factory=list)
+    ef_search: Optional[int] = None
+    probes: Optional[int] = None
+    mode: str = RETRIEVAL_MODE
+
+    @classmethod
+    def from_message(cls, msg: Dict[str, Any]) -> "VectorSearchOptions":
+        filters = msg.get("filters") or {}
+        if not isinstance(filters, dict):
+            raise ValueError("Поле filters должно быть объектом")
+
+        def single(key: str) -> Optional[str]:
+            value = filters.get(key)
+            if value is not None and not isinstance(value, str):
+                raise ValueError(f"Фильтр {key} должен быть строкой")
+            return (value or "").strip() or None
+
+        mode = msg.get("retrieval") or RETRIEVAL_MODE
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Режим поиска должен быть одним из: {', '.join(RETRIEVAL_MODES)}")
+
+        return cls(
+            mode=mode,
+            age_category=single("age_category"),
+            mcb=single("mcb"),
+            specialties=single("specialties"),
+            document_ids=_string_list(filters.get("document_id"), "document_id"),
+            ef_search=_optional_int(msg, "ef_search", VECTOR_MAX_EF_SEARCH),
+            probes=_optional_int(msg, "probes", VECTOR_MAX_PROBES),
+        )
+
+    @property
+    def has_filters(self) -> bool:
+        return bool(self.age_category or self.mcb or self.specialties or self.document_ids)
+
+    def filter_conditions(self, first_param: int) -> Tuple[List[str], List[Any]]:
+        """Условия фильтров и их параметры; номера параметров начинаются с first_param."""
+        conditions: List[str] = []
+        params: List[Any] = []
+
+        def add(condition: str, value: Any) -> None:
+            params.append(value)
+            conditions.append(condition.format(f"${first_param + len(params) - 1}"))
+
+        if self.age_category:
+            # документы для взрослых и детей подходят под оба фильтра
+            categories = [self.age_category]
+            if self.age_category != AGE_CATEGORY_BOTH:
+                categories.append(AGE_CATEGORY_BOTH)
+            add("metadata->>'age_category' = ANY({}::text[])", categories)
+        if self.mcb:
+            add("metadata->>'mcb' ILIKE {}", f"%{self.mcb}%")
+        if self.specialties:
+            add("metadata->>'specialties' ILIKE {}", f"%{self.specialties}%")
+        if self.document_ids:
+            add("metadata->>'document_id' = ANY({}::text[])", self.document_ids)
+        return conditions, params
+
+    def where_clause(self, first_param: int) -> Tuple[str, List[Any]]:
+        conditions, params = self.filter_conditions(first_param)
+        if not conditions:
+            return "", []
+        return "WHERE " + " AND ".join(conditions), params
+
+    def settings(self) -> Dict[str, str]:
+        """Параметры pgvector, которые устанавливаются на время одного запроса."""
+        settings: Dict[str, str] = {}
+        ef_search = self.ef_search or VECTOR_EF_SEARCH
+        probes = self.probes or VECTOR_PROBES
+        if ef_search:
+            settings["hnsw.ef_search"] = str(ef_search)
+        if probes:
+            settings["ivfflat.probes"] = str(probes)
+        if VECTOR_ITERATIVE_SCAN and self.has_filters:
+            settings["hnsw.iterative_scan"] = VECTOR_ITERATIVE_SCAN
+        return settings
+
+
+@dataclasses.dataclass
+class RagAnswer:
+    content: str
+    from_cache: bool = False
+
+
+@dataclasses.dataclass
+class RagContext:
+    embedding: List[float]
+    matched_results: List[Dict[str, Any]]
+    prompt: str
+    cacheable: bool = True
 
 
 @socket_router.websocket("/ws/chat")
@@ -32,11 +207,13 @@ async def websocket_chat(websocket: WebSocket):
     session_id = None
 
     try:
-        session_id = session_manager.create_session()
-        await websocket.send_text(json.dumps({"type": "session_created", "session_id": session_id}, ensure_ascii=False))
+        # ?session_id=... продолжает существующую сессию, неизвестный id заменяется новым
+        session_id, resumed = await session_manager.open_session(websocket.query_params.get("session_id"))
+        await websocket.send_text(json.dumps(
+            {"type": "session_created", "session_id": session_id, "resumed": resumed}, ensure_ascii=False
+        ))
 
-        history = session_manager.get_history(session_id)
-        await websocket.send_text(json.dumps({"type": "history", "messages": history}, ensure_ascii=False))
+        await _send_history(websocket, session_id)
 
         while True:
             data = await websocket.receive_text()
@@ -49,108 +226,269 @@ async def websocket_chat(websocket: WebSocket):
 
                     session_manager.add_message(session_id, "user", user_query)
 
+                    search_options = VectorSearchOptions.from_message(msg)
+
+                    if msg.get("stream"):
+                        final_content = None
+                        async for frame in stream_response(user_query, search_options):
+                            if frame["type"] == "chat_message_end":
+                                final_content = frame["content"]
+                            await websocket.send_text(json.dumps(frame, ensure_ascii=False))
+                        if final_content is not None:
+                            session_manager.add_message(session_id, "bot", final_content)
+                        continue
+
                     # работа с моделью
-                    response = await get_response(user_query)
+                    answer = await get_response(user_query, search_options)
 
-                    session_manager.add_message(session_id, "bot", response)
+                    session_manager.add_message(session_id, "bot", answer.content)
 
-                    await websocket.send_text(
-                        json.dumps({"type": "chat_message", "role": "bot", "content": response}, ensure_ascii=False))
+                    await websocket.send_text(json.dumps({
+                        "type": "chat_message",
+                        "role": "bot",
+                        "content": answer.content,
+                        "from_cache": answer.from_cache,
+                    }, ensure_ascii=False))
 
                 if msg.get("type") == "history":
-                    history = session_manager.get_history(session_id)
-                    await websocket.send_text(json.dumps({"type": "history", "messages": history}, ensure_ascii=False))
+                    await _send_history(websocket, session_id, limit=_optional_int(msg, "limit", session_manager.page_size),
+                                        before=msg.get("before"))
             except Exception as e:
                 await websocket.send_text(json.dumps({"type": "error", "message": str(e)}, ensure_ascii=False))
     except WebSocketDisconnect:
-        session_manager.remove_session(session_id)
+        # сессия остаётся в памяти, чтобы её можно было продолжить после переподключения;
+        # брошенные сессии удаляет фоновая задача session_manager по CHAT_SESSION_TTL
+        pass
+
+
+async def _send_history(websocket: WebSocket, session_id: str, limit: Optional[int] = None,
+                        before: Optional[str] = None) -> None:
+    messages, next_before = await session_manager.get_history(session_id, limit=limit, before=before)
+    await websocket.send_text(json.dumps(
+        {"type": "history", "messages": messages, "next_before": next_before}, ensure_ascii=False
+    ))
 
 
 async def _fetch_embedding(user_query: str) -> Optional[List[float]]:
-    embed_request = {
-        "texts": [user_query],
-        "task": "retrieval.query",
-        "dimensions": 1024
-    }
+    cached = await embedding_cache.get(user_query, QUERY_EMBEDDING_TASK, EMBEDDING_DIMENSIONS)
+    if cached is not None:
+        logger.info("Эмбеддинг взят из кэша")
+        return cached
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(EMBEDDING_SERVICE_URL, json=embed_request, timeout=30.0)
-            response.raise_for_status()
-            embedding_data = response.json()
-            embedding = embedding_data["embedding"][0]
-            logger.info("Эмбеддинг получен. Размер: %s", len(embedding))
-            return embedding
+        # одновременные вопросы разных пользователей уходят в embedding-service одним пакетом
+        embedding = await embedding_batcher.embed(user_query, QUERY_EMBEDDING_TASK, EMBEDDING_DIMENSIONS)
+        logger.info("Эмбеддинг получен. Размер: %s", len(embedding))
+        embedding_cache.put(user_query, QUERY_EMBEDDING_TASK, EMBEDDING_DIMENSIONS, embedding)
+        return embedding
     except (httpx.HTTPError, KeyError, IndexError) as exc:
         logger.error("Ошибка при генерации эмбеддинга: %s", exc)
         return None
 
 
-async def _fetch_similar_texts(embedding: List[float]) -> List[Dict[str, Any]]:
+async def _fetch_similar_texts(embedding: List[float],
+                               options: Optional[VectorSearchOptions] = None) -> List[Dict[str, Any]]:
     if not embedding:
         return []
 
+    options = options or VectorSearchOptions()
     embedding_str = '[' + ','.join(map(str, embedding)) + ']'
-    query = """
-        SELECT id,
-               content,
-               metadata->>'document_name'  AS document_name,
-               metadata->>'source_url'     AS source_url,
-               metadata->>'recommendation_number' AS recommendation_number,
-               1 - (embedding <=> $1::vector) AS similarity
-        FROM chunks
-        ORDER BY similarity DESC
-        LIMIT $2;
-    """
+    where_clause, filter_params = options.where_clause(first_param=3)
+    # вариантов текста запроса немного (по набору фильтров), и asyncpg берёт их подготовленные
+    # выражения из кэша соединения
+    query = SIMILARITY_QUERY.format(where_clause=where_clause)
+    settings = options.settings()
 
-    conn: Optional[asyncpg.Connection] = None
     try:
-        conn = await asyncpg.connect(
-            host=VECTOR_DB_HOST,
-            port=VECTOR_DB_PORT,
-            database=VECTOR_DB_NAME,
-            user=VECTOR_DB_USER,
-            password=VECTOR_DB_PASSWORD,
-        )
-        records = await conn.fetch(query, embedding_str, RETRIEVAL_LIMIT)
+        async with vector_pool.acquire() as conn:
+            if settings:
+                # set_config(..., true) действует до конца транзакции и не остаётся на соединении пула
+                async with conn.transaction():
+                    await conn.execute(
+                        "SELECT " + ", ".join(
+                            f"set_config(${2 * i + 1}, ${2 * i + 2}, true)" for i in range(len(settings))
+                        ),
+                        *[item for pair in settings.items() for item in pair],
+                    )
+                    records = await conn.fetch(query, embedding_str, RETRIEVAL_LIMIT, *filter_params)
+            else:
+                records = await conn.fetch(query, embedding_str, RETRIEVAL_LIMIT, *filter_params)
         logger.info("Найдено %s похожих фрагментов", len(records))
-        return [
-            {
-                "id": record["id"],
-                "text": record["content"],
-                "document_name": record["document_name"],
-                "source_url": record["source_url"],
-                "recommendation_number": record["recommendation_number"],
-                "similarity": record["similarity"],
-            }
-            for record in records
-        ]
-    except asyncpg.PostgresError as exc:
+        return [_passage_from_record(record) for record in records]
+    except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
         logger.error("Ошибка при работе с векторной БД: %s", exc)
         return []
+
+
+async def _fetch_lexical_texts(user_query: str,
+                               options: Optional[VectorSearchOptions] = None) -> List[Dict[str, Any]]:
+    options = options or VectorSearchOptions()
+    conditions, filter_params = options.filter_conditions(first_param=3)
+    query = LEXICAL_QUERY.format(filter_clause="".join(f" AND {condition}" for condition in conditions))
+
+    try:
+        async with vector_pool.acquire() as conn:
+            records = await conn.fetch(query, user_query, LEXICAL_LIMIT, *filter_params)
+        logger.info("Полнотекстовым поиском найдено %s фрагментов", len(records))
+        return [_passage_from_record(record) for record in records]
+    except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+        logger.error("Ошибка полнотекстового поиска в векторной БД: %s", exc)
+        return []
+
+
+def _passage_from_record(record: Any) -> Dict[str, Any]:
+    return {
+        "id": record["id"],
+        "text": record["content"],
+        "document_name": record["document_name"],
+        "source_url": record["source_url"],
+        "recommendation_number": record["recommendation_number"],
+        "document_id": record["document_id"],
+        "raw_document_id": record["raw_document_id"],
+        "similarity": record["similarity"],
+    }
+
+
+def _fuse_rankings(*rankings: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """Reciprocal-rank fusion: фрагмент получает сумму 1 / (k + позиция) по всем спискам."""
+    fused: Dict[Any, Dict[str, Any]] = {}
+    for ranking in rankings:
+        for position, passage in enumerate(ranking, start=1):
+            entry = fused.get(passage["id"])
+            if entry is None:
+                entry = fused[passage["id"]] = {**passage, "rrf_score": 0.0}
+            elif entry.get("similarity") is None:
+                entry["similarity"] = passage.get("similarity")
+            entry["rrf_score"] += 1.0 / (RRF_K + position)
+    return sorted(fused.values(), key=lambda item: item["rrf_score"], reverse=True)[:limit]
+
+
+async def _timed(branch: str, coro: Awaitable[T]) -> T:
+    started = time.perf_counter()
+    try:
+        return await coro
     finally:
-        if conn:
-            await conn.close()
+        elapsed = time.perf_counter() - started
+        retrieval_stats.record(branch, elapsed)
+        logger.info("Поиск фрагментов (%s): %.1f мс", branch, elapsed * 1000)
+
+
+async def _retrieve_passages(user_query: str, embedding: List[float],
+                             options: VectorSearchOptions) -> List[Dict[str, Any]]:
+    if options.mode != "hybrid":
+        return await _timed("vector", _fetch_similar_texts(embedding, options))
+
+    # ветки идут параллельно на разных соединениях пула, так что гибридный режим
+    # добавляет к задержке только разницу между ними
+    vector_passages, lexical_passages = await _timed("hybrid", asyncio.gather(
+        _timed("vector", _fetch_similar_texts(embedding, options)),
+        _timed("lexical", _fetch_lexical_texts(user_query, options)),
+    ))
+    return _fuse_rankings(vector_passages, lexical_passages, limit=RETRIEVAL_LIMIT)
+
+
+def _rerank_metadata(passage: Dict[str, Any], index: int) -> Dict[str, Any]:
+    return {
+        "passage_index": index,
+        "chunk_id": str(passage["id"]),
+        "document_id": passage.get("document_id"),
+        "document_name": passage.get("document_name"),
+        "recommendation_number": passage.get("recommendation_number"),
+    }
 
 
-async def _rerank_results(user_query: str, passages: List[str]) -> Optional[Dict[str, Any]]:
-    if not passages:
-        return None
+def _echoed_index(item: Dict[str, Any], size: int) -> Optional[int]:
+    metadata = item.get("metadata") if isinstance(item.get("metadata"), dict) else {}
+    for value in [item.get(key) for key in RERANK_INDEX_KEYS] + [metadata.get("passage_index")]:
+        if isinstance(value, int) and not isinstance(value, bool) and 0 <= value < size:
+            return value
+    return None
+
+
+def _resolve_rerank_indices(results: List[Dict[str, Any]], passages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Проставляет каждому результату rerank поле index – позицию фрагмента в passages.
 
+    Используется индекс или id фрагмента из ответа, а если сервис возвращает только текст – словарь
+    по тексту. Одинаковые тексты сопоставляются с разными фрагментами по порядку. Для результатов,
+    которые не удалось сопоставить, index равен None.
+    """
+    by_id: Optional[Dict[str, int]] = None
+    by_text: Optional[Dict[str, Deque[int]]] = None
+    used: Set[int] = set()
+    resolved: List[Dict[str, Any]] = []
+
+    for item in results:
+        index = _echoed_index(item, len(passages))
+        metadata = item.get("metadata") if isinstance(item.get("metadata"), dict) else {}
+        chunk_id = item.get("id", metadata.get("chunk_id"))
+        if index is None and chunk_id is not None:
+            if by_id is None:
+                by_id = {str(passage["id"]): position for position, passage in enumerate(passages)}
+            index = by_id.get(str(chunk_id))
+        if index is None and item.get("text") is not None:
+            if by_text is None:
+                by_text = defaultdict(deque)
+                for position, passage in enumerate(passages):
+                    by_text[passage["text"].strip()].append(position)
+            candidates = by_text.get(item["text"].strip())
+            while candidates:
+                position = candidates.popleft()
+                if position not in used:
+                    index = position
+                    break
+
+        if index is not None:
+            used.add(index)
+        resolved.append({**item, "index": index})
+    return resolved
+
+
+async def _rerank_batch(user_query: str, passages: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
     rerank_request = {
         "query": user_query,
-        "passages": passages,
+        "passages": [passage["text"] for passage in passages],
+        # позиция и id фрагмента в метаданных: по ним результат сопоставляется без сравнения текстов
+        "metadata": [_rerank_metadata(passage, index) for index, passage in enumerate(passages)],
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(RERANK_SERVICE_URL, json=rerank_request, timeout=30.0)
-            response.raise_for_status()
-            rerank_data = response.json()
-            logger.info("Результаты rerank получены")
-            return rerank_data
-    except httpx.HTTPError as exc:
+        response = await http_clients.get("rerank").post(RERANK_SERVICE_URL, json=rerank_request)
+        response.raise_for_status()
+        rerank_data = response.json()
+    except (httpx.HTTPError, ValueError) as exc:
         logger.error("Ошибка при rerank: %s", exc)
         return None
+    return _resolve_rerank_indices(rerank_data.get("reranked_results") or [], passages)
+
+
+async def _rerank_results(user_query: str, passages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not passages:
+        return None
+
+    size = max(1, RERANK_MAX_PASSAGES)
+    offsets = range(0, len(passages), size)
+    batches = await asyncio.gather(*(_rerank_batch(user_query, passages[offset:offset + size]) for offset in offsets))
+    if all(batch is None for batch in batches):
+        return None
+
+    results: List[Dict[str, Any]] = []
+    for offset, batch in zip(offsets, batches):
+        if batch is None:
+            logger.warning("Фрагменты %s–%s не переранжированы", offset + 1, offset + size)
+            continue
+        for item in batch:
+            if item["index"] is not None:
+                item["index"] += offset
+            results.append(item)
+
+    if len(batches) > 1:
+        # оценки cross-encoder не зависят от остальных фрагментов запроса, поэтому части можно объединить
+        results.sort(key=lambda item: item.get("score") if item.get("score") is not None else float("-inf"),
+                     reverse=True)
+        for rank, item in enumerate(results, start=1):
+            item["rank"] = rank
+    logger.info("Результаты rerank получены")
+    return {"reranked_results": results}
 
 
 def _format_response(rerank_data: Dict[str, Any], passages: List[Dict[str, Any]]) -> str:
@@ -160,9 +498,9 @@ def _format_response(rerank_data: Dict[str, Any], passages: List[Dict[str, Any]]
 
     lines: List[str] = []
     for idx, item in enumerate(results, start=1):
-        text = item.get("text", "").strip()
+        matched = passages[item["index"]] if item.get("index") is not None else None
+        text = (item.get("text") or (matched["text"] if matched else "")).strip()
         score = item.get("score")
-        matched = next((p for p in passages if p["text"] == text), None)
         source_parts = []
         if matched:
             if matched.get("document_name"):
@@ -216,12 +554,8 @@ def _build_prompt(user_query: str, reranked_results: List[Dict[str, Any]]) -> st
     return prompt
 
 
-async def _call_llm(prompt: str, user_query: str, reranked_results: List[Dict[str, Any]]) -> Optional[str]:
-    if not LLM_SERVICE_URL:
-        logger.warning("LLM_SERVICE_URL не задан. Ответ будет сформирован без обращения к LLM.")
-        return None
-
-    payload = {
+def _build_llm_payload(prompt: str, user_query: str, reranked_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
         "prompt": prompt,
         "query": user_query,
         "context": [
@@ -236,20 +570,86 @@ async def _call_llm(prompt: str, user_query: str, reranked_results: List[Dict[st
         ],
     }
 
+
+async def _call_llm(prompt: str, user_query: str, reranked_results: List[Dict[str, Any]]) -> Optional[str]:
+    if not LLM_SERVICE_URL:
+        logger.warning("LLM_SERVICE_URL не задан. Ответ будет сформирован без обращения к LLM.")
+        return None
+
+    payload = _build_llm_payload(prompt, user_query, reranked_results)
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(LLM_SERVICE_URL, json=payload, timeout=60.0)
-            response.raise_for_status()
-            data = response.json()
-            llm_answer = data.get("answer") or data.get("response") or data.get("result")
-            logger.info("Ответ от LLM получен")
-            return llm_answer
+        response = await http_clients.get("llm").post(LLM_SERVICE_URL, json=payload)
+        response.raise_for_status()
+        data = response.json()
+        llm_answer = data.get("answer") or data.get("response") or data.get("result")
+        logger.info("Ответ от LLM получен")
+        return llm_answer
     except httpx.HTTPError as exc:
         logger.error("Ошибка при обращении к LLM сервису: %s", exc)
         return None
 
 
-def _merge_answer_with_sources(llm_answer: Optional[str], reranked_results: List[Dict[str, Any]]) -> str:
+def _extract_llm_text(data: Any) -> str:
+    if isinstance(data, str):
+        return data
+    if not isinstance(data, dict):
+        return ""
+    for key in ("token", "delta", "text", "answer", "response", "result", "content"):
+        value = data.get(key)
+        if isinstance(value, str):
+            return value
+    choices = data.get("choices")
+    if choices and isinstance(choices[0], dict):
+        delta = choices[0].get("delta") or choices[0].get("message") or {}
+        return delta.get("content") or ""
+    return ""
+
+
+async def _stream_llm(prompt: str, user_query: str, reranked_results: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    """Фрагменты ответа LLM по мере генерации.
+
+    Поддерживаются ответы text/event-stream, NDJSON, обычный текст и, если сервис не умеет
+    стримить, цельный JSON-ответ.
+    """
+    payload = _build_llm_payload(prompt, user_query, reranked_results)
+    payload["stream"] = True
+
+    async with http_clients.get("llm").stream("POST", LLM_SERVICE_URL, json=payload) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("content-type", "")
+
+        if "text/event-stream" in content_type:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    text = _extract_llm_text(json.loads(data))
+                except json.JSONDecodeError:
+                    text = data
+                if text:
+                    yield text
+        elif "ndjson" in content_type or "jsonl" in content_type:
+            async for line in response.aiter_lines():
+                if line.strip():
+                    text = _extract_llm_text(json.loads(line))
+                    if text:
+                        yield text
+        elif "application/json" in content_type:
+            data = json.loads(await response.aread())
+            text = data.get("answer") or data.get("response") or data.get("result")
+            if text:
+                yield text
+        else:
+            async for text in response.aiter_text():
+                if text:
+                    yield text
+
+
+def _format_sources_block(reranked_results: List[Dict[str, Any]]) -> str:
     sources_lines: List[str] = []
     for idx, item in enumerate(reranked_results, start=1):
         doc = item.get("document_name") or "Неизвестный документ"
@@ -259,9 +659,12 @@ def _merge_answer_with_sources(llm_answer: Optional[str], reranked_results: List
         score_display = f"{score:.2f}" if score is not None else "—"
         sources_lines.append(f"{idx}. {doc}, рекомендация {rec} (score={score_display})\n   {link}")
 
-    sources_block = "\n".join(sources_lines)
+    return "\n".join(sources_lines)
+
 
+def _merge_answer_with_sources(llm_answer: Optional[str], reranked_results: List[Dict[str, Any]]) -> str:
     if llm_answer:
+        sources_block = _format_sources_block(reranked_results)
         return f"{llm_answer}\n\nИсточники:\n{sources_block}"
 
     # fallback ответ
@@ -279,36 +682,137 @@ def _merge_answer_with_sources(llm_answer: Optional[str], reranked_results: List
     return f"{fallback_intro}\n\n{fallback_block}"
 
 
-async def get_response(user_query: str) -> str:
+async def _prepare_context(user_query: str,
+                           options: Optional[VectorSearchOptions] = None) -> Union[RagAnswer, RagContext]:
+    options = options or VectorSearchOptions()
     # получение эмбеддинга
     embedding = await _fetch_embedding(user_query)
     if embedding is None:
-        return "Не удалось получить эмбеддинг для запроса. Повторите попытку позже."
+        return RagAnswer("Не удалось получить эмбеддинг для запроса. Повторите попытку позже.")
+
+    # ответ без фильтров не подходит для запроса с фильтрами, поэтому кэш используется только без них
+    cached_answer = None if options.has_filters else await answer_cache.lookup(embedding)
+    if cached_answer is not None:
+        return RagAnswer(cached_answer, from_cache=True)
 
     # db retrieval
-    passages = await _fetch_similar_texts(embedding)
+    passages = await _retrieve_passages(user_query, embedding, options)
     if not passages:
-        return "Релевантные рекомендации не найдены в базе данных."
+        return RagAnswer("Релевантные рекомендации не найдены в базе данных.")
 
-    rerank_data = await _rerank_results(user_query, [p["text"] for p in passages])
-    if rerank_data is None:
-        return "Не удалось выполнить переранжирование результатов. Попробуйте повторить запрос позже."
+    candidates, skip_rerank = rerank_policy.select_candidates(passages)
+    if not candidates:
+        return RagAnswer("Релевантные рекомендации не найдены в базе данных.")
 
-    reranked_results_raw = rerank_data.get("reranked_results") or []
     matched_results: List[Dict[str, Any]] = []
-    for item in reranked_results_raw:
-        text = item.get("text", "")
-        matched = next((p for p in passages if p["text"] == text), None)
-        if matched:
-            enriched = matched.copy()
-            enriched["score"] = item.get("score")
-            enriched["rank"] = item.get("rank")
-            matched_results.append(enriched)
-
-    if not matched_results:
-        return _format_response(rerank_data, passages)
+    if skip_rerank:
+        # порядок и оценка – по векторной близости
+        for rank, passage in enumerate(candidates, start=1):
+            matched_results.append({**passage, "score": passage["similarity"], "rank": rank})
+    else:
+        started = time.perf_counter()
+        rerank_data = await _rerank_results(user_query, candidates)
+        if rerank_data is None:
+            return RagAnswer("Не удалось выполнить переранжирование результатов. Попробуйте повторить запрос позже.")
+        rerank_policy.observe_rerank(len(candidates), time.perf_counter() - started)
+
+        for item in rerank_data.get("reranked_results") or []:
+            if item.get("index") is not None:
+                enriched = candidates[item["index"]].copy()
+                enriched["score"] = item.get("score")
+                enriched["rank"] = item.get("rank")
+                matched_results.append(enriched)
+
+        if not matched_results:
+            return RagAnswer(_format_response(rerank_data, candidates))
+        matched_results = rerank_policy.select_context(matched_results)
 
     prompt = _build_prompt(user_query, matched_results)
-    llm_answer = await _call_llm(prompt, user_query, matched_results)
+    return RagContext(embedding=embedding, matched_results=matched_results, prompt=prompt,
+                      cacheable=not options.has_filters)
+
+
+def _cache_answer(context: RagContext, response: str) -> None:
+    if not context.cacheable:
+        return
+    answer_cache.store(
+        context.embedding, response, [item.get("raw_document_id") for item in context.matched_results]
+    )
+
+
+async def get_response(user_query: str, options: Optional[VectorSearchOptions] = None) -> RagAnswer:
+    context = await _prepare_context(user_query, options)
+    if isinstance(context, RagAnswer):
+        return context
+
+    started = time.perf_counter()
+    llm_answer = await _call_llm(context.prompt, user_query, context.matched_results)
+    if llm_answer:
+        rerank_policy.observe_llm(len(context.matched_results), time.perf_counter() - started)
+
+    response = _merge_answer_with_sources(llm_answer, context.matched_results)
+    # fallback без LLM не кэшируем, чтобы следующий запрос снова попробовал получить ответ
+    if llm_answer:
+        _cache_answer(context, response)
+    return RagAnswer(response)
+
+
+async def stream_response(user_query: str,
+                          options: Optional[VectorSearchOptions] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Потоковый вариант get_response: фреймы retrieval, chat_message_delta и chat_message_end."""
+    context = await _prepare_context(user_query, options)
+    if isinstance(context, RagAnswer):
+        yield {
+            "type": "chat_message_end",
+            "role": "bot",
+            "content": context.content,
+            "sources": None,
+            "from_cache": context.from_cache,
+            "truncated": False,
+        }
+        return
+
+    yield {
+        "type": "retrieval",
+        "sources": [
+            {
+                "document_name": item.get("document_name"),
+                "recommendation_number": item.get("recommendation_number"),
+                "source_url": item.get("source_url"),
+                "score": item.get("score"),
+            }
+            for item in context.matched_results
+        ],
+    }
 
-    return _merge_answer_with_sources(llm_answer, matched_results)
\ No newline at end of file
+    parts: List[str] = []
+    truncated = False
+    if LLM_SERVICE_URL:
+        started = time.perf_counter()
+        try:
+            async for delta in _stream_llm(context.prompt, user_query, context.matched_results):
+                parts.append(delta)
+                yield {"type": "chat_message_delta", "role": "bot", "delta": delta}
+            logger.info("Потоковый ответ от LLM получен")
+            rerank_policy.observe_llm(len(context.matched_results), time.perf_counter() - started)
+        # AttributeError и TypeError – строка потока оказалась JSON, но не объектом нужного вида
+        except (httpx.HTTPError, json.JSONDecodeError, AttributeError, TypeError) as exc:
+            logger.error("Ошибка при потоковом обращении к LLM сервису: %s", exc)
+            # клиент уже показал начало ответа: оставляем его и помечаем обрывом, а не подменяем fallback
+            truncated = bool(parts)
+    else:
+        logger.warning("LLM_SERVICE_URL не задан. Ответ будет сформирован без обращения к LLM.")
+
+    llm_answer = "".join(parts) or None
+    response = _merge_answer_with_sources(llm_answer, context.matched_results)
+    if llm_answer and not truncated:
+        _cache_answer(context, response)
+
+    yield {
+        "type": "chat_message_end",
+        "role": "bot",
+        "content": response,
+        "sources": _format_sources_block(context.matched_results),
+        "from_cache": False,
+        "truncated": truncated,
+    }
@@ -0,0 +1,52 @@
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class FilesystemBlobStore:
+    """Хранилище PDF на локальном диске с адресацией по SHA-256 содержимого.
+
+    Одинаковые файлы (например, неизменённые версии документа) хранятся в одном экземпляре.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256[2:4] / sha256
+
+    def put(self, data: bytes) -> Tuple[str, int]:
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path_for(sha256)
+        if path.is_file():
+            return sha256, len(data)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # запись во временный файл и атомарное переименование: читатели не увидят недописанный файл
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                tmp.write(data)
+                tmp.flush()
+                os.fsync(tmp.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return sha256, len(data)
+
+    def read(self, sha256: str) -> bytes:
+        return self.path_for(sha256).read_bytes()
+
+    def delete(self, sha256: str) -> None:
+        try:
+            self.path_for(sha256).unlink()
+            logger.info("Файл %s удалён из хранилища", sha256)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,101 @@
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
+
+from psycopg2 import extensions
+from psycopg2.extras import Json, execute_values
+
+from db.postgres import ConnectionPool
+from db.vector_db import VectorConnection
+
+logger = logging.getLogger(__name__)
+
+# хэш считается по content, поэтому сверка работает и для фрагментов, загруженных до появления синхронизации по хэшам
+EXISTING_CHUNKS_QUERY = """
+    SELECT id::text, encode(sha256(convert_to(content, 'UTF8')), 'hex') AS content_hash, metadata
+    FROM chunks
+    WHERE metadata->>'document_id' = %s;
+"""
+
+UPDATE_METADATA_QUERY = """
+    UPDATE chunks AS c
+    SET metadata = v.metadata::jsonb
+    FROM (VALUES %s) AS v(id, document_id, metadata)
+    WHERE c.metadata->>'document_id' = v.document_id AND c.id::text = v.id;
+"""
+
+DELETE_CHUNKS_QUERY = """
+    DELETE FROM chunks
+    WHERE metadata->>'document_id' = %s AND id::text = ANY(%s);
+"""
+
+
+class ChunkStore:
+    """Синхронный доступ к фрагментам в векторной БД для сверки при повторной синхронизации.
+
+    Запись новых фрагментов по-прежнему выполняет embedding-service, здесь фрагменты только
+    читаются, переносятся на новую версию документа и удаляются.
+    """
+
+    def __init__(self):
+        config = VectorConnection()
+        self._pool = ConnectionPool(
+            {
+                "dbname": config.dbname,
+                "user": config.user,
+                "password": config.password,
+                "host": config.host,
+                "port": config.port,
+            },
+            max_size=config.max_size,
+            timeout=config.acquire_timeout,
+            ping_interval=5,
+            max_idle=config.max_inactive_lifetime,
+        )
+
+    @contextmanager
+    def _session(self) -> Iterator[extensions.connection]:
+        conn = self._pool.getconn()
+        try:
+            yield conn
+        finally:
+            self._pool.putconn(conn)
+
+    def close(self) -> None:
+        self._pool.closeall()
+
+    def existing_chunks(self, document_id: str) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """(id, SHA-256 текста, metadata) всех фрагментов документа, включая фрагменты старых версий."""
+        with self._session() as conn:
+            with conn.cursor() as cur:
+                cur.execute(EXISTING_CHUNKS_QUERY, (document_id,))
+                return [(row[0], row[1], row[2] or {}) for row in cur.fetchall()]
+
+    def apply(self, document_id: str, updates: Sequence[Tuple[str, Dict[str, Any]]],
+              stale_ids: Sequence[str]) -> None:
+        """В одной транзакции обновляет метаданные переиспользуемых фрагментов и удаляет устаревшие."""
+        if not updates and not stale_ids:
+            return
+
+        with self._session() as conn:
+            # соединения пула работают в autocommit; with conn фиксирует транзакцию или откатывает её при ошибке
+            conn.autocommit = False
+            try:
+                with conn, conn.cursor() as cur:
+                    if updates:
+                        execute_values(
+                            cur,
+                            UPDATE_METADATA_QUERY,
+                            [(chunk_id, document_id, Json(metadata)) for chunk_id, metadata in updates],
+                        )
+                    if stale_ids:
+                        cur.execute(DELETE_CHUNKS_QUERY, (document_id, list(stale_ids)))
+            finally:
+                if not conn.closed:
+                    conn.autocommit = True
+        logger.info(
+            "Документ %s: метаданные обновлены у %s фрагментов, удалено %s фрагментов",
+            document_id,
+            len(updates),
+            len(stale_ids),
+        )
@@ -5,9 +5,64 @@ CREATE TABLE IF NOT EXISTS documents (
     age_category VARCHAR(20) NOT NULL,
     developer VARCHAR(1000),
     placement_date DATE,
-    data BYTEA NOT NULL
+    data BYTEA,
+    data_size BIGINT,
+    data_sha256 CHAR(64),
+    embedded_sha256 CHAR(64),
+    embedded_empty BOOLEAN NOT NULL DEFAULT FALSE
 );
 
+ALTER TABLE documents ALTER COLUMN data SET STORAGE EXTERNAL;
+CREATE INDEX IF NOT EXISTS idx_documents_data_sha256 ON documents (data_sha256);
+CREATE INDEX IF NOT EXISTS idx_documents_keyset
+    ON documents (placement_date DESC NULLS LAST, title ASC, id_cr ASC);
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_documents_id_cr_trgm ON documents USING gin (id_cr gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_documents_title_trgm ON documents USING gin (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_documents_search ON documents USING gin (
+    (setweight(to_tsvector('russian', id_cr), 'A') || setweight(to_tsvector('russian', title), 'B'))
+);
+
+CREATE TABLE IF NOT EXISTS documents_stats (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    total BIGINT NOT NULL
+);
+
+CREATE OR REPLACE FUNCTION documents_stats_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE documents_stats SET total = total + (SELECT COUNT(*) FROM new_rows);
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION documents_stats_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE documents_stats SET total = total - (SELECT COUNT(*) FROM old_rows);
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION documents_stats_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE documents_stats SET total = 0;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE TRIGGER trg_documents_stats_insert
+    AFTER INSERT ON documents REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_insert();
+CREATE OR REPLACE TRIGGER trg_documents_stats_delete
+    AFTER DELETE ON documents REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_delete();
+CREATE OR REPLACE TRIGGER trg_documents_stats_truncate
+    AFTER TRUNCATE ON documents
+    FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_truncate();
+
+INSERT INTO documents_stats (total) SELECT COUNT(*) FROM documents
+ON CONFLICT (id) DO NOTHING;
+
 DO $$
 BEGIN
     IF NOT EXISTS (
@@ -22,4 +77,12 @@ BEGIN
         );
     END IF;
 END
-$$;
\ No newline at end of file
+$$;
+CREATE TABLE IF NOT EXISTS chat_messages (
+    message_id UUID PRIMARY KEY,
+    session_id UUID NOT NULL,
+    role VARCHAR(16) NOT NULL,
+    content TEXT NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages (session_id, created_at, message_id);
@@ -0,0 +1,24 @@
+import logging
+
+from db.postgres import DataManager
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_blobs():
+    print("Перенос PDF из таблицы documents в файловое хранилище...")
+
+    data_manager = DataManager()
+    try:
+        data_manager.create_table()
+        moved = data_manager.migrate_to_blob_store()
+        print(f"Перенесено документов: {moved}")
+        if moved:
+            print("Для освобождения места в TOAST выполните VACUUM FULL documents")
+    finally:
+        data_manager.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate_blobs()
@@ -1,12 +1,61 @@
 import datetime
+import hashlib
 import psycopg2
 import logging
 import os, time
+import threading
+from contextlib import contextmanager
+from psycopg2 import extensions
 from psycopg2.extras import execute_values, RealDictCursor
-from typing import Tuple
+from psycopg2.pool import PoolError
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from db.blob_store import FilesystemBlobStore
 
 logger = logging.getLogger(__name__)
 
+# допустимые значения documents.age_category (ограничение chk_documents_age)
+AGE_CATEGORIES = ('Взрослые', 'Дети', 'Взрослые, дети')
+
+# канал LISTEN/NOTIFY, в который отправляются id_cr добавленных, изменённых и удалённых документов
+DOCUMENTS_CHANNEL = "documents_changed"
+
+# выражение полнотекстового индекса idx_documents_search; запросы должны повторять его дословно,
+# иначе планировщик не сопоставит условие с индексом
+SEARCH_VECTOR = (
+    "(setweight(to_tsvector('russian', id_cr), 'A') || "
+    "setweight(to_tsvector('russian', title), 'B'))"
+)
+
+
+# число документов поддерживается триггерами на documents; оценка планировщика – запасной вариант
+COUNTER_TOTAL = "(SELECT total FROM documents_stats)"
+ESTIMATED_TOTAL = "(SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = 'documents'::regclass)"
+
+
+def _like_pattern(search: str) -> str:
+    escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _search_filter(search: str) -> Tuple[str, List[Any]]:
+    """Условие поиска по ID и названию: подстрока через триграммные индексы или совпадение словоформ."""
+    pattern = _like_pattern(search)
+    condition = (
+        f"(id_cr ILIKE %s OR title ILIKE %s "
+        f"OR {SEARCH_VECTOR} @@ websearch_to_tsquery('russian', %s))"
+    )
+    return condition, [pattern, pattern, search]
+
+
+def _search_rank(search: str) -> Tuple[str, List[Any]]:
+    """Релевантность: совпадение ID, близость названия к запросу и ранг полнотекстового поиска."""
+    rank = (
+        f"(similarity(id_cr, %s) + word_similarity(%s, title) "
+        f"+ ts_rank_cd({SEARCH_VECTOR}, websearch_to_tsquery('russian', %s)))"
+    )
+    return rank, [search, search, search]
+
 
 class DataConnection:
     def __init__(self):
@@ -16,25 +65,205 @@ class DataConnection:
         self.host = os.getenv("DB_HOST", "localhost")
         self.port = os.getenv("DB_PORT", "5432")
 
+        self.pool_max_size = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+        self.pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+        # соединение, простоявшее дольше этого времени, проверяется запросом SELECT 1 перед выдачей
+        self.pool_ping_interval = float(os.getenv("DB_POOL_PING_INTERVAL", "5"))
+        self.pool_max_idle = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+
+        # db – PDF хранятся в documents.data, fs – в файловом хранилище, в таблице только хэш и размер
+        self.storage_backend = os.getenv("DOCUMENT_STORAGE", "db").lower()
+        self.blob_dir = os.getenv("DOCUMENT_BLOB_DIR", "data/blobs")
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений psycopg2 с проверкой соединения при выдаче."""
+
+    def __init__(self, conn_config: Dict[str, Any], max_size: int, timeout: float,
+                 ping_interval: float, max_idle: float):
+        self._conn_config = conn_config
+        self._max_size = max_size
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        self._max_idle = max_idle
+
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle: List[Tuple[extensions.connection, float]] = []
+        self._lock = threading.Lock()
+
+        self._in_use = 0
+        self._created = 0
+        self._discarded = 0
+        self._checkouts = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def getconn(self) -> extensions.connection:
+        started = time.perf_counter()
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolError("Превышено время ожидания свободного соединения с БД")
+
+        waited = time.perf_counter() - started
+        try:
+            conn = self._take()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+        return conn
+
+    def putconn(self, conn: extensions.connection) -> None:
+        try:
+            if conn.closed or conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)
+            else:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    # в autocommit conn.rollback() ничего не отправляет серверу, а транзакцию,
+                    # открытую явным BEGIN, нужно откатить, чтобы снять блокировки
+                    if conn.autocommit:
+                        with conn.cursor() as cur:
+                            cur.execute("ROLLBACK")
+                    else:
+                        conn.rollback()
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def closeall(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                "max_size": self._max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "created_total": self._created,
+                "discarded_total": self._discarded,
+                "checkouts_total": checkouts,
+                "wait_time_avg_ms": round(self._wait_time_total / checkouts * 1000, 3) if checkouts else 0.0,
+                "wait_time_max_ms": round(self._wait_time_max * 1000, 3),
+            }
+
+    def _take(self) -> extensions.connection:
+        while True:
+            with self._lock:
+                item = self._idle.pop() if self._idle else None
+
+            if item is None:
+                conn = psycopg2.connect(**self._conn_config)
+                conn.autocommit = True
+                with self._lock:
+                    self._created += 1
+                return conn
+
+            conn, released_at = item
+            if self._is_usable(conn, time.monotonic() - released_at):
+                return conn
+            self._discard(conn)
+
+    def _is_usable(self, conn: extensions.connection, idle_for: float) -> bool:
+        if conn.closed:
+            return False
+        if self._max_idle and idle_for > self._max_idle:
+            return False
+        if idle_for >= self._ping_interval:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            except psycopg2.Error as e:
+                logger.warning(f"Соединение из пула не прошло проверку: {e}")
+                return False
+        return True
+
+    def _discard(self, conn: extensions.connection) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._discarded += 1
+
 
 class DataManager:
     def __init__(self):
         self.connection = DataConnection()
         self.upload_list = []
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # читаем из файлового хранилища при любом значении DOCUMENT_STORAGE: в таблице могут быть строки обоих видов
+        self.blob_store = FilesystemBlobStore(self.connection.blob_dir)
 
     # --------------------------------------------------------------------- #
     # Low-level helpers
     # --------------------------------------------------------------------- #
 
     def _get_connection(self, dbname):
-        conn_config = {
+        return psycopg2.connect(**self._conn_config(dbname))
+
+    def _conn_config(self, dbname=None):
+        return {
             'dbname': dbname or self.connection.dbname,
             'user': self.connection.user,
             'password': self.connection.password,
             'host': self.connection.host,
             'port': self.connection.port
         }
-        return psycopg2.connect(**conn_config)
+
+    def _get_pool(self) -> ConnectionPool:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        self._conn_config(),
+                        max_size=self.connection.pool_max_size,
+                        timeout=self.connection.pool_timeout,
+                        ping_interval=self.connection.pool_ping_interval,
+                        max_idle=self.connection.pool_max_idle,
+                    )
+        return self._pool
+
+    @contextmanager
+    def _session(self, dbname: str = None) -> Iterator[extensions.connection]:
+        """Соединение в режиме autocommit: из пула для рабочей БД, отдельное для служебных БД."""
+        if dbname and dbname != self.connection.dbname:
+            conn = self._get_connection(dbname)
+            try:
+                conn.autocommit = True
+                yield conn
+            finally:
+                conn.close()
+            return
+
+        pool = self._get_pool()
+        conn = pool.getconn()
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        if self._pool is None:
+            return {"max_size": self.connection.pool_max_size, "in_use": 0, "idle": 0}
+        return self._pool.stats()
 
     # --------------------------------------------------------------------- #
     # Database lifecycle
@@ -96,9 +325,104 @@ class DataManager:
             );
         """
 
+        # размер и SHA-256 содержимого нужны для ETag и отдачи файла частями без чтения всего BYTEA;
+        # EXTERNAL хранит PDF без сжатия, чтобы substring() читал из TOAST только нужный фрагмент
+        content_columns_query = """
+            ALTER TABLE documents
+                ADD COLUMN IF NOT EXISTS data_size BIGINT,
+                ADD COLUMN IF NOT EXISTS data_sha256 CHAR(64);
+            ALTER TABLE documents ALTER COLUMN data SET STORAGE EXTERNAL;
+        """
+
+        blob_columns_query = """
+            ALTER TABLE documents ALTER COLUMN data DROP NOT NULL;
+            CREATE INDEX IF NOT EXISTS idx_documents_data_sha256 ON documents (data_sha256);
+        """
+
+        # SHA-256 PDF, фрагменты которого полностью загружены в векторную БД; несовпадение с data_sha256
+        # означает, что синхронизация должна пересчитать фрагменты документа. embedded_empty отмечает PDF,
+        # из которого не извлечён текст: в поиске остаются фрагменты прежней версии
+        sync_columns_query = """
+            ALTER TABLE documents
+                ADD COLUMN IF NOT EXISTS embedded_sha256 CHAR(64),
+                ADD COLUMN IF NOT EXISTS embedded_empty BOOLEAN NOT NULL DEFAULT FALSE;
+        """
+
+        # порядок колонок совпадает с сортировкой списка документов, нужен для keyset-пагинации
+        keyset_index_query = """
+            CREATE INDEX IF NOT EXISTS idx_documents_keyset
+            ON documents (placement_date DESC NULLS LAST, title ASC, id_cr ASC);
+        """
+
+        # pg_trgm ускоряет ILIKE '%...%' по ID и названию, выражение SEARCH_VECTOR даёт поиск по словоформам;
+        # индекс по выражению вместо хранимой колонки не требует перезаписи таблицы вместе с PDF
+        search_index_query = f"""
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX IF NOT EXISTS idx_documents_id_cr_trgm ON documents USING gin (id_cr gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS idx_documents_title_trgm ON documents USING gin (title gin_trgm_ops);
+            CREATE INDEX IF NOT EXISTS idx_documents_search ON documents USING gin ({SEARCH_VECTOR});
+        """
+
+        # счётчик строк вместо COUNT(*) по всей таблице при каждом перелистывании списка;
+        # триггеры уровня оператора обновляют его один раз на INSERT/DELETE, а не на каждую строку
+        counter_query = """
+            CREATE TABLE IF NOT EXISTS documents_stats (
+                id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                total BIGINT NOT NULL
+            );
+
+            CREATE OR REPLACE FUNCTION documents_stats_insert() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE documents_stats SET total = total + (SELECT COUNT(*) FROM new_rows);
+                RETURN NULL;
+            END
+            $$;
+
+            CREATE OR REPLACE FUNCTION documents_stats_delete() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE documents_stats SET total = total - (SELECT COUNT(*) FROM old_rows);
+                RETURN NULL;
+            END
+            $$;
+
+            CREATE OR REPLACE FUNCTION documents_stats_truncate() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                UPDATE documents_stats SET total = 0;
+                RETURN NULL;
+            END
+            $$;
+
+            CREATE OR REPLACE TRIGGER trg_documents_stats_insert
+                AFTER INSERT ON documents REFERENCING NEW TABLE AS new_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_insert();
+            CREATE OR REPLACE TRIGGER trg_documents_stats_delete
+                AFTER DELETE ON documents REFERENCING OLD TABLE AS old_rows
+                FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_delete();
+            CREATE OR REPLACE TRIGGER trg_documents_stats_truncate
+                AFTER TRUNCATE ON documents
+                FOR EACH STATEMENT EXECUTE FUNCTION documents_stats_truncate();
+
+            INSERT INTO documents_stats (total) SELECT COUNT(*) FROM documents
+            ON CONFLICT (id) DO NOTHING;
+        """
+
+        backfill_content_query = """
+            UPDATE documents
+            SET data_size = octet_length(data),
+                data_sha256 = encode(sha256(data), 'hex')
+            WHERE data_sha256 IS NULL;
+        """
+
         self._execute_query(create_query)
         if not self._execute_query(check_constraint_query, fetch=True):
             self._execute_query(add_constraint_query)
+        self._execute_query(content_columns_query)
+        self._execute_query(blob_columns_query)
+        self._execute_query(sync_columns_query)
+        self._execute_query(keyset_index_query)
+        self._execute_query(search_index_query)
+        self._execute_query(counter_query)
+        self._execute_query(backfill_content_query)
         logger.info("Таблица documents создана/проверена")
 
     def initialization_db(self):
@@ -113,8 +437,7 @@ class DataManager:
 
     def _execute_query(self, query: str, params: Tuple = None, dbname: str = None, fetch: bool = False):
         try:
-            with self._get_connection(dbname) as conn:
-                conn.autocommit = True
+            with self._session(dbname) as conn:
                 with conn.cursor() as cur:
                     cur.execute(query, params)
                     if fetch:
@@ -124,58 +447,184 @@ class DataManager:
             logger.error(f"Ошибка в базе данных: {e}")
             raise
 
+    @staticmethod
+    def _notify_changed(cur, doc_ids):
+        cur.execute(
+            "SELECT pg_notify(%s, doc_id) FROM unnest(%s::text[]) AS doc_id",
+            (DOCUMENTS_CHANNEL, list(doc_ids)),
+        )
+
     def add_to_upload_list(self, id_cr, title, MCB="NULL", age_category='Взрослые', developer='NULL',
                            placement_date=datetime.date.today(), data='NULL'):
         self.upload_list.append((id_cr, title, MCB, age_category, developer, placement_date, data))
 
-    def upload_data(self):
-        insert_query = """ INSERT INTO documents (id_cr, title, MCB, age_category, developer, placement_date, data)
+    @property
+    def uses_blob_store(self) -> bool:
+        return self.connection.storage_backend == "fs"
+
+    @staticmethod
+    def _content_info(data) -> Tuple[int, str]:
+        raw = data.encode() if isinstance(data, str) else bytes(data)
+        return len(raw), hashlib.sha256(raw).hexdigest()
+
+    def _prepare_content(self, data) -> Tuple[Any, int, str]:
+        """Значения колонок data, data_size и data_sha256 для выбранного бэкенда хранения."""
+        raw = data.encode() if isinstance(data, str) else bytes(data)
+        if self.uses_blob_store:
+            sha256, size = self.blob_store.put(raw)
+            return None, size, sha256
+        return psycopg2.Binary(raw), *self._content_info(raw)
+
+    @contextmanager
+    def _blob_locks(self, cur, hashes: Iterable[str]):
+        # запись файла со вставкой строки и проверка ссылок с удалением файла не должны перемежаться,
+        # в том числе между процессами, поэтому используются advisory-блокировки PostgreSQL
+        keys = sorted({int(sha256[:15], 16) for sha256 in hashes if sha256})
+        for key in keys:
+            cur.execute("SELECT pg_advisory_lock(%s)", (key,))
+        try:
+            yield
+        finally:
+            for key in reversed(keys):
+                cur.execute("SELECT pg_advisory_unlock(%s)", (key,))
+
+    def _release_blobs(self, cur, hashes: Iterable[str]):
+        """Удаление файлов, на которые больше не ссылается ни одна строка documents."""
+        for sha256 in {h.strip() for h in hashes if h}:
+            with self._blob_locks(cur, [sha256]):
+                cur.execute(
+                    "SELECT 1 FROM documents WHERE data_sha256 = %s AND data IS NULL LIMIT 1",
+                    (sha256,),
+                )
+                if cur.fetchone() is None:
+                    self.blob_store.delete(sha256)
+
+    def upload_data(self, upsert: bool = False):
+        """Пакетная вставка накопленного upload_list одним запросом.
+
+        С upsert существующие документы перезаписываются; id_cr в пакете должны быть уникальны.
+        """
+        insert_query = """ INSERT INTO documents (id_cr, title, MCB, age_category, developer, placement_date, data,
+            data_size, data_sha256)
             VALUES %s"""
+        if upsert:
+            insert_query += """
+            ON CONFLICT (id_cr) DO UPDATE SET
+                title = EXCLUDED.title,
+                MCB = EXCLUDED.MCB,
+                age_category = EXCLUDED.age_category,
+                developer = EXCLUDED.developer,
+                placement_date = EXCLUDED.placement_date,
+                data = EXCLUDED.data,
+                data_size = EXCLUDED.data_size,
+                data_sha256 = EXCLUDED.data_sha256"""
+
+        previous_query = "SELECT data_sha256 FROM documents WHERE id_cr = ANY(%s) AND data IS NULL"
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
-                    execute_values(cur, insert_query, self.upload_list)
+                    ids = [row[0] for row in self.upload_list]
+                    previous = []
+                    if upsert and self.uses_blob_store:
+                        cur.execute(previous_query, (ids,))
+                        previous = [row[0] for row in cur.fetchall()]
+                    hashes = [self._content_info(row[6])[1] for row in self.upload_list] if self.uses_blob_store else []
+                    with self._blob_locks(cur, hashes):
+                        rows = [row[:6] + self._prepare_content(row[6]) for row in self.upload_list]
+                        execute_values(cur, insert_query, rows, page_size=max(1, len(rows)))
+                    self._notify_changed(cur, ids)
+                    replaced = set(h.strip() for h in previous if h) - set(hashes)
+                    if replaced:
+                        self._release_blobs(cur, replaced)
             self.upload_list = []
         except Exception as e:
             logger.error(f"Ошибка при загрузке данных: {e}")
             raise
 
     def delete_data(self, tpl):
-        delete_query = "DELETE FROM documents WHERE id_cr IN %s"
+        delete_query = "DELETE FROM documents WHERE id_cr IN %s RETURNING data_sha256, data IS NULL"
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
                     cur.execute(delete_query, (tpl,))
+                    blob_hashes = [sha256 for sha256, in_blob_store in cur.fetchall() if in_blob_store]
+                    self._notify_changed(cur, tpl)
+                    self._release_blobs(cur, blob_hashes)
 
         except Exception as e:
             logger.error(f"Ошибка при удалении документов: {e}")
             raise
 
     def is_doc_exist(self, doc_id):
-        query = """SELECT id_cr, title, MCB, age_category, developer, placement_date, data FROM documents
-        WHERE id_cr = %s;"""
+        query = """SELECT id_cr, title, MCB, age_category, developer, placement_date, data, data_sha256
+        FROM documents WHERE id_cr = %s;"""
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
                     cur.execute(query, (doc_id,))
                     ans = cur.fetchone()
-                    return ans
+            if ans and ans[6] is None and ans[7]:
+                return ans[:6] + (self.blob_store.read(ans[7].strip()),)
+            return ans[:7] if ans else ans
         except Exception as e:
             logger.error(f"Ошибка получения файла: {e}")
             return []
 
+    def get_document_info(self, doc_id: str):
+        """Метаданные документа без содержимого: размер и SHA-256 для заголовков ответа."""
+        query = """
+            SELECT id_cr, title,
+                   COALESCE(data_size, octet_length(data)) AS data_size,
+                   COALESCE(data_sha256, encode(sha256(data), 'hex')) AS data_sha256,
+                   data IS NULL AS in_blob_store
+            FROM documents
+            WHERE id_cr = %s;
+        """
+
+        try:
+            with self._session() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(query, (doc_id,))
+                    row = cur.fetchone()
+                    return dict(row) if row else None
+        except Exception as e:
+            logger.error(f"Ошибка получения сведений о файле: {e}")
+            return None
+
+    def read_document_range(self, doc_id: str, sha256: str, offset: int, length: int) -> bytes:
+        """Фрагмент содержимого документа; пустой результат, если документ изменился или удалён."""
+        query = """
+            SELECT substring(data FROM %s FOR %s)
+            FROM documents
+            WHERE id_cr = %s AND COALESCE(data_sha256, encode(sha256(data), 'hex')) = %s;
+        """
+
+        with self._session() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, (offset + 1, length, doc_id, sha256))
+                row = cur.fetchone()
+                return bytes(row[0]) if row else b""
+
+    def read_document(self, doc_id: str) -> Optional[bytes]:
+        """Содержимое документа целиком из БД или файлового хранилища; None, если документа нет."""
+        info = self.get_document_info(doc_id)
+        if not info:
+            return None
+        sha256 = info["data_sha256"].strip()
+        if info["in_blob_store"]:
+            return self.blob_store.read(sha256)
+        data = self.read_document_range(doc_id, sha256, 0, info["data_size"])
+        # документ заменили между запросами
+        return data if len(data) == info["data_size"] else None
+
     def get_all_docs(self):
         query = """SELECT id_cr, title, MCB, age_category, developer, placement_date FROM documents;"""
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
                     cur.execute(query)
                     ans = cur.fetchall()
@@ -184,57 +633,144 @@ class DataManager:
             logger.error(f"Ошибка получения всех файлов: {e}")
             return []
 
-    def get_docs_paginated(self, page: int = 0, size: int = 10, search: str | None = None):
+    @staticmethod
+    def _total_columns(search: str | None) -> Tuple[str, List[Any]]:
+        """Колонки total_count/total_exact, вычисляемые в том же запросе, что и страница.
+
+        Без поиска число документов берётся из счётчика documents_stats, который обновляют
+        триггеры, а при его отсутствии – из оценки планировщика. С поиском считается точно.
+        """
+        if not search:
+            return (
+                f"COALESCE({COUNTER_TOTAL}, {ESTIMATED_TOTAL}) AS total_count, "
+                f"{COUNTER_TOTAL} IS NOT NULL AS total_exact",
+                [],
+            )
+        condition, params = _search_filter(search)
+        return f"(SELECT COUNT(*) FROM documents WHERE {condition}) AS total_count, TRUE AS total_exact", params
+
+    def _fetch_total(self, cur, search: str | None) -> Tuple[int, bool]:
+        columns, params = self._total_columns(search)
+        cur.execute(f"SELECT {columns}", params or None)
+        row = cur.fetchone()
+        return int(row["total_count"] or 0), bool(row["total_exact"])
+
+    def _split_total(self, cur, rows, search: str | None) -> Tuple[List[Dict], int, bool]:
+        docs = [dict(row) for row in rows]
+        if not docs:
+            # страница за пределами выборки: итог приходится запросить отдельно
+            total, exact = self._fetch_total(cur, search)
+            return docs, total, exact
+        total, exact = docs[0]["total_count"], docs[0]["total_exact"]
+        for doc in docs:
+            doc.pop("total_count")
+            doc.pop("total_exact")
+        return docs, int(total or 0), bool(exact)
+
+    def get_docs_paginated(self, page: int = 0, size: int = 10,
+                           search: str | None = None) -> Tuple[List[Dict], int, bool]:
+        """Страница документов, общее число и признак того, что число точное, за один запрос."""
         base_query = """
-            SELECT id_cr, title, MCB, age_category, developer, placement_date
+            SELECT id_cr, title, MCB, age_category, developer, placement_date, {total_columns}
             FROM documents
             {where_clause}
-            ORDER BY placement_date DESC NULLS LAST, title ASC
+            ORDER BY {rank_order}placement_date DESC NULLS LAST, title ASC, id_cr ASC
             LIMIT %s OFFSET %s;
         """
 
         params = []
         where_clause = ""
+        rank_order = ""
         normalized_search = search.strip() if isinstance(search, str) else None
         if normalized_search:
-            pattern = f"%{normalized_search}%"
-            where_clause = "WHERE id_cr ILIKE %s OR title ILIKE %s"
-            params.extend([pattern, pattern])
+            condition, condition_params = _search_filter(normalized_search)
+            rank, rank_params = _search_rank(normalized_search)
+            where_clause = f"WHERE {condition}"
+            rank_order = f"{rank} DESC, "
+            # оконная функция считает все найденные строки до LIMIT, отдельный COUNT(*) не нужен
+            total_columns = "COUNT(*) OVER () AS total_count, TRUE AS total_exact"
+            params.extend(condition_params + rank_params)
+        else:
+            total_columns, _ = self._total_columns(None)
 
         params.extend([size, page * size])
-        query = base_query.format(where_clause=where_clause)
+        query = base_query.format(where_clause=where_clause, rank_order=rank_order, total_columns=total_columns)
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor(cursor_factory=RealDictCursor) as cur:
                     cur.execute(query, params)
-                    ans = cur.fetchall()
-                    return [dict(row) for row in ans]
+                    return self._split_total(cur, cur.fetchall(), normalized_search)
         except Exception as e:
             logger.error(f"Ошибка получения файлов с пагинацией: {e}")
-            return []
+            return [], 0, True
 
-    def get_documents_total(self, search: str | None = None) -> int:
-        query = "SELECT COUNT(*) FROM documents"
-        params = []
+    def get_docs_after(self, size: int = 10, after: Tuple | None = None,
+                       search: str | None = None) -> Tuple[List[Dict], int, bool]:
+        """Страница документов после ключа (placement_date, title, id_cr) последней строки предыдущей страницы.
+
+        Каждая ветка UNION ALL читает индекс idx_documents_keyset с нужной позиции и останавливается
+        после size строк, поэтому время выборки не зависит от глубины страницы. При поиске порядок
+        остаётся по дате, а не по релевантности: курсор должен однозначно задавать позицию.
+        Вместе со страницей возвращаются общее число документов и признак его точности.
+        """
+        columns = "id_cr, title, MCB, age_category, developer, placement_date"
+        order = "placement_date DESC NULLS LAST, title ASC, id_cr ASC"
 
+        search_clause = ""
+        search_params = []
         normalized_search = search.strip() if isinstance(search, str) else None
         if normalized_search:
-            pattern = f"%{normalized_search}%"
-            query += " WHERE id_cr ILIKE %s OR title ILIKE %s"
-            params.extend([pattern, pattern])
+            condition, search_params = _search_filter(normalized_search)
+            search_clause = f" AND {condition}"
+
+        if after is None:
+            branches = [("TRUE", [], order)]
+        else:
+            placement_date, title, id_cr = after
+            if placement_date is not None:
+                branches = [
+                    ("placement_date = %s AND (title, id_cr) > (%s, %s)", [placement_date, title, id_cr],
+                     "title ASC, id_cr ASC"),
+                    ("placement_date < %s", [placement_date], order),
+                    ("placement_date IS NULL", [], "title ASC, id_cr ASC"),
+                ]
+            else:
+                branches = [("placement_date IS NULL AND (title, id_cr) > (%s, %s)", [title, id_cr],
+                             "title ASC, id_cr ASC")]
+
+        total_columns, params = self._total_columns(normalized_search)
+        parts = []
+        for condition, condition_params, branch_order in branches:
+            parts.append(
+                f"(SELECT {columns} FROM documents WHERE {condition}{search_clause} "
+                f"ORDER BY {branch_order} LIMIT %s)"
+            )
+            params.extend(condition_params + search_params + [size])
+        query = (
+            f"SELECT page.*, {total_columns} FROM ({' UNION ALL '.join(parts)}) AS page "
+            f"ORDER BY {order} LIMIT %s;"
+        )
+        params.append(size)
 
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
-                with conn.cursor() as cur:
-                    cur.execute(query, params if params else None)
-                    result = cur.fetchone()
-                    return result[0] if result else 0
+            with self._session() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute(query, params)
+                    return self._split_total(cur, cur.fetchall(), normalized_search)
+        except Exception as e:
+            logger.error(f"Ошибка получения файлов по курсору: {e}")
+            return [], 0, True
+
+    def get_documents_total(self, search: str | None = None) -> Tuple[int, bool]:
+        normalized_search = search.strip() if isinstance(search, str) else None
+        try:
+            with self._session() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    return self._fetch_total(cur, normalized_search)
         except Exception as e:
             logger.error(f"Ошибка получения количества документов: {e}")
-            return 0
+            return 0, True
 
     # --------------------------------------------------------------------- #
     # New helpers for ingestion pipeline
@@ -252,25 +788,37 @@ class DataManager:
     ) -> None:
         """Сохранение или обновление документа в таблице documents."""
         upsert_query = """
-            INSERT INTO documents (id_cr, title, MCB, age_category, developer, placement_date, data)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO documents (id_cr, title, MCB, age_category, developer, placement_date, data,
+                                   data_size, data_sha256)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             ON CONFLICT (id_cr) DO UPDATE SET
                 title = EXCLUDED.title,
                 MCB = EXCLUDED.MCB,
                 age_category = EXCLUDED.age_category,
                 developer = EXCLUDED.developer,
                 placement_date = EXCLUDED.placement_date,
-                data = EXCLUDED.data;
+                data = EXCLUDED.data,
+                data_size = EXCLUDED.data_size,
+                data_sha256 = EXCLUDED.data_sha256;
         """
 
+        previous_query = "SELECT data_sha256 FROM documents WHERE id_cr = %s AND data IS NULL"
+
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
-                    cur.execute(
-                        upsert_query,
-                        (doc_id, title, mcb, age_category, developer, placement_date, psycopg2.Binary(data)),
-                    )
+                    cur.execute(previous_query, (doc_id,))
+                    previous = cur.fetchone()
+                    sha256 = self._content_info(data)[1]
+                    with self._blob_locks(cur, [sha256] if self.uses_blob_store else []):
+                        cur.execute(
+                            upsert_query,
+                            (doc_id, title, mcb, age_category, developer, placement_date,
+                             *self._prepare_content(data)),
+                        )
+                    self._notify_changed(cur, [doc_id])
+                    if previous and previous[0] and previous[0].strip() != sha256:
+                        self._release_blobs(cur, [previous[0]])
         except Exception as exc:
             logger.error("Ошибка при сохранении документа %s: %s", doc_id, exc)
             raise
@@ -278,8 +826,7 @@ class DataManager:
     def get_existing_document_ids(self):
         query = "SELECT id_cr FROM documents"
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
                     cur.execute(query)
                     return {row[0] for row in cur.fetchall()}
@@ -287,14 +834,80 @@ class DataManager:
             logger.error("Ошибка при получении списка документов: %s", exc)
             return set()
 
+    def get_sync_state(self) -> Dict[str, Tuple[str | None, str | None]]:
+        """id_cr -> (SHA-256 сохранённого PDF, SHA-256 PDF, фрагменты которого загружены в векторную БД)."""
+        query = "SELECT id_cr, data_sha256, embedded_sha256 FROM documents"
+        try:
+            with self._session() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query)
+                    return {
+                        row[0]: (row[1].strip() if row[1] else None, row[2].strip() if row[2] else None)
+                        for row in cur.fetchall()
+                    }
+        except Exception as exc:
+            logger.error("Ошибка при получении состояния синхронизации: %s", exc)
+            return {}
+
+    def mark_embedded(self, doc_id: str, sha256: str, has_text: bool = True) -> None:
+        """Отмечает PDF sha256 обработанным; без текста (has_text=False) фрагменты документа не менялись."""
+        # условие на data_sha256 не даёт отметить документ, который успели перезаписать другим PDF
+        query = """
+            UPDATE documents SET embedded_sha256 = %s, embedded_empty = %s
+            WHERE id_cr = %s AND data_sha256 = %s
+        """
+        try:
+            with self._session() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(query, (sha256, not has_text, doc_id, sha256))
+                    if cur.rowcount and has_text:
+                        # фрагменты в векторной БД заменены только теперь: уведомление из save_document
+                        # пришло раньше, и кэш ответов мог успеть сохранить ответ по старым фрагментам
+                        self._notify_changed(cur, [doc_id])
+        except psycopg2.Error as e:
+            logger.error(f"Ошибка в базе данных: {e}")
+            raise
+
     def document_exists(self, doc_id: str) -> bool:
         query = "SELECT 1 FROM documents WHERE id_cr = %s"
         try:
-            with self._get_connection(dbname=self.connection.dbname) as conn:
-                conn.autocommit = True
+            with self._session() as conn:
                 with conn.cursor() as cur:
                     cur.execute(query, (doc_id,))
                     return cur.fetchone() is not None
         except Exception as exc:
             logger.error("Ошибка проверки наличия документа %s: %s", doc_id, exc)
             return False
+
+    def migrate_to_blob_store(self) -> int:
+        """Перенос содержимого documents.data в файловое хранилище. Возвращает число перенесённых документов."""
+        ids_query = "SELECT id_cr FROM documents WHERE data IS NOT NULL ORDER BY id_cr"
+        select_query = "SELECT data FROM documents WHERE id_cr = %s AND data IS NOT NULL"
+        update_query = """
+            UPDATE documents
+            SET data = NULL, data_size = %s, data_sha256 = %s
+            WHERE id_cr = %s AND data IS NOT NULL
+        """
+
+        with self._session() as conn:
+            with conn.cursor() as cur:
+                cur.execute(ids_query)
+                doc_ids = [row[0] for row in cur.fetchall()]
+
+        moved = 0
+        for index, doc_id in enumerate(doc_ids, start=1):
+            with self._session() as conn:
+                with conn.cursor() as cur:
+                    # по одному документу, чтобы в памяти не оказалось больше одного PDF
+                    cur.execute(select_query, (doc_id,))
+                    row = cur.fetchone()
+                    if not row:
+                        continue
+                    data = bytes(row[0])
+                    sha256 = hashlib.sha256(data).hexdigest()
+                    with self._blob_locks(cur, [sha256]):
+                        self.blob_store.put(data)
+                        cur.execute(update_query, (len(data), sha256, doc_id))
+                        moved += cur.rowcount
+            logger.info("Документ %s перенесён в файловое хранилище (%s/%s)", doc_id, index, len(doc_ids))
+        return moved
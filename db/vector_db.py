@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+
+class VectorConnection:
+    def __init__(self):
+        self.host = os.getenv("VECTOR_DB_HOST", os.getenv("DB_HOST", "localhost"))
+        self.port = int(os.getenv("VECTOR_DB_PORT", os.getenv("DB_PORT", "5433")))
+        self.dbname = os.getenv("VECTOR_DB_NAME", "rag")
+        self.user = os.getenv("VECTOR_DB_USER", os.getenv("DB_USER", "dev"))
+        self.password = os.getenv("VECTOR_DB_PASSWORD", os.getenv("DB_PASSWORD", "dev_password"))
+
+        self.min_size = int(os.getenv("VECTOR_DB_POOL_MIN_SIZE", "1"))
+        self.max_size = int(os.getenv("VECTOR_DB_POOL_MAX_SIZE", "10"))
+        self.acquire_timeout = float(os.getenv("VECTOR_DB_POOL_TIMEOUT", "10"))
+        self.max_inactive_lifetime = float(os.getenv("VECTOR_DB_POOL_MAX_INACTIVE", "300"))
+        # asyncpg кэширует подготовленные выражения на каждом соединении пула,
+        # поэтому запрос похожих фрагментов парсится и планируется один раз на соединение
+        self.statement_cache_size = int(os.getenv("VECTOR_DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+class VectorPool:
+    """Пул соединений asyncpg к векторной БД, общий для всего приложения."""
+
+    def __init__(self):
+        self.connection = VectorConnection()
+        self._pool: Optional[asyncpg.Pool] = None
+        self._lock = asyncio.Lock()
+
+        self._waiting = 0
+        self._acquired_total = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    async def open(self) -> asyncpg.Pool:
+        if self._pool is not None:
+            return self._pool
+
+        async with self._lock:
+            if self._pool is None:
+                self._pool = await asyncpg.create_pool(
+                    host=self.connection.host,
+                    port=self.connection.port,
+                    database=self.connection.dbname,
+                    user=self.connection.user,
+                    password=self.connection.password,
+                    min_size=self.connection.min_size,
+                    max_size=self.connection.max_size,
+                    max_inactive_connection_lifetime=self.connection.max_inactive_lifetime,
+                    statement_cache_size=self.connection.statement_cache_size,
+                )
+                logger.info(
+                    "Пул векторной БД создан (min=%s, max=%s)",
+                    self.connection.min_size,
+                    self.connection.max_size,
+                )
+        return self._pool
+
+    async def close(self) -> None:
+        async with self._lock:
+            if self._pool is not None:
+                await self._pool.close()
+                self._pool = None
+                logger.info("Пул векторной БД закрыт")
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        pool = await self.open()
+
+        started = time.perf_counter()
+        self._waiting += 1
+        try:
+            conn = await pool.acquire(timeout=self.connection.acquire_timeout)
+        finally:
+            self._waiting -= 1
+
+        waited = time.perf_counter() - started
+        self._acquired_total += 1
+        self._wait_time_total += waited
+        self._wait_time_max = max(self._wait_time_max, waited)
+
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    def stats(self) -> Dict[str, Any]:
+        pool = self._pool
+        size = pool.get_size() if pool else 0
+        idle = pool.get_idle_size() if pool else 0
+        acquired = self._acquired_total
+        return {
+            "open": pool is not None,
+            "min_size": self.connection.min_size,
+            "max_size": self.connection.max_size,
+            "size": size,
+            "in_use": size - idle,
+            "idle": idle,
+            "waiting": self._waiting,
+            "acquired_total": acquired,
+            "wait_time_avg_ms": round(self._wait_time_total / acquired * 1000, 3) if acquired else 0.0,
+            "wait_time_max_ms": round(self._wait_time_max * 1000, 3),
+        }
+
+
+vector_pool = VectorPool()
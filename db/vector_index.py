@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import math
+import os
+from typing import Any, Dict, List
+
+import asyncpg
+
+from db.vector_db import vector_pool
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAMES = {
+    "hnsw": "idx_chunks_embedding_hnsw",
+    "ivfflat": "idx_chunks_embedding_ivfflat",
+}
+
+# индексы для фильтров по метаданным и полнотекстового поиска по фрагментам
+METADATA_INDEXES = {
+    "idx_chunks_document_id": "((metadata->>'document_id'))",
+    "idx_chunks_age_category": "((metadata->>'age_category'))",
+    # полнотекстовая ветка гибридного поиска
+    "idx_chunks_content_fts": "USING gin (to_tsvector('russian', content))",
+}
+
+INVALID_INDEXES_QUERY = """
+    SELECT c.relname
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE i.indrelid = 'chunks'::regclass
+      AND NOT i.indisvalid
+      AND c.relname = ANY($1::text[]);
+"""
+
+ESTIMATED_ROWS_QUERY = "SELECT GREATEST(reltuples, 0)::bigint FROM pg_class WHERE oid = 'chunks'::regclass"
+
+
+class VectorIndexConfig:
+    def __init__(self):
+        self.index_type = os.getenv("VECTOR_INDEX_TYPE", "hnsw").lower()
+        self.hnsw_m = int(os.getenv("VECTOR_HNSW_M", "16"))
+        self.hnsw_ef_construction = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", "64"))
+        # 0 – подобрать по числу строк, как рекомендует pgvector
+        self.ivfflat_lists = int(os.getenv("VECTOR_IVFFLAT_LISTS", "0"))
+        self.maintenance_work_mem = os.getenv("VECTOR_INDEX_MAINTENANCE_WORK_MEM", "")
+        self.rebuild = os.getenv("VECTOR_INDEX_REBUILD", "false").lower() == "true"
+
+
+def _ivfflat_lists(rows: int) -> int:
+    if rows <= 1_000_000:
+        return max(1, rows // 1000)
+    return int(math.sqrt(rows))
+
+
+async def ensure_chunk_indexes(config: VectorIndexConfig | None = None) -> Dict[str, Any]:
+    """Создаёт ANN-индекс выбранного типа по chunks.embedding и индексы по метаданным.
+
+    Индексы строятся CONCURRENTLY, чтобы не блокировать запись эмбеддингов. Индекс другого типа
+    удаляется, недостроенные (INVALID) после прерванной сборки пересоздаются.
+    """
+    config = config or VectorIndexConfig()
+    if config.index_type not in INDEX_NAMES:
+        raise ValueError(f"Неизвестный тип векторного индекса: {config.index_type}")
+
+    index_name = INDEX_NAMES[config.index_type]
+    report: Dict[str, Any] = {"type": config.index_type, "index": index_name, "dropped": [], "created": []}
+
+    async with vector_pool.acquire() as conn:
+        if config.maintenance_work_mem:
+            await conn.execute(f"SET maintenance_work_mem = '{config.maintenance_work_mem}'")
+
+        managed = list(INDEX_NAMES.values()) + list(METADATA_INDEXES)
+        to_drop: List[str] = [record["relname"] for record in await conn.fetch(INVALID_INDEXES_QUERY, managed)]
+        to_drop += [name for name in INDEX_NAMES.values() if name != index_name]
+        if config.rebuild:
+            to_drop.append(index_name)
+        for name in dict.fromkeys(to_drop):
+            await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            report["dropped"].append(name)
+
+        if config.index_type == "hnsw":
+            options = f"m = {config.hnsw_m}, ef_construction = {config.hnsw_ef_construction}"
+        else:
+            # IVFFlat строит списки по имеющимся данным, поэтому создавать его стоит после загрузки
+            lists = config.ivfflat_lists or _ivfflat_lists(await conn.fetchval(ESTIMATED_ROWS_QUERY))
+            options = f"lists = {lists}"
+
+        statements = {
+            index_name: (
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON chunks "
+                f"USING {config.index_type} (embedding vector_cosine_ops) WITH ({options})"
+            )
+        }
+        for name, expression in METADATA_INDEXES.items():
+            statements[name] = f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON chunks {expression}"
+
+        for name, statement in statements.items():
+            logger.info("Создание индекса %s", name)
+            await conn.execute(statement)
+            report["created"].append(name)
+
+        await conn.execute("ANALYZE chunks")
+
+    logger.info("Индексы таблицы chunks готовы: %s (%s)", index_name, options)
+    return report
+
+
+async def _main() -> None:
+    try:
+        print(await ensure_chunk_indexes())
+    except (asyncpg.PostgresError, OSError, ValueError) as exc:
+        logger.error("Не удалось создать индексы таблицы chunks: %s", exc)
+        raise
+    finally:
+        await vector_pool.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
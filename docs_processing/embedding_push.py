@@ -0,0 +1,277 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+logger = logging.getLogger(__name__)
+
+# запись фрагментов в embedding-service не идемпотентна: строки получают новый id при каждом запросе.
+# 429 и 503 – отказ принять пакет, такой пакет повторяется всегда
+REJECTED_STATUSES = {429, 503}
+# после этих ответов, таймаута чтения или обрыва соединения пакет мог быть уже сохранён
+AMBIGUOUS_STATUSES = {500, 502, 504}
+
+
+class EmbeddingPushConfig:
+    def __init__(self):
+        self.url = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8000/embed")
+        self.dimensions = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
+        self.timeout = float(os.getenv("EMBEDDING_REQUEST_TIMEOUT", os.getenv("MINZDRAV_REQUEST_TIMEOUT", "60")))
+
+        # размер пакета задаётся суммарной длиной текстов и подстраивается под задержку сервиса
+        self.batch_chars = int(os.getenv("EMBEDDING_BATCH_CHARS", "12000"))
+        self.min_batch_chars = int(os.getenv("EMBEDDING_BATCH_MIN_CHARS", "2000"))
+        self.max_batch_chars = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", "64000"))
+        self.max_batch_items = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.target_latency = float(os.getenv("EMBEDDING_TARGET_LATENCY", "2"))
+
+        # пакетов одного документа в полёте и общий предел запросов к сервису
+        self.concurrency = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+        self.max_in_flight = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "8"))
+
+        self.max_retries = int(os.getenv("EMBEDDING_MAX_RETRIES", "4"))
+        self.retry_base_delay = float(os.getenv("EMBEDDING_RETRY_BASE_DELAY", "0.5"))
+        self.retry_max_delay = float(os.getenv("EMBEDDING_RETRY_MAX_DELAY", "15"))
+
+
+class RetryableEmbeddingError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None, maybe_stored: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.maybe_stored = maybe_stored
+
+
+class AdaptiveBatchBudget:
+    """Бюджет символов на пакет: растёт, пока сервис отвечает быстрее целевой задержки, и уменьшается,
+    когда отвечает медленнее или с ошибками. Общий для всех документов, потому что сервис один."""
+
+    def __init__(self, config: EmbeddingPushConfig):
+        self._config = config
+        self._chars = float(min(max(config.batch_chars, config.min_batch_chars), config.max_batch_chars))
+        self._lock = threading.Lock()
+
+    @property
+    def chars(self) -> int:
+        with self._lock:
+            return int(self._chars)
+
+    def observe(self, chars: int, latency: float) -> None:
+        config = self._config
+        with self._lock:
+            if latency > config.target_latency:
+                # пропорциональное уменьшение, но не более чем вдвое за раз
+                self._chars *= max(0.5, config.target_latency / latency)
+            elif latency < config.target_latency / 2 and chars >= self._chars * 0.8:
+                # увеличиваем только по полным пакетам: хвост документа ничего не говорит о пределе сервиса
+                self._chars *= 1.25
+            self._chars = min(max(self._chars, config.min_batch_chars), config.max_batch_chars)
+
+    def penalize(self) -> None:
+        with self._lock:
+            self._chars = max(self._chars / 2, self._config.min_batch_chars)
+
+
+class EmbeddingPusher:
+    """Отправка фрагментов в embedding-service: пакеты по бюджету символов, несколько пакетов
+    одновременно через общий пул соединений, повторы с экспоненциальной задержкой и джиттером.
+
+    Без retry_unsafe повторяются только пакеты, которые сервис точно не сохранил (соединение
+    не установлено, ответ 429/503). С retry_unsafe повторяются и остальные сбои; вызывающий
+    код должен после отправки удалить возможные дубли, их число – unsafe_retries в статистике.
+    """
+
+    def __init__(self, config: Optional[EmbeddingPushConfig] = None):
+        self.config = config or EmbeddingPushConfig()
+        self.budget = AdaptiveBatchBudget(self.config)
+        self._session: Optional[requests.Session] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _resources(self) -> Tuple[requests.Session, ThreadPoolExecutor]:
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, self.config.max_in_flight))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=max(1, self.config.max_in_flight), thread_name_prefix="embedding-push"
+                )
+            return self._session, self._executor
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                # не блокируем остановку приложения: пакеты в полёте дорабатывают в своих потоках
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def push(self, texts: List[str], metadata: List[Dict[str, Any]], label: str,
+             progress: Optional[Callable[[int, int], None]] = None, retry_unsafe: bool = False) -> Dict[str, Any]:
+        """Отправляет фрагменты документа label; возвращает статистику с пропускной способностью."""
+        session, executor = self._resources()
+        total = len(texts)
+        batches = self._batches(texts)
+        in_flight: Set[Future] = set()
+        sent = 0
+        batch_count = 0
+        retries = 0
+        unsafe_retries = 0
+        started = time.perf_counter()
+        error: Optional[BaseException] = None
+
+        try:
+            while True:
+                while error is None and len(in_flight) < max(1, self.config.concurrency):
+                    # пакет формируется непосредственно перед отправкой, чтобы учесть текущий бюджет
+                    bounds = next(batches, None)
+                    if bounds is None:
+                        break
+                    first, last = bounds
+                    in_flight.add(executor.submit(
+                        self._send, session, texts[first:last], metadata[first:last], retry_unsafe
+                    ))
+                    batch_count += 1
+
+                if not in_flight:
+                    break
+
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    try:
+                        count, attempts, unsafe = future.result()
+                    except Exception as exc:
+                        # дожидаемся остальных пакетов в полёте, новые не отправляем
+                        error = error or exc
+                        continue
+                    sent += count
+                    retries += attempts
+                    unsafe_retries += unsafe
+                    if progress is not None:
+                        progress(sent, total)
+        finally:
+            if in_flight:
+                wait(in_flight)
+
+        elapsed = time.perf_counter() - started
+        stats = {
+            "chunks": sent,
+            "batches": batch_count,
+            "retries": retries,
+            "unsafe_retries": unsafe_retries,
+            "seconds": round(elapsed, 3),
+            "chunks_per_second": round(sent / elapsed, 2) if elapsed > 0 else 0.0,
+            "batch_chars": self.budget.chars,
+        }
+        if error is not None:
+            logger.error("Ошибка при сохранении эмбеддингов документа %s: %s", label, error)
+            raise error
+
+        logger.info(
+            "Документ %s: %s чанков за %.2f с (%.2f чанков/с), пакетов %s, повторов %s, бюджет пакета %s символов",
+            label,
+            sent,
+            elapsed,
+            stats["chunks_per_second"],
+            batch_count,
+            retries,
+            stats["batch_chars"],
+        )
+        return stats
+
+    def _batches(self, texts: List[str]) -> Iterator[Tuple[int, int]]:
+        start = 0
+        while start < len(texts):
+            budget = self.budget.chars
+            end = start
+            chars = 0
+            # хотя бы один фрагмент в пакете, даже если он длиннее бюджета
+            while end < len(texts) and end - start < self.config.max_batch_items:
+                if end > start and chars + len(texts[end]) > budget:
+                    break
+                chars += len(texts[end])
+                end += 1
+            yield start, end
+            start = end
+
+    def _send(self, session: requests.Session, texts: List[str], metadata: List[Dict[str, Any]],
+              retry_unsafe: bool) -> Tuple[int, int, int]:
+        """Отправляет пакет; возвращает число фрагментов, повторов и повторов после возможной записи."""
+        payload = {
+            "texts": texts,
+            "metadata": metadata,
+            "task": "retrieval.passage",
+            "dimensions": self.config.dimensions,
+        }
+        chars = sum(len(text) for text in texts)
+        unsafe = 0
+
+        for attempt in range(self.config.max_retries + 1):
+            started = time.perf_counter()
+            try:
+                response = session.post(self.config.url, json=payload, timeout=self.config.timeout)
+                if response.status_code in REJECTED_STATUSES or response.status_code in AMBIGUOUS_STATUSES:
+                    raise RetryableEmbeddingError(
+                        f"embedding-service ответил {response.status_code}",
+                        retry_after=_retry_after(response),
+                        maybe_stored=response.status_code in AMBIGUOUS_STATUSES,
+                    )
+                response.raise_for_status()
+            except (RetryableEmbeddingError, requests.Timeout, requests.ConnectionError) as exc:
+                self.budget.penalize()
+                maybe_stored = exc.maybe_stored if isinstance(exc, RetryableEmbeddingError) else not _not_sent(exc)
+                if attempt >= self.config.max_retries or (maybe_stored and not retry_unsafe):
+                    raise
+                if maybe_stored:
+                    unsafe += 1
+                delay = random.uniform(0, min(self.config.retry_max_delay, self.config.retry_base_delay * 2 ** attempt))
+                if isinstance(exc, RetryableEmbeddingError) and exc.retry_after is not None:
+                    delay = max(delay, min(exc.retry_after, self.config.retry_max_delay))
+                logger.warning(
+                    "Пакет из %s чанков не принят (%s)%s, повтор %s/%s через %.2f с",
+                    len(texts),
+                    exc,
+                    ", возможен дубль" if maybe_stored else "",
+                    attempt + 1,
+                    self.config.max_retries,
+                    delay,
+                )
+                time.sleep(delay)
+                continue
+
+            self.budget.observe(chars, time.perf_counter() - started)
+            logger.debug("embedding-service ответ: %s", response.text[:200])
+            return len(texts), attempt, unsafe
+
+        raise AssertionError("unreachable")
+
+
+def _not_sent(exc: requests.RequestException) -> bool:
+    """Сбой до отправки запроса: соединение с сервисом не было установлено."""
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+embedding_pusher = EmbeddingPusher()
@@ -1,5 +1,8 @@
+import base64
+import datetime
+import json
 from pydantic import BaseModel
-from typing import List, Any
+from typing import List, Any, Dict, Optional, Tuple
 
 
 class Pageable(BaseModel):
@@ -12,3 +15,25 @@ class PaginatedResponse(BaseModel):
     total: int
     pageable: Pageable
     total_pages: int
+    next_cursor: Optional[str] = None
+    # False, если total – оценка планировщика, а не точное число
+    exact_total: bool = True
+
+
+def encode_cursor(row: Dict[str, Any]) -> str:
+    """Непрозрачный курсор из ключа сортировки (placement_date, title, id_cr) строки."""
+    placement_date = row.get("placement_date")
+    key = [placement_date.isoformat() if placement_date else None, row["title"], row["id_cr"]]
+    raw = json.dumps(key, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Optional[datetime.date], str, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        placement_date, title, id_cr = json.loads(raw)
+        if not isinstance(title, str) or not isinstance(id_cr, str):
+            raise ValueError
+        return (datetime.date.fromisoformat(placement_date) if placement_date else None), title, id_cr
+    except (ValueError, TypeError) as exc:
+        raise ValueError("Некорректный курсор") from exc
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class Stage:
+    """Этап конвейера: пул потоков, читающих из ограниченной очереди.
+
+    Функция этапа получает элемент и возвращает его (или новый элемент) для следующего этапа.
+    None означает, что элемент дальше не передаётся. Исключение прерывает обработку только
+    этого элемента.
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], Any], workers: int = 1, queue_size: int = 8):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.inbox: "queue.Queue[Any]" = queue.Queue(maxsize=max(1, queue_size))
+        self.next: Optional[Stage] = None
+
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        for _ in self._threads:
+            self.inbox.put(_STOP)
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+        self.finished_at = time.perf_counter()
+
+    def stats(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "elapsed_seconds": round(elapsed, 3),
+            "items_per_second": round(self.processed / elapsed, 3) if elapsed > 0 else 0.0,
+        }
+
+    def _work(self) -> None:
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                return
+
+            started = time.perf_counter()
+            try:
+                result = self.func(item)
+            except Exception as exc:
+                result = None
+                with self._lock:
+                    self.failed += 1
+                logger.exception("Этап %s: ошибка обработки %s: %s", self.name, item, exc)
+            else:
+                with self._lock:
+                    self.processed += 1
+            finally:
+                with self._lock:
+                    self.busy_seconds += time.perf_counter() - started
+
+            if result is not None and self.next is not None:
+                self.next.inbox.put(result)
+
+
+class Pipeline:
+    """Последовательность этапов, связанных ограниченными очередями."""
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        for current, following in zip(stages, stages[1:]):
+            current.next = following
+
+    def run(self, items: Iterable[Any]) -> Dict[str, Dict[str, Any]]:
+        for stage in self.stages:
+            stage.start()
+
+        first = self.stages[0]
+        for item in items:
+            # put блокируется при заполненной очереди, так что быстрый этап не уходит далеко вперёд
+            first.inbox.put(item)
+
+        for stage in self.stages:
+            stage.stop()
+            stage.join()
+
+        report = {stage.name: stage.stats() for stage in self.stages}
+        for name, stats in report.items():
+            logger.info(
+                "Этап %s: обработано %s, ошибок %s, %.2f шт/с (потоков %s, занятость %.1f с)",
+                name,
+                stats["processed"],
+                stats["failed"],
+                stats["items_per_second"],
+                stats["workers"],
+                stats["busy_seconds"],
+            )
+        return report
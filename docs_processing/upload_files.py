@@ -2,18 +2,28 @@ from __future__ import annotations
 
 import dataclasses
 import datetime as dt
+import hashlib
 import io
 import logging
+import multiprocessing
 import os
+import signal
+import threading
 import time
-from collections import defaultdict
-from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 
 import pdfplumber
 import pyexcel as pe
 import requests
 
+from db.chunk_store import ChunkStore
 from db.postgres import DataManager
+from docs_processing.embedding_push import embedding_pusher
+from docs_processing.pipeline import Pipeline, Stage
 
 logger = logging.getLogger(__name__)
 
@@ -25,18 +35,24 @@ DEFAULT_HEADERS = {
     "Referer": "https://apicr.minzdrav.gov.ru/",
 }
 
-EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8000/embed")
-EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
-EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "12"))
-
 CHUNK_SIZE = int(os.getenv("PDF_CHUNK_SIZE", "900"))
 CHUNK_OVERLAP = int(os.getenv("PDF_CHUNK_OVERLAP", "200"))
 MIN_CHUNK_LENGTH = int(os.getenv("PDF_MIN_CHUNK_LENGTH", "120"))
 
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+PDF_SHARD_PAGES = int(os.getenv("PDF_SHARD_PAGES", "20"))
+PDF_PAGE_TIMEOUT = float(os.getenv("PDF_PAGE_TIMEOUT", "30"))
+
 REQUEST_TIMEOUT = int(os.getenv("MINZDRAV_REQUEST_TIMEOUT", "60"))
 MAX_RETRIES = int(os.getenv("MINZDRAV_MAX_RETRIES", "3"))
 RETRY_DELAY = int(os.getenv("MINZDRAV_RETRY_DELAY", "3"))
 
+SYNC_QUEUE_SIZE = int(os.getenv("SYNC_QUEUE_SIZE", "8"))
+SYNC_DOWNLOAD_WORKERS = int(os.getenv("SYNC_DOWNLOAD_WORKERS", "4"))
+SYNC_STORE_WORKERS = int(os.getenv("SYNC_STORE_WORKERS", "2"))
+SYNC_EXTRACT_WORKERS = int(os.getenv("SYNC_EXTRACT_WORKERS", "2"))
+SYNC_EMBED_WORKERS = int(os.getenv("SYNC_EMBED_WORKERS", "2"))
+
 
 @dataclasses.dataclass
 class ClinicalDocument:
@@ -56,6 +72,20 @@ class ClinicalDocument:
         return self.raw_id
 
 
+@dataclasses.dataclass
+class SyncItem:
+    doc: ClinicalDocument
+    position: str
+    pdf_bytes: Optional[bytes] = None
+    sha256: Optional[str] = None
+    # PDF совпадает с уже сохранённым в БД, повторно сохранять не нужно
+    stored: bool = False
+    chunks: Optional[List[Dict]] = None
+
+    def __str__(self) -> str:
+        return f"документа {self.doc.raw_id}"
+
+
 class MinzdravClient:
     FILTER_PAYLOAD = {"filter": {"status": [1], "search": "", "year": "", "specialties": []}}
 
@@ -192,15 +222,47 @@ def _chunk_text(text: str) -> Iterator[str]:
         start = max(end - overlap, start + 1)
 
 
-def _extract_chunks(pdf_data: bytes) -> List[Dict]:
+class PageTimeoutError(Exception):
+    pass
+
+
+@contextmanager
+def _page_deadline(seconds: float) -> Iterator[None]:
+    # SIGALRM доступен только в главном потоке процесса; воркеры пула процессов выполняют задачи именно в нём.
+    # При PDF_EXTRACT_WORKERS <= 1 извлечение идёт в потоках конвейера, и ограничение времени не действует
+    if seconds <= 0 or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _on_alarm(signum, frame):
+        raise PageTimeoutError()
+
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _extract_page_range(pdf_data: bytes, first_page: int, last_page: int, page_timeout: float) -> List[Dict]:
+    """Чанки страниц first_page..last_page (нумерация с 1, включительно)."""
     chunks: List[Dict] = []
     with pdfplumber.open(io.BytesIO(pdf_data)) as pdf:
-        for page_number, page in enumerate(pdf.pages, start=1):
+        for page_number in range(first_page, last_page + 1):
+            page = pdf.pages[page_number - 1]
             try:
-                raw_text = page.extract_text() or ""
+                with _page_deadline(page_timeout):
+                    raw_text = page.extract_text() or ""
+            except PageTimeoutError:
+                logger.warning("Превышено время извлечения текста со страницы %s", page_number)
+                continue
             except Exception as exc:
                 logger.warning("Не удалось извлечь текст со страницы %s: %s", page_number, exc)
                 continue
+            finally:
+                page.close()
 
             normalized = _normalize_text(raw_text)
             if len(normalized) < MIN_CHUNK_LENGTH:
@@ -217,6 +279,81 @@ def _extract_chunks(pdf_data: bytes) -> List[Dict]:
     return chunks
 
 
+_extract_executor: Optional[ProcessPoolExecutor] = None
+_extract_executor_lock = threading.Lock()
+
+
+def _get_extract_executor() -> Optional[ProcessPoolExecutor]:
+    global _extract_executor
+    if PDF_EXTRACT_WORKERS <= 1:
+        return None
+    with _extract_executor_lock:
+        if _extract_executor is None:
+            # spawn вместо fork: извлечение вызывается из потоков конвейера синхронизации
+            _extract_executor = ProcessPoolExecutor(
+                max_workers=PDF_EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _extract_executor
+
+
+def shutdown_extract_executor() -> None:
+    global _extract_executor
+    with _extract_executor_lock:
+        if _extract_executor is not None:
+            _extract_executor.shutdown(wait=True, cancel_futures=True)
+            _extract_executor = None
+
+
+def _reset_extract_executor(broken: ProcessPoolExecutor) -> None:
+    global _extract_executor
+    with _extract_executor_lock:
+        # пул мог уже пересоздать другой поток конвейера
+        if _extract_executor is broken:
+            _extract_executor = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_chunks(pdf_data: bytes) -> List[Dict]:
+    with pdfplumber.open(io.BytesIO(pdf_data)) as pdf:
+        page_count = len(pdf.pages)
+
+    executor = _get_extract_executor()
+    if executor is None:
+        return _extract_page_range(pdf_data, 1, page_count, PDF_PAGE_TIMEOUT)
+
+    try:
+        return _extract_shards(executor, pdf_data, page_count)
+    except BrokenProcessPool as exc:
+        # воркер аварийно завершился (нехватка памяти, сбой в C-коде), и пул больше не принимает задачи
+        logger.warning("Пул извлечения текста из PDF неработоспособен (%s), пул пересоздаётся", exc)
+        _reset_extract_executor(executor)
+
+    executor = _get_extract_executor()
+    try:
+        return _extract_shards(executor, pdf_data, page_count)
+    except BrokenProcessPool:
+        # документ, повторно роняющий воркер, не должен оставить сломанный пул следующим документам
+        _reset_extract_executor(executor)
+        raise
+
+
+def _extract_shards(executor: ProcessPoolExecutor, pdf_data: bytes, page_count: int) -> List[Dict]:
+    shard_size = max(1, PDF_SHARD_PAGES)
+    futures = [
+        executor.submit(
+            _extract_page_range, pdf_data, first_page, min(page_count, first_page + shard_size - 1), PDF_PAGE_TIMEOUT
+        )
+        for first_page in range(1, page_count + 1, shard_size)
+    ]
+
+    # шарды идут подряд по страницам, поэтому порядок чанков совпадает с последовательным извлечением
+    chunks: List[Dict] = []
+    for future in futures:
+        chunks.extend(future.result())
+    return chunks
+
+
 def _prepare_metadata(doc: ClinicalDocument, chunk: Dict) -> Dict:
     page = chunk["page"]
     chunk_index = chunk["chunk_index"]
@@ -243,31 +380,100 @@ def _prepare_metadata(doc: ClinicalDocument, chunk: Dict) -> Dict:
     return metadata
 
 
-def _batched(items: List[Dict], batch_size: int) -> Iterator[List[Dict]]:
-    for index in range(0, len(items), batch_size):
-        yield items[index : index + batch_size]
+def _chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _sync_chunks(chunks: List[Dict], doc: ClinicalDocument, chunk_store: ChunkStore,
+                 progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+    """Приводит фрагменты документа в векторной БД к новой версии, вычисляя эмбеддинги только для нового текста.
+
+    Фрагменты сопоставляются по SHA-256 текста среди всех версий документа (один base_id):
+    совпавшие остаются в БД, у них обновляются метаданные, несовпавшие удаляются, в том числе
+    фрагменты старых версий. Новые фрагменты записываются раньше удаления старых, чтобы поиск
+    не оставался без документа; при сбое повторный запуск переиспользует уже записанные.
 
+    Запись в embedding-service не идемпотентна, поэтому если пакет пришлось повторить после
+    сбоя, при котором сервис мог его уже сохранить, фрагменты перечитываются и лишние копии
+    одного текста удаляются вместе с устаревшими.
+    """
+    available: Dict[str, List[Tuple[str, Dict]]] = defaultdict(list)
+    for chunk_id, content_hash, metadata in chunk_store.existing_chunks(doc.base_id):
+        available[content_hash].append((chunk_id, metadata))
 
-def _push_embeddings(chunks: List[Dict], doc: ClinicalDocument) -> None:
+    to_embed: List[Dict] = []
+    updates: List[Tuple[str, Dict]] = []
+    reused: List[str] = []
+    for chunk in chunks:
+        candidates = available.get(_chunk_hash(chunk["text"]))
+        if not candidates:
+            to_embed.append(chunk)
+            continue
+        chunk_id, metadata = candidates.pop()
+        reused.append(chunk_id)
+        new_metadata = _prepare_metadata(doc, chunk)
+        if metadata != new_metadata:
+            updates.append((chunk_id, new_metadata))
+
+    stale = [chunk_id for candidates in available.values() for chunk_id, _ in candidates]
+
+    if to_embed:
+        stats = _push_embeddings(to_embed, doc, progress=progress)
+        if stats and stats["unsafe_retries"]:
+            stale += _duplicate_chunks(chunks, doc, chunk_store, keep=set(reused), skip=set(stale))
+    chunk_store.apply(doc.base_id, updates, stale)
+
+    logger.info(
+        "Документ %s: новых фрагментов %s, без изменений %s, удалено %s",
+        doc.raw_id,
+        len(to_embed),
+        len(reused),
+        len(stale),
+    )
+    return {"embedded": len(to_embed), "reused": len(reused), "deleted": len(stale)}
+
+
+def _duplicate_chunks(chunks: List[Dict], doc: ClinicalDocument, chunk_store: ChunkStore,
+                      keep: Set[str], skip: Set[str]) -> List[str]:
+    """Id лишних копий фрагментов, сохранённых повторно при повторе пакета.
+
+    Каждого текста в БД остаётся столько копий, сколько раз он встречается в новой версии;
+    переиспользуемые фрагменты (keep) сохраняются в первую очередь, skip уже удаляются.
+    """
+    expected = Counter(_chunk_hash(chunk["text"]) for chunk in chunks)
+    stored: Dict[str, List[str]] = defaultdict(list)
+    for chunk_id, content_hash, _ in chunk_store.existing_chunks(doc.base_id):
+        if chunk_id not in skip:
+            stored[content_hash].append(chunk_id)
+
+    extra: List[str] = []
+    for content_hash, ids in stored.items():
+        ids.sort(key=lambda chunk_id: chunk_id not in keep)
+        extra += ids[expected[content_hash]:]
+    if extra:
+        logger.warning("Документ %s: удаляется %s дублей фрагментов после повтора пакетов", doc.raw_id, len(extra))
+    return extra
+
+
+def _push_embeddings(chunks: List[Dict], doc: ClinicalDocument,
+                     progress: Optional[Callable[[int, int], None]] = None) -> Optional[Dict]:
+    """Отправляет чанки в embedding-service; progress(отправлено, всего) вызывается после каждого пакета.
+
+    Возвращает статистику отправки, в том числе пропускную способность в чанках в секунду.
+    """
     if not chunks:
         logger.info("Документ %s пропущен: текст не найден", doc.base_id)
-        return
+        return None
 
     logger.info("Отправка %s чанков документа %s в embedding-service", len(chunks), doc.base_id)
-    for batch in _batched(chunks, EMBEDDING_BATCH_SIZE):
-        payload = {
-            "texts": [item["text"] for item in batch],
-            "metadata": [_prepare_metadata(doc, item) for item in batch],
-            "task": "retrieval.passage",
-            "dimensions": EMBEDDING_DIMENSIONS,
-        }
-        response = requests.post(EMBEDDING_SERVICE_URL, json=payload, timeout=REQUEST_TIMEOUT)
-        try:
-            response.raise_for_status()
-        except Exception as exc:
-            logger.error("Ошибка при сохранении эмбеддингов документа %s: %s", doc.base_id, exc)
-            raise
-        logger.debug("embedding-service ответ: %s", response.json())
+    return embedding_pusher.push(
+        [item["text"] for item in chunks],
+        [_prepare_metadata(doc, item) for item in chunks],
+        label=doc.raw_id,
+        progress=progress,
+        # возможные дубли удаляет _sync_chunks
+        retry_unsafe=True,
+    )
 
 
 def sync_minzdrav_documents(
@@ -275,15 +481,23 @@ def sync_minzdrav_documents(
     limit: Optional[int] = None,
     force_reload: bool = False,
     push_embeddings: bool = True,
-) -> None:
+) -> Dict[str, Dict]:
+    """Загружает новые и изменённые документы реестра.
+
+    Документ, уже сохранённый и полностью загруженный в векторную БД, пропускается без скачивания.
+    С force_reload скачиваются все документы, но сохранение и пересчёт фрагментов выполняются
+    только при изменении SHA-256 PDF.
+    """
     logging.basicConfig(level=logging.INFO)
     client = MinzdravClient()
     data_manager = DataManager()
+    chunk_store = ChunkStore() if push_embeddings else None
+
+    sync_state = data_manager.get_sync_state()
+    logger.info("В БД найдено %s документов", len(sync_state))
 
-    existing_ids = set()
-    if not force_reload:
-        existing_ids = data_manager.get_existing_document_ids()
-        logger.info("В БД найдено %s документов", len(existing_ids))
+    chunk_totals = {"embedded": 0, "reused": 0, "deleted": 0}
+    chunk_totals_lock = threading.Lock()
 
     documents = client.fetch_documents()
     if limit:
@@ -291,34 +505,93 @@ def sync_minzdrav_documents(
         logger.info("Ограничено к обработке %s документов", limit)
 
     total = len(documents)
-    for index, doc in enumerate(documents, start=1):
-        logger.info("Документ %s/%s: %s", index, total, doc.title)
 
-        if not force_reload and doc.storage_id in existing_ids:
-            logger.info("Документ %s уже есть в БД, пропуск", doc.raw_id)
-            continue
+    def is_synced(doc_id: str, sha256: Optional[str]) -> bool:
+        stored_sha256, embedded_sha256 = sync_state.get(doc_id, (None, None))
+        if stored_sha256 is None or (sha256 is not None and sha256 != stored_sha256):
+            return False
+        return not push_embeddings or embedded_sha256 == stored_sha256
 
-        try:
-            pdf_bytes = client.download_pdf(doc)
-            data_manager.save_document(
-                doc_id=doc.storage_id,
-                title=doc.title,
-                mcb=doc.mcb or "NULL",
-                age_category=doc.age_category or "Взрослые",
-                developer=doc.developer or "NULL",
-                placement_date=doc.publish_date or dt.date.today(),
-                data=pdf_bytes,
-            )
-            logger.info("Документ %s сохранён", doc.raw_id)
+    def pending_items() -> Iterator[SyncItem]:
+        for index, doc in enumerate(documents, start=1):
+            if not force_reload and is_synced(doc.storage_id, None):
+                logger.info("Документ %s уже есть в БД, пропуск", doc.raw_id)
+                continue
+            yield SyncItem(doc=doc, position=f"{index}/{total}")
+
+    def download(item: SyncItem) -> Optional[SyncItem]:
+        logger.info("Документ %s: %s", item.position, item.doc.title)
+        item.pdf_bytes = client.download_pdf(item.doc)
+        item.sha256 = hashlib.sha256(item.pdf_bytes).hexdigest()
+        if is_synced(item.doc.storage_id, item.sha256):
+            logger.info("Документ %s не изменился, пропуск", item.doc.raw_id)
+            return None
+        item.stored = sync_state.get(item.doc.storage_id, (None, None))[0] == item.sha256
+        return item
+
+    def store(item: SyncItem) -> Optional[SyncItem]:
+        doc = item.doc
+        if item.stored:
+            # PDF уже в БД, но его фрагменты не были загружены до конца
+            return item if push_embeddings else None
+        data_manager.save_document(
+            doc_id=doc.storage_id,
+            title=doc.title,
+            mcb=doc.mcb or "NULL",
+            age_category=doc.age_category or "Взрослые",
+            developer=doc.developer or "NULL",
+            placement_date=doc.publish_date or dt.date.today(),
+            data=item.pdf_bytes,
+        )
+        logger.info("Документ %s сохранён", doc.raw_id)
+        return item if push_embeddings else None
+
+    def extract(item: SyncItem) -> SyncItem:
+        item.chunks = _extract_chunks(item.pdf_bytes)
+        item.pdf_bytes = None
+        return item
+
+    def embed(item: SyncItem) -> None:
+        if not item.chunks:
+            # пустой результат скорее говорит о сбое извлечения, чем о документе без текста:
+            # фрагменты прежней версии остаются в поиске, а неизменённый PDF больше не скачивается
+            logger.info("Документ %s пропущен: текст не найден", item.doc.base_id)
+            data_manager.mark_embedded(item.doc.storage_id, item.sha256, has_text=False)
+            return
+        counts = _sync_chunks(item.chunks, item.doc, chunk_store)
+        data_manager.mark_embedded(item.doc.storage_id, item.sha256)
+        with chunk_totals_lock:
+            for key, value in counts.items():
+                chunk_totals[key] += value
+
+    stages = [
+        Stage("download", download, workers=SYNC_DOWNLOAD_WORKERS, queue_size=SYNC_QUEUE_SIZE),
+        Stage("store", store, workers=SYNC_STORE_WORKERS, queue_size=SYNC_QUEUE_SIZE),
+    ]
+    if push_embeddings:
+        stages += [
+            Stage("extract", extract, workers=SYNC_EXTRACT_WORKERS, queue_size=SYNC_QUEUE_SIZE),
+            Stage("embed", embed, workers=SYNC_EMBED_WORKERS, queue_size=SYNC_QUEUE_SIZE),
+        ]
 
-            if push_embeddings:
-                chunks = _extract_chunks(pdf_bytes)
-                _push_embeddings(chunks, doc)
-        except Exception as exc:
-            logger.exception("Ошибка обработки документа %s: %s", doc.raw_id, exc)
-            continue
+    try:
+        report = Pipeline(stages).run(pending_items())
+        if push_embeddings:
+            report["chunks"] = chunk_totals
+            logger.info(
+                "Фрагменты: вычислено эмбеддингов %s, переиспользовано %s, удалено %s",
+                chunk_totals["embedded"],
+                chunk_totals["reused"],
+                chunk_totals["deleted"],
+            )
+        return report
+    finally:
+        shutdown_extract_executor()
+        embedding_pusher.close()
+        if chunk_store is not None:
+            chunk_store.close()
+        data_manager.close()
 
 
 if __name__ == "__main__":
     sync_minzdrav_documents()
-
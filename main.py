@@ -1,7 +1,16 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware # Yulia added this thing
 from api.router_socket import socket_router
 from api.router_page import page_router
+from db.vector_db import vector_pool
+from docs_processing.embedding_push import embedding_pusher
+from services.answer_cache import answer_cache
+from services.chat_service import session_manager
+from services.document_service import DocumentService
+from services.http_clients import http_clients
+from services.ingestion_jobs import ingestion_jobs
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -9,7 +18,29 @@ logger = logging.getLogger(__name__)
 
 origins = ["*"] # Yulia added this thing
 
-app = FastAPI(title="Medical Support")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        await vector_pool.open()
+    except Exception as exc:
+        # чат попробует открыть пул повторно при первом запросе
+        logger.warning("Не удалось создать пул векторной БД при старте: %s", exc)
+    http_clients.open()
+    await answer_cache.start()
+    await ingestion_jobs.start()
+    await session_manager.start()
+    yield
+    await session_manager.stop()
+    await ingestion_jobs.stop()
+    await answer_cache.stop()
+    await http_clients.close()
+    await vector_pool.close()
+    DocumentService.close()
+    embedding_pusher.close()
+
+
+app = FastAPI(title="Medical Support", lifespan=lifespan)
 app.include_router(socket_router)
 app.include_router(page_router)
 
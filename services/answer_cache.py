@@ -0,0 +1,221 @@
+import asyncio
+import itertools
+import logging
+import math
+import operator
+import os
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import asyncpg
+
+from db.postgres import DOCUMENTS_CHANNEL, DataConnection
+
+logger = logging.getLogger(__name__)
+
+
+class _CachedAnswer:
+    __slots__ = ("vector", "answer", "doc_ids", "stored_at")
+
+    def __init__(self, vector: array, answer: str, doc_ids: Set[str], stored_at: float):
+        self.vector = vector
+        self.answer = answer
+        self.doc_ids = doc_ids
+        self.stored_at = stored_at
+
+
+def _base_id(doc_id: str) -> str:
+    return doc_id.split("_", maxsplit=1)[0]
+
+
+def _normalize(embedding: List[float]) -> Optional[array]:
+    norm = math.sqrt(sum(x * x for x in embedding))
+    if not norm:
+        return None
+    return array("d", (x / norm for x in embedding))
+
+
+def _best_match(vector: array, candidates: List[Tuple[int, array]], threshold: float,
+                budget: float) -> Tuple[Optional[int], float, bool]:
+    """Самая близкая запись не ниже порога; при budget > 0 просмотр прекращается через budget секунд.
+
+    Возвращает ключ записи (или None), близость и признак того, что просмотрены не все записи.
+    """
+    deadline = time.perf_counter() + budget
+    best_key, best_score = None, threshold
+    for scanned, (key, candidate) in enumerate(candidates, start=1):
+        score = sum(map(operator.mul, candidate, vector))
+        if score >= best_score:
+            best_key, best_score = key, score
+        if budget > 0 and scanned % 16 == 0 and scanned < len(candidates) and time.perf_counter() > deadline:
+            return best_key, best_score, True
+    return best_key, best_score, False
+
+
+class AnswerCache:
+    """Семантический кэш итоговых ответов.
+
+    Ответ переиспользуется, если косинусная близость эмбеддинга нового запроса к эмбеддингу
+    закэшированного не ниже порога. Записи, ссылающиеся на изменённые документы, удаляются
+    по уведомлениям PostgreSQL из канала documents_changed, которые отправляет DataManager.
+
+    Поиск ближайшей записи выполняется в пуле потоков, чтобы не блокировать event loop, и
+    ограничен ANSWER_CACHE_SCAN_BUDGET_MS: записи просматриваются от недавно использованных
+    к старым, и по истечении бюджета оставшиеся пропускаются.
+    """
+
+    def __init__(self):
+        self.max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256"))
+        self.threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+        self.ttl = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        self.reconnect_delay = float(os.getenv("ANSWER_CACHE_LISTEN_RETRY", "5"))
+        self.scan_budget = float(os.getenv("ANSWER_CACHE_SCAN_BUDGET_MS", "5")) / 1000
+
+        self._entries: "OrderedDict[int, _CachedAnswer]" = OrderedDict()
+        self._ids = itertools.count()
+        self._listener_task: Optional[asyncio.Task] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.truncated_scans = 0
+
+    async def start(self) -> None:
+        if self.max_entries > 0 and self._listener_task is None:
+            self._listener_task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener_task is not None:
+            self._listener_task.cancel()
+            try:
+                await self._listener_task
+            except asyncio.CancelledError:
+                pass
+            self._listener_task = None
+
+    async def lookup(self, embedding: List[float]) -> Optional[str]:
+        if self.max_entries <= 0 or not self._entries:
+            self.misses += 1
+            return None
+
+        vector = _normalize(embedding)
+        if vector is None:
+            self.misses += 1
+            return None
+
+        now = time.monotonic()
+        expired: List[int] = []
+        candidates: List[Tuple[int, array]] = []
+        for key, entry in reversed(self._entries.items()):
+            if now - entry.stored_at > self.ttl:
+                expired.append(key)
+            elif len(entry.vector) == len(vector):
+                candidates.append((key, entry.vector))
+        for key in expired:
+            del self._entries[key]
+        if not candidates:
+            self.misses += 1
+            return None
+
+        best_key, best_score, truncated = await asyncio.get_running_loop().run_in_executor(
+            None, _best_match, vector, candidates, self.threshold, self.scan_budget
+        )
+        if truncated:
+            self.truncated_scans += 1
+
+        # пока шёл поиск, запись могли удалить по уведомлению об изменении документа
+        entry = self._entries.get(best_key) if best_key is not None else None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(best_key)
+        self.hits += 1
+        logger.info("Ответ найден в семантическом кэше (близость %.4f)", best_score)
+        return entry.answer
+
+    def store(self, embedding: List[float], answer: str, doc_ids: Iterable[Optional[str]]) -> None:
+        if self.max_entries <= 0:
+            return
+
+        vector = _normalize(embedding)
+        if vector is None:
+            return
+
+        ids: Set[str] = set()
+        for doc_id in doc_ids:
+            if doc_id:
+                ids.add(doc_id)
+                ids.add(_base_id(doc_id))
+
+        self._entries[next(self._ids)] = _CachedAnswer(vector, answer, ids, time.monotonic())
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_documents(self, doc_ids: Iterable[str]) -> int:
+        targets: Set[str] = set()
+        for doc_id in doc_ids:
+            targets.add(doc_id)
+            targets.add(_base_id(doc_id))
+
+        stale = [key for key, entry in self._entries.items() if entry.doc_ids & targets]
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            self.invalidations += len(stale)
+            logger.info("Из кэша ответов удалено %s записей по изменённым документам", len(stale))
+        return len(stale)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "truncated_scans": self.truncated_scans,
+            "listening": self._listener_task is not None and not self._listener_task.done(),
+        }
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        self.invalidate_documents([payload])
+
+    async def _listen(self) -> None:
+        config = DataConnection()
+        while True:
+            conn: Optional[asyncpg.Connection] = None
+            try:
+                conn = await asyncpg.connect(
+                    host=config.host,
+                    port=int(config.port),
+                    database=config.dbname,
+                    user=config.user,
+                    password=config.password,
+                )
+                terminated = asyncio.Event()
+                conn.add_termination_listener(lambda _: terminated.set())
+                await conn.add_listener(DOCUMENTS_CHANNEL, self._on_notification)
+                logger.info("Кэш ответов подписан на изменения документов")
+                await terminated.wait()
+                logger.warning("Соединение для уведомлений об изменении документов потеряно")
+            except asyncio.CancelledError:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+                raise
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+                logger.warning("Не удалось подписаться на изменения документов: %s", exc)
+
+            # пока подписки нет, уведомления могли быть пропущены
+            self.clear()
+            await asyncio.sleep(self.reconnect_delay)
+
+
+answer_cache = AnswerCache()
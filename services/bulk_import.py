@@ -0,0 +1,220 @@
+import csv
+import dataclasses
+import datetime as dt
+import io
+import logging
+import os
+import threading
+import zipfile
+from pathlib import PurePosixPath
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pyexcel as pe
+
+from db.postgres import AGE_CATEGORIES, DataManager
+from services.document_service import data_base
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "50"))
+IMPORT_BATCH_BYTES = int(float(os.getenv("IMPORT_BATCH_MB", "64")) * 1024 * 1024)
+IMPORT_MAX_FILE_BYTES = int(float(os.getenv("IMPORT_MAX_FILE_MB", "100")) * 1024 * 1024)
+
+MANIFEST_COLUMNS = ("file", "doc_id", "title", "mcb", "age_category", "developer", "placement_date")
+
+
+@dataclasses.dataclass
+class ImportEntry:
+    file: str
+    doc_id: str
+    title: str
+    mcb: str
+    age_category: str
+    developer: str
+    placement_date: dt.date
+    data: bytes = dataclasses.field(repr=False, default=b"")
+
+
+def read_manifest(filename: str, content: bytes) -> Dict[str, Dict[str, str]]:
+    """Строки манифеста (CSV или XLSX) по имени файла; колонки – MANIFEST_COLUMNS."""
+    if filename.lower().endswith(".xlsx"):
+        records = pe.get_records(file_content=content, file_type="xlsx")
+    else:
+        try:
+            text = content.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            # CSV, сохранённый из Excel с русской локалью
+            text = content.decode("cp1251")
+        try:
+            dialect = csv.Sniffer().sniff(text.split("\n", 1)[0], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        records = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+
+    manifest: Dict[str, Dict[str, str]] = {}
+    for record in records:
+        row = {str(key).strip().lower(): value for key, value in record.items() if key}
+        name = str(row.get("file") or "").strip()
+        if name:
+            manifest[PurePosixPath(name).name] = {
+                column: (value.isoformat() if isinstance(value, (dt.date, dt.datetime)) else str(value).strip())
+                for column, value in row.items()
+                if column in MANIFEST_COLUMNS and value not in (None, "")
+            }
+    return manifest
+
+
+def archive_entries(archive: IO[bytes]) -> Iterator[Tuple[str, int, Callable[[], bytes]]]:
+    """Файлы ZIP-архива по одному: архив читается с диска через seek, а не загружается в память целиком."""
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            yield info.filename, info.file_size, lambda info=info: _read_limited(zf.open(info))
+
+
+def upload_entries(files: List[Any]) -> Iterator[Tuple[str, int, Callable[[], bytes]]]:
+    for upload in files:
+        upload.file.seek(0, os.SEEK_END)
+        size = upload.file.tell()
+        upload.file.seek(0)
+        yield upload.filename or "", size, lambda upload=upload: _read_limited(upload.file)
+
+
+def _read_limited(stream: IO[bytes]) -> bytes:
+    with stream:
+        data = stream.read(IMPORT_MAX_FILE_BYTES + 1)
+    if len(data) > IMPORT_MAX_FILE_BYTES:
+        raise ValueError("Файл превышает допустимый размер")
+    return data
+
+
+def _build_entry(name: str, meta: Dict[str, str]) -> ImportEntry:
+    stem = PurePosixPath(name).stem
+    doc_id = meta.get("doc_id", stem)
+    if not doc_id or len(doc_id) > 10:
+        raise ValueError("doc_id должен содержать от 1 до 10 символов")
+    title = meta.get("title", stem)
+    if len(title) > 400:
+        raise ValueError("Название длиннее 400 символов")
+    age_category = meta.get("age_category", "Взрослые")
+    if age_category not in AGE_CATEGORIES:
+        raise ValueError(f"Недопустимая возрастная категория: {age_category}")
+    placement_date = meta.get("placement_date")
+    try:
+        parsed_date = dt.date.fromisoformat(placement_date[:10]) if placement_date else dt.date.today()
+    except ValueError:
+        raise ValueError(f"Некорректная дата размещения: {placement_date}")
+    return ImportEntry(
+        file=name,
+        doc_id=doc_id,
+        title=title,
+        mcb=meta.get("mcb", "NULL"),
+        age_category=age_category,
+        developer=meta.get("developer", "NULL"),
+        placement_date=parsed_date,
+    )
+
+
+class BulkImporter:
+    """Массовая загрузка PDF пакетными upsert-запросами через upload_list и execute_values."""
+
+    def __init__(self, data_manager: Optional[DataManager] = None):
+        # по умолчанию DataManager и пул соединений DocumentService, чтобы их число не превышало DB_POOL_MAX_SIZE
+        self.data_manager = data_manager or data_base
+        # upload_list общий для экземпляра DataManager; кроме импорта его никто не использует
+        self._lock = threading.Lock()
+
+    def import_entries(self, entries: Iterator[Tuple[str, int, Callable[[], bytes]]],
+                       manifest: Optional[Dict[str, Dict[str, str]]] = None,
+                       on_imported: Optional[Callable[[ImportEntry], Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """Сохраняет PDF пакетами. on_imported вызывается для каждого сохранённого документа,
+        его результат (например, задание индексации) добавляется в сведения о файле."""
+        manifest = manifest or {}
+        results: List[Dict[str, Any]] = []
+        batch: List[Tuple[ImportEntry, Dict[str, Any]]] = []
+        batch_bytes = 0
+        seen_ids: Dict[str, str] = {}
+
+        for name, size, read in entries:
+            result: Dict[str, Any] = {"file": name, "doc_id": None, "status": "failed", "error": None}
+            results.append(result)
+            base_name = PurePosixPath(name).name
+            if not base_name.lower().endswith(".pdf"):
+                result.update(status="skipped", error="Не PDF-файл")
+                continue
+
+            try:
+                entry = _build_entry(name, manifest.get(base_name, {}))
+                result["doc_id"] = entry.doc_id
+                if entry.doc_id in seen_ids:
+                    raise ValueError(f"doc_id уже встречался в файле {seen_ids[entry.doc_id]}")
+                if size > IMPORT_MAX_FILE_BYTES:
+                    raise ValueError("Файл превышает допустимый размер")
+                entry.data = read()
+            except (ValueError, zipfile.BadZipFile, OSError) as exc:
+                result["error"] = str(exc)
+                continue
+
+            seen_ids[entry.doc_id] = name
+            batch.append((entry, result))
+            batch_bytes += len(entry.data)
+            if len(batch) >= IMPORT_BATCH_SIZE or batch_bytes >= IMPORT_BATCH_BYTES:
+                self._flush(batch, on_imported)
+                batch, batch_bytes = [], 0
+
+        if batch:
+            self._flush(batch, on_imported)
+
+        summary = {status: 0 for status in ("imported", "failed", "skipped")}
+        for result in results:
+            summary[result["status"]] += 1
+        summary["indexing_queued"] = sum(1 for result in results if result.get("indexing") == "queued")
+        logger.info(
+            "Массовая загрузка: загружено %s, с ошибками %s, пропущено %s, поставлено на индексацию %s",
+            summary["imported"],
+            summary["failed"],
+            summary["skipped"],
+            summary["indexing_queued"],
+        )
+        return {"summary": summary, "files": results}
+
+    def _flush(self, batch: List[Tuple[ImportEntry, Dict[str, Any]]],
+               on_imported: Optional[Callable[[ImportEntry], Dict[str, Any]]] = None) -> None:
+        try:
+            self._upsert([entry for entry, _ in batch])
+        except Exception:
+            # один некорректный документ не должен отменять весь пакет: повторяем поштучно
+            for entry, result in batch:
+                try:
+                    self._upsert([entry])
+                except Exception as exc:
+                    result["error"] = str(exc)
+                else:
+                    result["status"] = "imported"
+        else:
+            for _, result in batch:
+                result["status"] = "imported"
+
+        for entry, result in batch:
+            if result["status"] == "imported":
+                # без нарезки и эмбеддингов документ есть в списке, но не участвует в поиске
+                result["indexing"] = "not_indexed"
+                if on_imported is not None:
+                    result.update(on_imported(entry))
+
+    def _upsert(self, entries: List[ImportEntry]) -> None:
+        with self._lock:
+            self.data_manager.upload_list = []
+            try:
+                for entry in entries:
+                    self.data_manager.add_to_upload_list(
+                        entry.doc_id, entry.title, entry.mcb, entry.age_category, entry.developer,
+                        placement_date=entry.placement_date, data=entry.data,
+                    )
+                self.data_manager.upload_data(upsert=True)
+            finally:
+                self.data_manager.upload_list = []
+
+
+bulk_importer = BulkImporter()
@@ -0,0 +1,263 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import asyncpg
+
+from db.postgres import DataConnection
+
+logger = logging.getLogger(__name__)
+
+# ключ сообщения – время создания и UUID, присвоенные при создании: номера, которые каждый воркер
+# вёл бы сам, расходятся при переподключении к другому воркеру, пока история ещё не записана
+CREATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+        message_id UUID PRIMARY KEY,
+        session_id UUID NOT NULL,
+        role VARCHAR(16) NOT NULL,
+        content TEXT NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_chat_messages_session ON chat_messages (session_id, created_at, message_id);
+"""
+
+# один INSERT на пакет; конфликт возможен только при повторе уже записанного пакета
+INSERT_QUERY = """
+    WITH inserted AS (
+        INSERT INTO chat_messages (message_id, session_id, role, content, created_at)
+        SELECT * FROM unnest($1::uuid[], $2::uuid[], $3::varchar[], $4::text[], $5::timestamptz[])
+        ON CONFLICT (message_id) DO NOTHING
+        RETURNING 1
+    )
+    SELECT count(*) FROM inserted;
+"""
+
+EXISTS_QUERY = "SELECT EXISTS (SELECT 1 FROM chat_messages WHERE session_id = $1::uuid)"
+
+PAGE_QUERY = """
+    SELECT message_id::text, role, content, created_at
+    FROM chat_messages
+    WHERE session_id = $1::uuid AND (created_at, message_id) < ($2::timestamptz, $3::uuid)
+    ORDER BY created_at DESC, message_id DESC
+    LIMIT $4;
+"""
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+MICROSECOND = dt.timedelta(microseconds=1)
+# курсор «после всех сообщений»
+MAX_CURSOR = (2 ** 62, "ffffffff-ffff-ffff-ffff-ffffffffffff")
+
+# (message_id, role, content, created_at – микросекунды unix time)
+HistoryRecord = Tuple[str, str, str, int]
+
+
+def _timestamp(micros: int) -> dt.datetime:
+    return EPOCH + dt.timedelta(microseconds=micros)
+
+
+class ChatHistoryBackend:
+    """Хранилище истории чата. Базовая реализация ничего не сохраняет: история живёт только в памяти."""
+
+    persistent = False
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def append(self, session_id: str, record: HistoryRecord) -> None:
+        pass
+
+    async def exists(self, session_id: str) -> bool:
+        return False
+
+    async def load(self, session_id: str, before: Tuple[int, str], limit: int) -> List[HistoryRecord]:
+        """Не больше limit сообщений с ключом (created_at, message_id) меньше before, по возрастанию."""
+        return []
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory"}
+
+
+class PostgresChatHistory(ChatHistoryBackend):
+    """История чата в таблице chat_messages основной БД с отложенной пакетной записью.
+
+    append только ставит сообщение в очередь, фоновая задача записывает накопленное одним
+    запросом раз в CHAT_HISTORY_FLUSH_INTERVAL или по набору CHAT_HISTORY_BATCH_SIZE сообщений.
+    При недоступности БД пакет повторяется, а при переполнении очереди новые сообщения
+    не сохраняются (в памяти процесса они остаются).
+    """
+
+    persistent = True
+
+    def __init__(self):
+        self.batch_size = int(os.getenv("CHAT_HISTORY_BATCH_SIZE", "200"))
+        self.flush_interval = float(os.getenv("CHAT_HISTORY_FLUSH_INTERVAL", "1"))
+        self.queue_size = int(os.getenv("CHAT_HISTORY_QUEUE_SIZE", "10000"))
+        self.retry_delay = float(os.getenv("CHAT_HISTORY_RETRY_DELAY", "5"))
+        self.pool_size = int(os.getenv("CHAT_HISTORY_POOL_SIZE", "4"))
+
+        self._queue: Optional[asyncio.Queue] = None
+        # пакет, который собирает или записывает фоновая задача: при остановке он не должен потеряться
+        self._batch: List[Tuple[str, str, str, str, int]] = []
+        # сессии с ещё не записанными сообщениями: такая сессия существует, хотя в таблице её пока нет
+        self._unwritten: Dict[str, int] = {}
+        self._writer: Optional[asyncio.Task] = None
+        self._pool: Optional[asyncpg.Pool] = None
+        self._pool_lock = asyncio.Lock()
+        self._schema_ready = False
+
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.failures = 0
+
+    async def start(self) -> None:
+        if self._writer is None:
+            self._queue = asyncio.Queue(maxsize=max(1, self.queue_size))
+            self._writer = asyncio.create_task(self._write_loop())
+
+    async def stop(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        batch, self._batch = self._batch, []
+        if self._queue is not None:
+            batch += [self._queue.get_nowait() for _ in range(self._queue.qsize())]
+        if batch:
+            # последняя попытка записать то, что осталось в очереди
+            try:
+                await self._write(batch)
+            except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+                logger.error("При остановке не сохранено %s сообщений чата: %s", len(batch), exc)
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    def append(self, session_id: str, record: HistoryRecord) -> None:
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait((session_id, *record))
+            self._unwritten[session_id] = self._unwritten.get(session_id, 0) + 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Очередь записи истории чата заполнена, не сохранено сообщений: %s", self.dropped)
+
+    async def exists(self, session_id: str) -> bool:
+        if self._unwritten.get(session_id):
+            return True
+        try:
+            async with self._acquire() as conn:
+                return await conn.fetchval(EXISTS_QUERY, session_id)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+            logger.warning("Не удалось проверить сессию чата %s: %s", session_id, exc)
+            return False
+
+    async def load(self, session_id: str, before: Tuple[int, str], limit: int) -> List[HistoryRecord]:
+        try:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(PAGE_QUERY, session_id, _timestamp(before[0]), before[1], limit)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+            logger.warning("Не удалось загрузить историю сессии чата %s: %s", session_id, exc)
+            return []
+        return [
+            (row["message_id"], row["role"], row["content"], (row["created_at"] - EPOCH) // MICROSECOND)
+            for row in reversed(rows)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "postgres",
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        async with self._pool_lock:
+            if self._pool is None:
+                config = DataConnection()
+                self._pool = await asyncpg.create_pool(
+                    host=config.host,
+                    port=int(config.port),
+                    database=config.dbname,
+                    user=config.user,
+                    password=config.password,
+                    min_size=1,
+                    max_size=self.pool_size,
+                )
+        async with self._pool.acquire() as conn:
+            if not self._schema_ready:
+                await conn.execute(CREATE_TABLE_QUERY)
+                self._schema_ready = True
+            yield conn
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self._batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            while True:
+                try:
+                    await self._write(batch)
+                    self._batch = []
+                    break
+                except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+                    self.failures += 1
+                    logger.warning(
+                        "Не удалось сохранить %s сообщений чата: %s. Повтор через %s с",
+                        len(batch),
+                        exc,
+                        self.retry_delay,
+                    )
+                    await asyncio.sleep(self.retry_delay)
+
+    async def _write(self, batch: List[Tuple[str, str, str, str, int]]) -> None:
+        session_ids, message_ids, roles, contents, created_at = (list(column) for column in zip(*batch))
+        async with self._acquire() as conn:
+            inserted = await conn.fetchval(
+                INSERT_QUERY,
+                message_ids, session_ids, roles, contents, [_timestamp(value) for value in created_at],
+            )
+        if inserted < len(batch):
+            # ключи уникальны, поэтому пропущенные строки – уже записанные при прерванной попытке
+            logger.info("Из пакета истории чата %s сообщений уже были записаны", len(batch) - inserted)
+        for session_id in session_ids:
+            left = self._unwritten.get(session_id, 0) - 1
+            if left > 0:
+                self._unwritten[session_id] = left
+            else:
+                self._unwritten.pop(session_id, None)
+        self.written += len(batch)
+        self.batches += 1
+
+
+def create_history_backend() -> ChatHistoryBackend:
+    name = os.getenv("CHAT_HISTORY_BACKEND", "memory").lower()
+    if name == "postgres":
+        return PostgresChatHistory()
+    if name != "memory":
+        logger.warning("Неизвестное хранилище истории чата %s, история хранится только в памяти", name)
+    return ChatHistoryBackend()
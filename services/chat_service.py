@@ -1,38 +1,245 @@
-import uuid
+import asyncio
+import logging
+import os
+import sys
 import time
-from typing import Dict, List
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from services.chat_history import MAX_CURSOR, ChatHistoryBackend, create_history_backend
+
+logger = logging.getLogger(__name__)
+
+
+class ChatMessage:
+    __slots__ = ("id", "role", "content", "created_at")
+
+    def __init__(self, role: str, content: str, message_id: Optional[str] = None,
+                 created_at: Optional[int] = None):
+        self.id = message_id or str(uuid.uuid4())
+        self.role = role
+        self.content = content
+        # микросекунды unix time; вместе с id задаёт порядок сообщений и курсор истории
+        self.created_at = time.time_ns() // 1000 if created_at is None else created_at
+
+    @property
+    def key(self) -> Tuple[int, str]:
+        return self.created_at, self.id
+
+    @property
+    def size(self) -> int:
+        return sys.getsizeof(self) + sys.getsizeof(self.content)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "role": self.role,
+            "content": self.content,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.created_at / 1_000_000)),
+        }
+
+
+def encode_cursor(key: Tuple[int, str]) -> str:
+    return f"{key[0]}:{key[1]}"
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        created_at, message_id = cursor.split(":", 1)
+        return int(created_at), str(uuid.UUID(message_id))
+    except (AttributeError, ValueError):
+        raise ValueError("Некорректный курсор истории")
 
 
 class ChatSession:
-    def __init__(self):
-        self.messages: List[Dict] = []
+    __slots__ = ("messages", "last_seen", "size")
 
-    def add_message(self, role: str, content: str):
-        self.messages.append({
-            "role": role,
-            "content": content,
-            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-        })
+    def __init__(self, max_messages: int):
+        # последние сообщения сессии, полученные этим процессом
+        self.messages: Deque[ChatMessage] = deque(maxlen=max_messages or None)
+        self.last_seen = time.monotonic()
+        self.size = 0
 
-    def get_messages(self):
-        return self.messages.copy()
+    def add_message(self, role: str, content: str) -> Tuple[ChatMessage, int]:
+        """Добавляет сообщение; возвращает его и изменение занимаемой памяти в байтах."""
+        delta = 0
+        if self.messages.maxlen is not None and len(self.messages) == self.messages.maxlen:
+            delta -= self.messages.popleft().size
+        message = ChatMessage(role, content)
+        self.messages.append(message)
+        delta += message.size
+        self.size += delta
+        return message, delta
+
+    def get_messages(self, limit: int, before: Optional[Tuple[int, str]] = None) -> List[ChatMessage]:
+        """Не больше limit последних сообщений с ключом меньше before."""
+        page: List[ChatMessage] = []
+        for message in reversed(self.messages):
+            if len(page) >= limit:
+                break
+            if before is None or message.key < before:
+                page.append(message)
+        page.reverse()
+        return page
 
 
 class ChatSessionManager:
-    def __init__(self):
-        self.sessions: Dict[str, ChatSession] = {}
+    """Сессии чата в памяти процесса с ограничениями по времени простоя и памяти.
+
+    Сессия, к которой не обращались дольше CHAT_SESSION_TTL, удаляется фоновой задачей. При
+    превышении CHAT_MAX_MEMORY_MB вытесняются давно не использовавшиеся сессии, а в каждой
+    сессии хранится не больше CHAT_MAX_MESSAGES последних сообщений.
+
+    С постоянным хранилищем истории (CHAT_HISTORY_BACKEND) сообщения дописываются в него в фоне,
+    сессию можно продолжить после переподключения, перезапуска или на другом воркере, а более
+    старые сообщения подгружаются из хранилища постранично по запросу.
+    """
+
+    def __init__(self, backend: Optional[ChatHistoryBackend] = None):
+        self.ttl = float(os.getenv("CHAT_SESSION_TTL", "1800"))
+        self.max_messages = int(os.getenv("CHAT_MAX_MESSAGES", "200"))
+        self.max_bytes = int(float(os.getenv("CHAT_MAX_MEMORY_MB", "64")) * 1024 * 1024)
+        self.sweep_interval = float(os.getenv("CHAT_SWEEP_INTERVAL", "60"))
+        self.page_size = int(os.getenv("CHAT_HISTORY_PAGE_SIZE", "50"))
+        self.backend = backend or create_history_backend()
+
+        self.sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._bytes = 0
+        self._sweeper: Optional[asyncio.Task] = None
+
+        self.expired = 0
+        self.evicted = 0
+
+    async def start(self) -> None:
+        await self.backend.start()
+        if self._sweeper is None and self.ttl > 0:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            try:
+                await self._sweeper
+            except asyncio.CancelledError:
+                pass
+            self._sweeper = None
+        await self.backend.stop()
 
     def create_session(self) -> str:
         session_id = str(uuid.uuid4())
-        self.sessions[session_id] = ChatSession()
+        self.sessions[session_id] = ChatSession(self.max_messages)
         return session_id
 
-    def get_history(self, session_id: str) -> List[Dict]:
-        return self.sessions[session_id].get_messages() if session_id in self.sessions else []
+    async def open_session(self, session_id: Optional[str] = None) -> Tuple[str, bool]:
+        """Продолжает сессию session_id, если она известна, иначе создаёт новую.
+
+        Возвращает id сессии и признак того, что сессия продолжена. История продолженной сессии
+        не загружается целиком: страницы отдаёт get_history.
+        """
+        try:
+            session_id = str(uuid.UUID(session_id)) if session_id else None
+        except ValueError:
+            session_id = None
+
+        if session_id is not None:
+            if self._touch(session_id) is not None:
+                return session_id, True
+            if await self.backend.exists(session_id):
+                self.sessions[session_id] = ChatSession(self.max_messages)
+                return session_id, True
+        return self.create_session(), False
+
+    async def get_history(self, session_id: str, limit: Optional[int] = None,
+                          before: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Страница истории: не больше limit сообщений раньше курсора before (по умолчанию последние).
+
+        Возвращает сообщения по возрастанию времени и курсор следующей страницы
+        (None, если более старых сообщений нет).
+        """
+        session = self._touch(session_id)
+        if session is None:
+            return [], None
+
+        limit = max(1, min(limit or self.page_size, self.page_size))
+        key = decode_cursor(before) if before else None
+        # на одно больше, чтобы узнать, есть ли следующая страница
+        local = session.get_messages(limit + 1, key)
+        candidates: Dict[str, ChatMessage] = {message.id: message for message in local}
+        if self.backend.persistent:
+            # в памяти только сообщения, прошедшие через этот процесс; остальные – в хранилище.
+            # ещё не записанные сообщения этого процесса берутся из памяти, совпадающие – по id
+            stored = await self.backend.load(session_id, before=key or MAX_CURSOR, limit=limit + 1)
+            for message_id, role, content, created_at in stored:
+                if message_id not in candidates:
+                    candidates[message_id] = ChatMessage(role, content, message_id, created_at)
+
+        ordered = sorted(candidates.values(), key=lambda message: message.key)
+        page = ordered[-limit:]
+        next_before = encode_cursor(page[0].key) if len(ordered) > limit else None
+        return [message.to_dict() for message in page], next_before
 
     def add_message(self, session_id: str, role: str, content: str):
-        if session_id in self.sessions:
-            self.sessions[session_id].add_message(role, content)
+        session = self._touch(session_id)
+        if session is None:
+            # сессию открытого соединения могли вытеснить: история в хранилище при этом сохраняется
+            session = self.sessions[session_id] = ChatSession(self.max_messages)
+        message, delta = session.add_message(role, content)
+        self._bytes += delta
+        self.backend.append(session_id, (message.id, message.role, message.content, message.created_at))
+        self._evict(keep=session_id)
 
     def remove_session(self, session_id: str):
-        self.sessions.pop(session_id, None)
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.size
+
+    def sweep(self) -> int:
+        """Удаляет сессии, простаивающие дольше ttl; возвращает их число."""
+        deadline = time.monotonic() - self.ttl
+        expired = 0
+        # сессии упорядочены по последнему обращению, поэтому просроченные – в начале
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.last_seen > deadline:
+                break
+            self.remove_session(session_id)
+            expired += 1
+        self.expired += expired
+        return expired
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self.sessions),
+            "messages": sum(len(session.messages) for session in self.sessions.values()),
+            "memory_bytes": self._bytes,
+            "max_memory_bytes": self.max_bytes,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "history": self.backend.stats(),
+        }
+
+    def _touch(self, session_id: str) -> Optional[ChatSession]:
+        session = self.sessions.get(session_id)
+        if session is not None:
+            session.last_seen = time.monotonic()
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def _evict(self, keep: str) -> None:
+        while self._bytes > self.max_bytes and len(self.sessions) > 1:
+            session_id = next(iter(self.sessions))
+            if session_id == keep:
+                break
+            self.remove_session(session_id)
+            self.evicted += 1
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            expired = self.sweep()
+            if expired:
+                logger.info("Удалено %s неактивных сессий чата, осталось %s", expired, len(self.sessions))
+
+
+session_manager = ChatSessionManager()
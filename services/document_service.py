@@ -1,44 +1,210 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import anyio
 from db.postgres import DataManager
-from fastapi.responses import Response
-from typing import List, Dict
+from docs_processing.pageable import decode_cursor, encode_cursor
+from fastapi.responses import Response, StreamingResponse
+from typing import Any, AsyncIterator, Callable, List, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 data_base = DataManager()
 
+# DataManager синхронный (psycopg2), поэтому запросы выполняются в отдельном ограниченном
+# пуле потоков и не блокируют event loop, который обслуживает /ws/chat
+DB_WORKERS = int(os.getenv("DOCUMENT_DB_WORKERS", str(data_base.connection.pool_max_size)))
+_db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="document-db")
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOCUMENT_DOWNLOAD_CHUNK_SIZE", str(1024 * 1024)))
 
-class DocumentService:
-    @staticmethod
-    def create_doc(doc_id: str, title: str, mcb: str, age_category: str, developer: str, file_data: bytes):
-        data_base.add_to_upload_list(doc_id, title, mcb, age_category, developer, data=file_data)
-        data_base.upload_data()
 
+async def _run_in_db_thread(func: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, partial(func, *args, **kwargs))
+
+
+def _parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Диапазон (start, end) включительно из заголовка Range.
+
+    None – заголовок отсутствует, некорректен или содержит несколько диапазонов (отдаётся весь файл).
+    ValueError – диапазон синтаксически корректен, но не пересекается с файлом.
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[len("bytes="):].strip()
+    if "," in spec or "-" not in spec:
+        return None
+
+    start_str, end_str = (part.strip() for part in spec.split("-", maxsplit=1))
+    if not start_str:
+        if not end_str.isdigit():
+            return None
+        suffix = int(end_str)
+        if suffix == 0 or size == 0:
+            raise ValueError("Пустой диапазон")
+        return max(0, size - suffix), size - 1
+
+    if not start_str.isdigit() or (end_str and not end_str.isdigit()):
+        return None
+    start = int(start_str)
+    end = int(end_str) if end_str else size - 1
+    if start >= size:
+        raise ValueError("Диапазон за пределами файла")
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def _etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+async def _stream_document(doc_id: str, sha256: str, start: int, end: int) -> AsyncIterator[bytes]:
+    offset = start
+    while offset <= end:
+        length = min(DOWNLOAD_CHUNK_SIZE, end - offset + 1)
+        chunk = await _run_in_db_thread(data_base.read_document_range, doc_id, sha256, offset, length)
+        if not chunk:
+            # документ заменили или удалили во время скачивания: обрываем ответ, а не отдаём смесь версий
+            raise RuntimeError(f"Документ {doc_id} изменился во время скачивания")
+        offset += len(chunk)
+        yield chunk
+
+
+class BlobFileResponse(Response):
+    """Отдача диапазона файла из хранилища: через sendfile, если ASGI-сервер поддерживает
+    расширение http.response.zerocopysend, иначе чтением фрагментами."""
+
+    def __init__(self, path: str, start: int, end: int, status_code: int, headers: Dict[str, str]):
+        super().__init__(status_code=status_code, headers=headers, media_type="application/pdf")
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as blob:
+                await send({
+                    "type": "http.response.zerocopysend",
+                    "file": blob.fileno(),
+                    "offset": self.start,
+                    "count": self.count,
+                    "more_body": False,
+                })
+            return
+
+        async with await anyio.open_file(self.path, "rb") as blob:
+            await blob.seek(self.start)
+            remaining = self.count
+            while remaining > 0:
+                chunk = await blob.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class DocumentService:
     # @staticmethod
     # def get_all_docs():
     #     return data_base.get_all_docs()
 
     @staticmethod
-    def get_all_docs(page: int = 0, size: int = 10, search: str | None = None) -> List[Dict]:
+    async def get_all_docs(page: int = 0, size: int = 10,
+                           search: str | None = None) -> Tuple[List[Dict], int, bool]:
+        """Страница документов, общее число и признак точности этого числа."""
         normalized_search = search.strip() if isinstance(search, str) else None
-        return data_base.get_docs_paginated(page=page, size=size, search=normalized_search)
+        return await _run_in_db_thread(data_base.get_docs_paginated, page=page, size=size, search=normalized_search)
 
     @staticmethod
-    def get_total_documents(search: str | None = None) -> int:
+    async def get_docs_by_cursor(cursor: str | None = None, size: int = 10,
+                                 search: str | None = None) -> Tuple[List[Dict], Optional[str], int, bool]:
+        """Страница документов после курсора, курсор следующей страницы (None, если страница последняя),
+        общее число документов и признак его точности."""
+        after = decode_cursor(cursor) if cursor else None
         normalized_search = search.strip() if isinstance(search, str) else None
-        return data_base.get_documents_total(search=normalized_search)
+        # лишняя строка показывает, есть ли следующая страница
+        docs, total, exact = await _run_in_db_thread(data_base.get_docs_after, size=size + 1, after=after,
+                                                     search=normalized_search)
+        if len(docs) <= size:
+            return docs, None, total, exact
+        docs = docs[:size]
+        return docs, encode_cursor(docs[-1]), total, exact
 
     @staticmethod
-    def delete_doc(doc_id: str) -> bool:
-        ans = data_base.is_doc_exist(doc_id)
-        if ans:
-            data_base.delete_data((doc_id,))
+    async def get_total_documents(search: str | None = None) -> Tuple[int, bool]:
+        normalized_search = search.strip() if isinstance(search, str) else None
+        return await _run_in_db_thread(data_base.get_documents_total, search=normalized_search)
+
+    @staticmethod
+    async def delete_doc(doc_id: str) -> bool:
+        if await _run_in_db_thread(data_base.document_exists, doc_id):
+            await _run_in_db_thread(data_base.delete_data, (doc_id,))
             return True
         return False
 
     @staticmethod
-    def get_doc(doc_id: str):
-        ans = data_base.is_doc_exist(doc_id)
-        if ans:
-            return Response(
-                content=ans[6],
-                media_type="application/pdf",
-                headers={"Content-Disposition": f"attachment; filename=document_{doc_id}.pdf"})
-        return None
+    async def get_doc(doc_id: str, range_header: str | None = None, if_none_match: str | None = None,
+                      if_range: str | None = None):
+        info = await _run_in_db_thread(data_base.get_document_info, doc_id)
+        if not info:
+            return None
+
+        size = info["data_size"]
+        sha256 = info["data_sha256"].strip()
+        etag = f'"{sha256}"'
+        headers = {
+            "Content-Disposition": f"attachment; filename=document_{doc_id}.pdf",
+            "ETag": etag,
+            "Accept-Ranges": "bytes",
+        }
+
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+
+        if if_range and if_range.strip() != etag:
+            range_header = None
+        try:
+            byte_range = _parse_range(range_header, size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+        status_code = 200
+        start, end = 0, size - 1
+        if byte_range:
+            start, end = byte_range
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        if info["in_blob_store"]:
+            path = data_base.blob_store.path_for(sha256)
+            if not path.is_file():
+                logger.error("Файл документа %s (%s) отсутствует в хранилище", doc_id, sha256)
+                return None
+            return BlobFileResponse(str(path), start, end, status_code, headers)
+
+        return StreamingResponse(
+            _stream_document(doc_id, sha256, start, end),
+            status_code=status_code,
+            media_type="application/pdf",
+            headers=headers,
+        )
+
+    @staticmethod
+    def get_pool_stats() -> Dict[str, Any]:
+        return data_base.pool_stats()
+
+    @staticmethod
+    def close():
+        data_base.close()
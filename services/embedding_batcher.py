@@ -0,0 +1,151 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from services.http_clients import http_clients
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+WAIT_MS_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class _Histogram:
+    __slots__ = ("bounds", "counts", "count", "total")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = tuple(bounds)
+        # последний счётчик – значения больше верхней границы
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def to_dict(self) -> Dict[str, Any]:
+        labels = [f"le_{bound:g}" for bound in self.bounds] + ["le_inf"]
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count, 3) if self.count else 0.0,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class _PendingBatch:
+    __slots__ = ("task", "dimensions", "futures", "enqueued_at", "timer")
+
+    def __init__(self, task: str, dimensions: int):
+        self.task = task
+        self.dimensions = dimensions
+        # одинаковые тексты в пакете отправляются один раз и получают общий результат
+        self.futures: Dict[str, asyncio.Future] = {}
+        self.enqueued_at: Dict[str, float] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingBatcher:
+    """Объединяет одновременные запросы эмбеддингов в один вызов embedding-service.
+
+    Запрос ждёт не дольше EMBEDDING_COALESCE_WAIT_MS: пакет уходит по истечении этого времени
+    с момента поступления первого текста или сразу, как только набралось EMBEDDING_COALESCE_MAX_TEXTS.
+    """
+
+    def __init__(self):
+        self.url = os.getenv("EMBEDDING_SERVICE_URL", "http://localhost:8000/embed")
+        self.max_wait = float(os.getenv("EMBEDDING_COALESCE_WAIT_MS", "5")) / 1000
+        self.max_texts = int(os.getenv("EMBEDDING_COALESCE_MAX_TEXTS", "32"))
+
+        self._pending: Dict[Tuple[str, int], _PendingBatch] = {}
+        self._in_flight: Set[asyncio.Task] = set()
+
+        self.requests = 0
+        self.deduplicated = 0
+        self.batches = 0
+        self.errors = 0
+        self.batch_sizes = _Histogram(BATCH_SIZE_BUCKETS)
+        self.wait_ms = _Histogram(WAIT_MS_BUCKETS)
+
+    async def embed(self, text: str, task: str, dimensions: int) -> List[float]:
+        self.requests += 1
+        key = (task, dimensions)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _PendingBatch(task, dimensions)
+
+        future = batch.futures.get(text)
+        if future is None:
+            future = batch.futures[text] = asyncio.get_running_loop().create_future()
+            batch.enqueued_at[text] = time.perf_counter()
+        else:
+            self.deduplicated += 1
+
+        if len(batch.futures) >= self.max_texts or self.max_wait <= 0:
+            self._flush(key)
+        elif batch.timer is None:
+            batch.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+
+        # shield: отмена одного ожидающего (закрытый websocket) не должна отменять результат для остальных
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_wait_ms": round(self.max_wait * 1000, 3),
+            "max_texts": self.max_texts,
+            "requests": self.requests,
+            "deduplicated": self.deduplicated,
+            "batches": self.batches,
+            "errors": self.errors,
+            "batch_size": self.batch_sizes.to_dict(),
+            "wait_ms": self.wait_ms.to_dict(),
+        }
+
+    def _flush(self, key: Tuple[str, int]) -> None:
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+
+        sent_at = time.perf_counter()
+        for enqueued_at in batch.enqueued_at.values():
+            self.wait_ms.observe((sent_at - enqueued_at) * 1000)
+        self.batch_sizes.observe(len(batch.futures))
+        self.batches += 1
+
+        task = asyncio.create_task(self._send(batch))
+        self._in_flight.add(task)
+        task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: _PendingBatch) -> None:
+        texts = list(batch.futures)
+        payload = {"texts": texts, "task": batch.task, "dimensions": batch.dimensions}
+        try:
+            response = await http_clients.get("embedding").post(self.url, json=payload)
+            response.raise_for_status()
+            embeddings = response.json()["embedding"]
+            if len(embeddings) != len(texts):
+                raise IndexError(f"embedding-service вернул {len(embeddings)} эмбеддингов на {len(texts)} текстов")
+        except Exception as exc:
+            self.errors += 1
+            for future in batch.futures.values():
+                if not future.done():
+                    future.set_exception(exc)
+                    # все ожидающие могли уже уйти: иначе asyncio предупредит о необработанном исключении
+                    future.exception()
+            return
+
+        if len(texts) > 1:
+            logger.info("Эмбеддинги %s запросов получены одним пакетом", len(texts))
+        for text, embedding in zip(texts, embeddings):
+            future = batch.futures[text]
+            if not future.done():
+                future.set_result(embedding)
+
+
+embedding_batcher = EmbeddingBatcher()
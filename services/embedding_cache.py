@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from db.vector_db import vector_pool
+
+logger = logging.getLogger(__name__)
+
+CREATE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS query_embedding_cache (
+        cache_key CHAR(64) PRIMARY KEY,
+        task VARCHAR(64) NOT NULL,
+        dimensions INTEGER NOT NULL,
+        embedding DOUBLE PRECISION[] NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+"""
+
+SELECT_QUERY = """
+    SELECT embedding
+    FROM query_embedding_cache
+    WHERE cache_key = $1
+      AND created_at > now() - make_interval(secs => $2);
+"""
+
+UPSERT_QUERY = """
+    INSERT INTO query_embedding_cache (cache_key, task, dimensions, embedding)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (cache_key) DO UPDATE SET
+        embedding = EXCLUDED.embedding,
+        created_at = now();
+"""
+
+
+class EmbeddingCache:
+    """LRU-кэш эмбеддингов запросов с TTL и ограничением по памяти.
+
+    Вторым уровнем может выступать таблица query_embedding_cache в векторной БД:
+    она переживает перезапуск и общая для всех воркеров.
+    """
+
+    def __init__(self):
+        self.max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "10000"))
+        self.max_bytes = int(float(os.getenv("EMBEDDING_CACHE_MAX_MB", "64")) * 1024 * 1024)
+        self.ttl = float(os.getenv("EMBEDDING_CACHE_TTL", "86400"))
+        self.persist = os.getenv("EMBEDDING_CACHE_PERSIST", "false").lower() == "true"
+
+        self._entries: "OrderedDict[str, Tuple[array, float, int]]" = OrderedDict()
+        self._bytes = 0
+        self._schema_ready = False
+        self._pending: Set[asyncio.Task] = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text: str, task: str, dimensions: int) -> str:
+        normalized = " ".join(text.casefold().split())
+        return hashlib.sha256(f"{task}\n{dimensions}\n{normalized}".encode("utf-8")).hexdigest()
+
+    async def get(self, text: str, task: str, dimensions: int) -> Optional[List[float]]:
+        if self.max_entries <= 0:
+            return None
+
+        key = self.make_key(text, task, dimensions)
+        entry = self._entries.get(key)
+        if entry is not None:
+            vector, stored_at, _ = entry
+            if time.monotonic() - stored_at <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+            self._remove(key)
+
+        if self.persist:
+            vector = await self._load(key)
+            if vector is not None:
+                self._store(key, array("d", vector))
+                self.hits += 1
+                self.persistent_hits += 1
+                return vector
+
+        self.misses += 1
+        return None
+
+    def put(self, text: str, task: str, dimensions: int, embedding: List[float]) -> None:
+        if self.max_entries <= 0:
+            return
+
+        key = self.make_key(text, task, dimensions)
+        self._store(key, array("d", embedding))
+        if self.persist:
+            # запись во второй уровень не должна задерживать ответ пользователю
+            task_ref = asyncio.create_task(self._save(key, task, dimensions, embedding))
+            self._pending.add(task_ref)
+            task_ref.add_done_callback(self._pending.discard)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_bytes": self._bytes,
+            "max_memory_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "persistent_hits": self.persistent_hits,
+            "evictions": self.evictions,
+            "persist": self.persist,
+        }
+
+    def _store(self, key: str, vector: array) -> None:
+        if key in self._entries:
+            self._remove(key)
+
+        size = sys.getsizeof(vector) + sys.getsizeof(key)
+        self._entries[key] = (vector, time.monotonic(), size)
+        self._bytes += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    async def _ensure_schema(self, conn: asyncpg.Connection) -> None:
+        if not self._schema_ready:
+            await conn.execute(CREATE_TABLE_QUERY)
+            self._schema_ready = True
+
+    async def _load(self, key: str) -> Optional[List[float]]:
+        try:
+            async with vector_pool.acquire() as conn:
+                await self._ensure_schema(conn)
+                record = await conn.fetchrow(SELECT_QUERY, key, self.ttl)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+            logger.warning("Не удалось прочитать кэш эмбеддингов из БД: %s", exc)
+            return None
+        return list(record["embedding"]) if record else None
+
+    async def _save(self, key: str, task: str, dimensions: int, embedding: List[float]) -> None:
+        try:
+            async with vector_pool.acquire() as conn:
+                await self._ensure_schema(conn)
+                await conn.execute(UPSERT_QUERY, key, task, dimensions, embedding)
+        except (asyncpg.PostgresError, OSError, asyncio.TimeoutError) as exc:
+            logger.warning("Не удалось сохранить эмбеддинг в кэш БД: %s", exc)
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,66 @@
+import importlib.util
+import logging
+import os
+from typing import Dict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+UPSTREAMS = ("embedding", "rerank", "llm")
+
+
+class UpstreamConfig:
+    def __init__(self):
+        self.max_connections = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+        self.max_keepalive_connections = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+        self.keepalive_expiry = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+        self.connect_timeout = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+        self.http2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+        self.timeouts = {
+            "embedding": float(os.getenv("EMBEDDING_TIMEOUT", "30")),
+            "rerank": float(os.getenv("RERANK_TIMEOUT", "30")),
+            "llm": float(os.getenv("LLM_TIMEOUT", "60")),
+        }
+
+
+class UpstreamClients:
+    """Долгоживущие httpx-клиенты с keep-alive, по одному на каждый внешний сервис."""
+
+    def __init__(self):
+        self.config = UpstreamConfig()
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def open(self) -> None:
+        for name in UPSTREAMS:
+            self.get(name)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._create(name)
+            self._clients[name] = client
+        return client
+
+    async def close(self) -> None:
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def _create(self, name: str) -> httpx.AsyncClient:
+        http2 = self.config.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("UPSTREAM_HTTP2 включён, но пакет h2 не установлен. Используется HTTP/1.1")
+            http2 = False
+
+        limits = httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+        timeout = httpx.Timeout(self.config.timeouts[name], connect=self.config.connect_timeout)
+        logger.info("HTTP-клиент для %s создан (http2=%s)", name, http2)
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+
+http_clients = UpstreamClients()
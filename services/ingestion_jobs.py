@@ -0,0 +1,276 @@
+import asyncio
+import datetime as dt
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from db.chunk_store import ChunkStore
+from db.postgres import DataManager
+from docs_processing.upload_files import ClinicalDocument, _extract_chunks, _parse_base_id, _sync_chunks
+from services.document_service import data_base
+
+logger = logging.getLogger(__name__)
+
+
+class IngestionQueueFull(Exception):
+    pass
+
+
+class IngestionJob:
+    __slots__ = (
+        "id", "doc_id", "title", "mcb", "age_category", "developer", "placement_date", "data", "stored",
+        "status", "error", "chunks_total", "embedding_total", "embedding_done", "chunk_counts",
+        "created_at", "started_at", "finished_at",
+    )
+
+    def __init__(self, doc_id: str, title: str, mcb: str, age_category: str, developer: str,
+                 data: Optional[bytes], placement_date: Optional[dt.date] = None):
+        self.id = uuid.uuid4().hex
+        self.doc_id = doc_id
+        self.title = title
+        self.mcb = mcb
+        self.age_category = age_category
+        self.developer = developer
+        self.placement_date = placement_date or dt.date.today()
+        self.data: Optional[bytes] = data
+        # PDF уже сохранён (массовый импорт): задание только нарезает документ и отправляет эмбеддинги
+        self.stored = data is None
+
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.chunks_total: Optional[int] = None
+        # фрагменты, для которых нужны новые эмбеддинги (совпавшие с прежней версией переиспользуются)
+        self.embedding_total: Optional[int] = None
+        self.embedding_done = 0
+        self.chunk_counts: Optional[Dict[str, int]] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        def timestamp(value: Optional[float]) -> Optional[str]:
+            return dt.datetime.fromtimestamp(value, dt.timezone.utc).isoformat() if value else None
+
+        return {
+            "job_id": self.id,
+            "doc_id": self.doc_id,
+            "title": self.title,
+            "status": self.status,
+            "error": self.error,
+            "chunks_total": self.chunks_total,
+            "embedding_total": self.embedding_total,
+            "embedding_done": self.embedding_done,
+            "chunks": self.chunk_counts,
+            "created_at": timestamp(self.created_at),
+            "started_at": timestamp(self.started_at),
+            "finished_at": timestamp(self.finished_at),
+        }
+
+
+class IngestionJobs:
+    """Фоновая загрузка документов: сохранение PDF, нарезка на фрагменты и отправка эмбеддингов.
+
+    Очередь ограничена: при её заполнении новые загрузки отклоняются сразу, а не копятся в памяти.
+    Задания для уже сохранённых документов (submit_stored) не держат PDF в памяти, поэтому
+    ограничены не INGEST_QUEUE_SIZE, а INGEST_MAX_JOBS.
+    Задания выполняются в собственном пуле потоков, поэтому не занимают потоки запросов к БД,
+    которыми пользуются список документов и скачивание; соединения с БД берутся из общего пула
+    DocumentService, чтобы их число не превышало DB_POOL_MAX_SIZE.
+    """
+
+    def __init__(self):
+        self.workers = int(os.getenv("INGEST_WORKERS", "2"))
+        self.queue_size = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+        # сколько хранить сведения о завершённых заданиях, сек
+        self.retention = float(os.getenv("INGEST_JOB_RETENTION", "3600"))
+        self.max_jobs = int(os.getenv("INGEST_MAX_JOBS", "1000"))
+        self.max_file_bytes = int(float(os.getenv("INGEST_MAX_FILE_MB", "100")) * 1024 * 1024)
+
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        # заданий с PDF в памяти в очереди
+        self._queued_uploads = 0
+        self._tasks: List[asyncio.Task] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._data_manager: Optional[DataManager] = None
+        self._chunk_store: Optional[ChunkStore] = None
+        self._lock = threading.Lock()
+
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._queued_uploads = 0
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix="ingest")
+        self._data_manager = data_base
+        self._chunk_store = ChunkStore()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(max(1, self.workers))]
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            # текущие задания дорабатывают в своих потоках, новые не начинаются
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._chunk_store is not None:
+            self._chunk_store.close()
+            self._chunk_store = None
+        # общий DataManager закрывает DocumentService
+        self._data_manager = None
+
+    def ensure_capacity(self) -> None:
+        """Отклоняет загрузку до чтения файла, если очередь уже заполнена."""
+        if self._queue is not None and self._queued_uploads >= max(1, self.queue_size):
+            self.rejected += 1
+            raise IngestionQueueFull("Очередь загрузки документов заполнена, повторите попытку позже")
+
+    def submit(self, doc_id: str, title: str, mcb: str, age_category: str, developer: str,
+               data: bytes) -> IngestionJob:
+        if self._queue is None:
+            raise RuntimeError("Фоновая загрузка документов не запущена")
+        self.ensure_capacity()
+
+        job = IngestionJob(doc_id, title, mcb, age_category, developer, data)
+        self._queued_uploads += 1
+        return self._enqueue(job)
+
+    def submit_stored(self, doc_id: str, title: str, mcb: str, age_category: str, developer: str,
+                      placement_date: dt.date) -> IngestionJob:
+        """Ставит в очередь нарезку и эмбеддинги документа, PDF которого уже сохранён в БД."""
+        if self._queue is None:
+            raise RuntimeError("Фоновая загрузка документов не запущена")
+        if self._queue.qsize() >= max(1, self.max_jobs):
+            self.rejected += 1
+            raise IngestionQueueFull("Очередь загрузки документов заполнена, повторите попытку позже")
+
+        return self._enqueue(IngestionJob(doc_id, title, mcb, age_category, developer, None, placement_date))
+
+    def _enqueue(self, job: IngestionJob) -> IngestionJob:
+        self._queue.put_nowait(job)
+        self._forget_expired()
+        self._jobs[job.id] = job
+        logger.info("Документ %s поставлен в очередь загрузки (задание %s)", job.doc_id, job.id)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        self._forget_expired()
+        return self._jobs.get(job_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "running": sum(1 for job in self._jobs.values() if job.started_at and not job.finished),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    def _forget_expired(self) -> None:
+        now = time.time()
+        for job_id in list(self._jobs):
+            job = self._jobs[job_id]
+            expired = job.finished and now - job.finished_at > self.retention
+            if expired or (len(self._jobs) > self.max_jobs and job.finished):
+                del self._jobs[job_id]
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            if not job.stored:
+                self._queued_uploads -= 1
+            try:
+                await loop.run_in_executor(self._executor, self._run, job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: IngestionJob) -> None:
+        job.started_at = time.time()
+        data, job.data = job.data, None
+        try:
+            base_id, version = _parse_base_id(job.doc_id)
+            doc = ClinicalDocument(
+                raw_id=job.doc_id,
+                base_id=base_id,
+                version=version,
+                title=job.title,
+                mcb=None if job.mcb == "NULL" else job.mcb,
+                age_category=job.age_category,
+                developer=None if job.developer == "NULL" else job.developer,
+                publish_date=job.placement_date,
+                source_url=f"/doclist/{job.doc_id}",
+            )
+
+            if job.stored:
+                job.status = "loading"
+                data = self._data_manager.read_document(job.doc_id)
+                if data is None:
+                    raise ValueError(f"Документ {job.doc_id} не найден или изменён")
+            else:
+                job.status = "storing"
+                self._data_manager.save_document(
+                    doc_id=job.doc_id,
+                    title=job.title,
+                    mcb=job.mcb,
+                    age_category=job.age_category,
+                    developer=job.developer,
+                    placement_date=job.placement_date,
+                    data=data,
+                )
+
+            job.status = "extracting"
+            chunks = _extract_chunks(data)
+            job.chunks_total = len(chunks)
+
+            job.status = "embedding"
+            if chunks:
+                job.chunk_counts = _sync_chunks(chunks, doc, self._chunk_store, progress=self._progress(job))
+                job.embedding_total = job.chunk_counts["embedded"]
+                self._data_manager.mark_embedded(job.doc_id, hashlib.sha256(data).hexdigest())
+            else:
+                logger.warning("В документе %s не найден текст, в чат он не попадёт", job.doc_id)
+                # фрагменты прежней версии остаются, синхронизация реестра не будет обрабатывать этот PDF заново
+                self._data_manager.mark_embedded(job.doc_id, hashlib.sha256(data).hexdigest(), has_text=False)
+
+            job.status = "done"
+            with self._lock:
+                self.completed += 1
+            logger.info("Документ %s загружен (задание %s)", job.doc_id, job.id)
+        except Exception as exc:
+            job.status = "failed"
+            job.error = str(exc)
+            with self._lock:
+                self.failed += 1
+            logger.exception("Ошибка фоновой загрузки документа %s: %s", job.doc_id, exc)
+        finally:
+            job.finished_at = time.time()
+
+    @staticmethod
+    def _progress(job: IngestionJob):
+        def update(sent: int, total: int) -> None:
+            job.embedding_total = total
+            job.embedding_done = sent
+
+        return update
+
+
+ingestion_jobs = IngestionJobs()
@@ -0,0 +1,155 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# вес нового замера в скользящем среднем стоимости rerank и LLM
+EWMA_ALPHA = 0.2
+
+
+def _optional_float(name: str) -> Optional[float]:
+    value = os.getenv(name, "").strip()
+    return float(value) if value else None
+
+
+class RerankPolicy:
+    """Отсечение кандидатов перед rerank и контекста перед LLM.
+
+    Все правила по умолчанию выключены. Каждое срабатывание пишется в лог с оценкой сэкономленного
+    времени: она считается по скользящему среднему времени rerank и LLM на один фрагмент.
+    """
+
+    def __init__(self):
+        # фрагменты с косинусной близостью ниже порога не рассматриваются
+        self.similarity_floor = float(os.getenv("RAG_SIMILARITY_FLOOR", "0"))
+        # если top_k фрагментов отрываются от остальных по близости хотя бы на decisive_gap, rerank не нужен
+        self.decisive_gap = float(os.getenv("RAG_DECISIVE_GAP", "0"))
+        self.decisive_top_k = int(os.getenv("RAG_DECISIVE_TOP_K", "3"))
+        # в rerank уходят фрагменты не дальше candidate_margin от лучшего, но не меньше min_candidates
+        self.candidate_margin = float(os.getenv("RAG_CANDIDATE_MARGIN", "0"))
+        self.min_candidates = int(os.getenv("RAG_MIN_CANDIDATES", "5"))
+        # контекст LLM: от context_min до context_max фрагментов с оценкой rerank не ниже context_min_score
+        self.context_min_score = _optional_float("RAG_CONTEXT_MIN_SCORE")
+        self.context_max = int(os.getenv("RAG_CONTEXT_MAX", "0"))
+        self.context_min = int(os.getenv("RAG_CONTEXT_MIN", "1"))
+
+        self._rerank_ms_per_passage: Optional[float] = None
+        self._llm_ms_per_passage: Optional[float] = None
+
+        self.floor_pruned = 0
+        self.candidates_pruned = 0
+        self.rerank_skipped = 0
+        self.context_pruned = 0
+        self.saved_ms = 0.0
+
+    def observe_rerank(self, passages: int, seconds: float) -> None:
+        if passages:
+            self._rerank_ms_per_passage = self._ewma(self._rerank_ms_per_passage, seconds * 1000 / passages)
+
+    def observe_llm(self, passages: int, seconds: float) -> None:
+        if passages:
+            self._llm_ms_per_passage = self._ewma(self._llm_ms_per_passage, seconds * 1000 / passages)
+
+    def select_candidates(self, passages: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], bool]:
+        """Кандидаты для rerank и признак того, что rerank можно пропустить.
+
+        Фрагменты полнотекстовой ветки без векторной близости (similarity = None) отсекаются
+        только вместе с rerank: оценить их без него нечем.
+        """
+        candidates = passages
+        if self.similarity_floor > 0:
+            candidates = [p for p in candidates if p["similarity"] is None or p["similarity"] >= self.similarity_floor]
+            self._log_pruned("порог близости %.3f" % self.similarity_floor, len(passages), len(candidates),
+                             self._rerank_ms_per_passage)
+            self.floor_pruned += len(passages) - len(candidates)
+
+        if not candidates:
+            return candidates, False
+
+        decisive = self._decisive_top(candidates)
+        if decisive is not None:
+            saved = self._estimate(self._rerank_ms_per_passage, len(candidates))
+            self.rerank_skipped += 1
+            self.saved_ms += saved
+            logger.info(
+                "Rerank пропущен: %s лучших фрагментов отрываются от остальных по близости на %.3f и более, "
+                "экономия ≈ %.0f мс",
+                len(decisive),
+                self.decisive_gap,
+                saved,
+            )
+            return decisive, True
+
+        if self.candidate_margin > 0:
+            best = max((p["similarity"] for p in candidates if p["similarity"] is not None), default=None)
+            if best is not None:
+                before = len(candidates)
+                kept = [
+                    p for position, p in enumerate(candidates)
+                    if position < self.min_candidates or p["similarity"] is None
+                    or p["similarity"] >= best - self.candidate_margin
+                ]
+                self._log_pruned("отрыв от лучшего больше %.3f" % self.candidate_margin, before, len(kept),
+                                 self._rerank_ms_per_passage)
+                self.candidates_pruned += before - len(kept)
+                candidates = kept
+
+        return candidates, False
+
+    def select_context(self, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Фрагменты после rerank, которые войдут в промпт LLM."""
+        context = results
+        if self.context_min_score is not None:
+            context = [
+                item for position, item in enumerate(context)
+                if position < self.context_min or (item.get("score") is not None and item["score"] >= self.context_min_score)
+            ]
+        if self.context_max > 0:
+            context = context[:max(self.context_max, self.context_min)]
+
+        if len(context) < len(results):
+            self._log_pruned("контекст LLM", len(results), len(context), self._llm_ms_per_passage)
+            self.context_pruned += len(results) - len(context)
+        return context
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "floor_pruned": self.floor_pruned,
+            "candidates_pruned": self.candidates_pruned,
+            "rerank_skipped": self.rerank_skipped,
+            "context_pruned": self.context_pruned,
+            "estimated_saved_ms": round(self.saved_ms, 1),
+            "rerank_ms_per_passage": round(self._rerank_ms_per_passage or 0.0, 3),
+            "llm_ms_per_passage": round(self._llm_ms_per_passage or 0.0, 3),
+        }
+
+    def _decisive_top(self, candidates: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        k = self.decisive_top_k
+        if self.decisive_gap <= 0 or k <= 0 or len(candidates) <= k:
+            return None
+        if any(p["similarity"] is None for p in candidates):
+            return None
+        ordered = sorted(candidates, key=lambda p: p["similarity"], reverse=True)
+        if ordered[k - 1]["similarity"] - ordered[k]["similarity"] < self.decisive_gap:
+            return None
+        return ordered[:k]
+
+    def _log_pruned(self, rule: str, before: int, after: int, ms_per_passage: Optional[float]) -> None:
+        if after >= before:
+            return
+        saved = self._estimate(ms_per_passage, before - after)
+        self.saved_ms += saved
+        logger.info("Отсечение фрагментов (%s): %s → %s, экономия ≈ %.0f мс", rule, before, after, saved)
+
+    @staticmethod
+    def _estimate(ms_per_passage: Optional[float], passages: int) -> float:
+        # до первых замеров оценка нулевая
+        return (ms_per_passage or 0.0) * passages
+
+    @staticmethod
+    def _ewma(current: Optional[float], value: float) -> float:
+        return value if current is None else current + EWMA_ALPHA * (value - current)
+
+
+rerank_policy = RerankPolicy()
@@ -0,0 +1,38 @@
+from typing import Any, Dict
+
+
+class _BranchTimings:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class RetrievalStats:
+    """Время выполнения этапов поиска фрагментов (векторный, лексический, итоговый)."""
+
+    def __init__(self):
+        self._branches: Dict[str, _BranchTimings] = {}
+
+    def record(self, branch: str, seconds: float) -> None:
+        timings = self._branches.get(branch)
+        if timings is None:
+            timings = self._branches[branch] = _BranchTimings()
+        timings.count += 1
+        timings.total += seconds
+        timings.max = max(timings.max, seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            branch: {
+                "count": timings.count,
+                "avg_ms": round(timings.total / timings.count * 1000, 3) if timings.count else 0.0,
+                "max_ms": round(timings.max * 1000, 3),
+            }
+            for branch, timings in self._branches.items()
+        }
+
+
+retrieval_stats = RetrievalStats()
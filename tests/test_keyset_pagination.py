@@ -0,0 +1,173 @@
+"""Курсорная пагинация списка документов: курсоры и обход страниц без дублей и пропусков."""
+import asyncio
+import base64
+import datetime as dt
+import json
+import uuid
+
+import psycopg2
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api.router_page import page_router
+from db.postgres import DataConnection, DataManager, _search_filter
+from docs_processing.pageable import decode_cursor, encode_cursor
+from services import document_service
+from services.document_service import DocumentService
+
+
+def _raw_cursor(value) -> str:
+    raw = json.dumps(value, ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+@pytest.mark.parametrize("row", [
+    {"placement_date": dt.date(2024, 3, 1), "title": "Астма, дети", "id_cr": "359_2"},
+    {"placement_date": None, "title": "", "id_cr": "1"},
+    {"placement_date": dt.date(2020, 1, 31), "title": "=" * 7 + "/+?&", "id_cr": "a_b"},
+])
+def test_cursor_round_trip(row):
+    cursor = encode_cursor(row)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (row["placement_date"], row["title"], row["id_cr"])
+
+
+@pytest.mark.parametrize("cursor", [
+    "",
+    "не-base64!",
+    "%%%%",
+    _raw_cursor(["2024-01-01", "title"]),
+    _raw_cursor(["2024-13-01", "title", "1"]),
+    _raw_cursor([20240101, "title", "1"]),
+    _raw_cursor(["2024-01-01", 1, "1"]),
+    _raw_cursor(["2024-01-01", "title", None]),
+    _raw_cursor({"placement_date": "2024-01-01", "title": "t", "id_cr": "1"}),
+    _raw_cursor("строка"),
+    base64.urlsafe_b64encode(b"\xff\xfe\x00").decode("ascii"),
+])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("cursor", ["не-base64!", _raw_cursor(["2024-13-01", "title", "1"]), _raw_cursor([1, 2, 3])])
+def test_invalid_cursor_is_bad_request(monkeypatch, cursor):
+    def get_docs_after(**kwargs):
+        raise AssertionError("некорректный курсор не должен доходить до БД")
+
+    monkeypatch.setattr(document_service.data_base, "get_docs_after", get_docs_after)
+    app = FastAPI()
+    app.include_router(page_router)
+
+    response = TestClient(app).get("/doclist/paginated", params={"cursor": cursor})
+    assert response.status_code == 400
+
+
+# --------------------------------------------------------------------- #
+# Обход страниц на PostgreSQL из переменных DB_*
+# --------------------------------------------------------------------- #
+
+TITLES = ["Астма", "Астма", "Бронхит", "астма", "Гастрит", "Бронхит"]
+DATES = [dt.date(2024, 5, 1), dt.date(2024, 5, 1), dt.date(2023, 1, 1), None]
+
+
+@pytest.fixture
+def keyset_db(monkeypatch):
+    """DataManager на временной схеме с документами, у которых много совпадений ключа сортировки."""
+    config = DataConnection()
+    try:
+        conn = psycopg2.connect(dbname=config.dbname, user=config.user, password=config.password,
+                                host=config.host, port=config.port, connect_timeout=3)
+    except psycopg2.OperationalError as exc:
+        pytest.skip(f"PostgreSQL недоступен: {exc}")
+
+    schema = f"test_keyset_{uuid.uuid4().hex[:12]}"
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {schema}")
+        cur.execute(f"SET search_path TO {schema}")
+        cur.execute("""
+            CREATE TABLE documents (
+                id_cr VARCHAR(10) PRIMARY KEY,
+                title VARCHAR(400) NOT NULL,
+                MCB VARCHAR(400),
+                age_category VARCHAR(20) NOT NULL,
+                developer VARCHAR(1000),
+                placement_date DATE
+            );
+            CREATE INDEX idx_documents_keyset ON documents (placement_date DESC NULLS LAST, title ASC, id_cr ASC);
+            CREATE TABLE documents_stats (id BOOLEAN PRIMARY KEY DEFAULT TRUE, total BIGINT NOT NULL);
+        """)
+        rows = [
+            (f"{index}_{index % 3 + 1}", TITLES[index % len(TITLES)], "NULL", "Взрослые", "NULL",
+             DATES[index % len(DATES)])
+            for index in range(47)
+        ]
+        cur.executemany("INSERT INTO documents VALUES (%s, %s, %s, %s, %s, %s)", rows)
+        cur.execute("INSERT INTO documents_stats (total) SELECT COUNT(*) FROM documents")
+
+    data_manager = DataManager()
+    base_config = data_manager._conn_config
+    monkeypatch.setattr(data_manager, "_conn_config",
+                        lambda dbname=None: {**base_config(dbname), "options": f"-c search_path={schema}"})
+    monkeypatch.setattr(document_service, "data_base", data_manager)
+    try:
+        yield data_manager, conn
+    finally:
+        data_manager.close()
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.close()
+
+
+def _expected_ids(conn, search: str = None):
+    """Полный список в порядке сортировки одним запросом: с ним сравнивается постраничный обход."""
+    condition, params = _search_filter(search) if search else ("TRUE", [])
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT id_cr FROM documents WHERE {condition} "
+            f"ORDER BY placement_date DESC NULLS LAST, title ASC, id_cr ASC",
+            params or None,
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+def _walk(size: int, search: str = None):
+    async def run():
+        ids, cursor, pages = [], None, 0
+        while True:
+            docs, cursor, total, exact = await DocumentService.get_docs_by_cursor(cursor=cursor, size=size,
+                                                                                  search=search)
+            pages += 1
+            assert len(docs) <= size
+            ids += [doc["id_cr"] for doc in docs]
+            if cursor is None:
+                return ids, total, exact, pages
+            # курсор однозначно указывает на последнюю строку страницы
+            assert decode_cursor(cursor)[2] == docs[-1]["id_cr"]
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("size", [1, 3, 4, 10, 47, 100])
+def test_keyset_walk_has_no_duplicates_or_gaps(keyset_db, size):
+    _, conn = keyset_db
+    expected = _expected_ids(conn)
+
+    ids, total, exact, pages = _walk(size)
+
+    assert ids == expected
+    assert (total, exact) == (len(expected), True)
+    assert pages == max(1, -(-len(expected) // size))
+
+
+def test_keyset_walk_with_search(keyset_db):
+    _, conn = keyset_db
+    expected = _expected_ids(conn, "астма")
+    assert expected
+
+    ids, total, exact, _ = _walk(4, search="астма")
+
+    assert ids == expected
+    assert (total, exact) == (len(expected), True)
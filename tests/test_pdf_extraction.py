@@ -0,0 +1,116 @@
+"""Извлечение текста PDF по диапазонам страниц в пуле процессов против последовательного извлечения."""
+import signal
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+from docs_processing import upload_files
+
+
+def _pdf(pages):
+    """Минимальный PDF: по странице на каждый список строк, шрифт Helvetica."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    kids = []
+    for lines in pages:
+        commands = ["BT /F1 10 Tf 12 TL 40 800 Td"]
+        commands += [f"({line}) Tj T*" for line in lines]
+        commands.append("ET")
+        stream = "\n".join(commands).encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % kid for kid in kids), len(kids)
+    )
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def _page(number, lines):
+    return [f"Page {number} line {line} recommendation text for extraction order check" for line in range(lines)]
+
+
+# страница 4 короче MIN_CHUNK_LENGTH и пропускается, на длинных страницах по несколько чанков
+PAGE_LINES = [3, 30, 12, 1, 50, 6, 20]
+
+
+@pytest.fixture(scope="module")
+def pdf_data():
+    return _pdf([_page(number, lines) for number, lines in enumerate(PAGE_LINES, start=1)])
+
+
+@pytest.fixture
+def sharded(monkeypatch):
+    monkeypatch.setattr(upload_files, "PDF_EXTRACT_WORKERS", 2)
+    # границы шардов проходят между страницами 2|3, 4|5, 6|7
+    monkeypatch.setattr(upload_files, "PDF_SHARD_PAGES", 2)
+    upload_files.shutdown_extract_executor()
+    yield
+    upload_files.shutdown_extract_executor()
+
+
+def test_sequential_extraction_sanity(pdf_data):
+    chunks = upload_files._extract_page_range(pdf_data, 1, len(PAGE_LINES), 0)
+
+    pages = [chunk["page"] for chunk in chunks]
+    assert pages == sorted(pages)
+    assert 4 not in pages
+    assert max(chunk["chunk_index"] for chunk in chunks) > 0
+    assert all("Page %d line" % chunk["page"] in chunk["text"] for chunk in chunks)
+
+
+def test_sharded_extraction_matches_sequential(pdf_data, sharded):
+    sequential = upload_files._extract_page_range(pdf_data, 1, len(PAGE_LINES), upload_files.PDF_PAGE_TIMEOUT)
+
+    assert upload_files._extract_chunks(pdf_data) == sequential
+
+
+def test_broken_pool_is_recreated(pdf_data, sharded):
+    sequential = upload_files._extract_page_range(pdf_data, 1, len(PAGE_LINES), upload_files.PDF_PAGE_TIMEOUT)
+    executor = upload_files._get_extract_executor()
+    executor.submit(pow, 2, 2).result()
+
+    # аварийное завершение воркера: пул помечается сломанным и больше не принимает задачи
+    for process in list(executor._processes.values()):
+        process.kill()
+    deadline = time.monotonic() + 10
+    while not executor._broken and time.monotonic() < deadline:
+        time.sleep(0.05)
+    with pytest.raises(BrokenProcessPool):
+        executor.submit(pow, 2, 2).result()
+
+    assert upload_files._extract_chunks(pdf_data) == sequential
+    assert upload_files._get_extract_executor() is not executor
+
+
+def test_page_timeout_not_applied_outside_main_thread():
+    """Ограничение времени страницы работает только в главном потоке (воркеры пула процессов)."""
+    handlers = []
+
+    def run():
+        with upload_files._page_deadline(5):
+            handlers.append(signal.getsignal(signal.SIGALRM))
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert handlers == [signal.getsignal(signal.SIGALRM)]
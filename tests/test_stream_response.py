@@ -0,0 +1,179 @@
+"""Потоковый ответ чата на заглушке LLM-сервиса (httpx.MockTransport)."""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Callable, Dict, List
+
+import httpx
+import pytest
+
+from api import router_socket
+from services.http_clients import http_clients
+
+PASSAGE = {
+    "text": "Фрагмент рекомендации",
+    "document_name": "КР-1",
+    "recommendation_number": "1-p1",
+    "source_url": "/doclist/1",
+    "raw_document_id": "1",
+    "score": 0.9,
+}
+
+
+class _Stream(httpx.AsyncByteStream):
+    """Тело ответа по частям; callable в списке частей выполняется между ними (ожидание, сбой)."""
+
+    def __init__(self, parts: List[Any]):
+        self.parts = parts
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for part in self.parts:
+            if callable(part):
+                await part()
+            else:
+                yield part.encode("utf-8")
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Подменяет LLM-сервис: возвращает функцию, задающую тип содержимого и части ответа."""
+    requests: List[Dict[str, Any]] = []
+    cached: List[str] = []
+    response: Dict[str, Any] = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        return httpx.Response(200, headers={"content-type": response["content_type"]},
+                              stream=_Stream(response["parts"]))
+
+    async def prepare_context(user_query, options=None):
+        return router_socket.RagContext(embedding=[1.0], matched_results=[dict(PASSAGE)], prompt="prompt")
+
+    monkeypatch.setattr(router_socket, "LLM_SERVICE_URL", "http://llm.test/generate")
+    monkeypatch.setattr(router_socket, "_prepare_context", prepare_context)
+    monkeypatch.setattr(router_socket, "_cache_answer", lambda context, text: cached.append(text))
+    monkeypatch.setitem(http_clients._clients, "llm", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+
+    def configure(content_type: str, parts: List[Any]) -> Dict[str, Any]:
+        response.update(content_type=content_type, parts=parts)
+        return {"requests": requests, "cached": cached}
+
+    return configure
+
+
+def _collect(on_frame: Callable[[Dict[str, Any]], None] = lambda frame: None) -> List[Dict[str, Any]]:
+    async def run() -> List[Dict[str, Any]]:
+        frames = []
+        async for frame in router_socket.stream_response("вопрос"):
+            frames.append(frame)
+            on_frame(frame)
+        return frames
+
+    return asyncio.run(run())
+
+
+def _assert_order(frames: List[Dict[str, Any]]) -> None:
+    types = [frame["type"] for frame in frames]
+    assert types[0] == "retrieval"
+    assert types[-1] == "chat_message_end"
+    assert set(types[1:-1]) <= {"chat_message_delta"}
+
+
+def _deltas(frames: List[Dict[str, Any]]) -> str:
+    return "".join(frame["delta"] for frame in frames if frame["type"] == "chat_message_delta")
+
+
+def test_sse_stops_at_done(llm):
+    state = llm("text/event-stream", [
+        ": keep-alive\n\n",
+        'data: {"token": "Приём "}\n\n',
+        'data: {"choices": [{"delta": {"content": "НПВП"}}]}\n\n',
+        "data: [DONE]\n\n",
+        'data: {"token": "после DONE"}\n\n',
+    ])
+    frames = _collect()
+
+    _assert_order(frames)
+    assert _deltas(frames) == "Приём НПВП"
+    end = frames[-1]
+    assert end["content"].startswith("Приём НПВП\n\nИсточники:")
+    assert end["truncated"] is False
+    assert state["requests"][0]["stream"] is True
+    assert state["cached"] == [end["content"]]
+
+
+def test_ndjson_lines(llm):
+    llm("application/x-ndjson", ['{"delta": "Пер', 'вый"}\n{"text": " второй"}\n', "\n", '{"response": "!"}\n'])
+    frames = _collect()
+
+    _assert_order(frames)
+    assert [frame["delta"] for frame in frames[1:-1]] == ["Первый", " второй", "!"]
+    assert frames[-1]["content"].startswith("Первый второй!")
+
+
+def test_plain_text_and_json(llm):
+    llm("text/plain; charset=utf-8", ["Ответ ", "текстом"])
+    frames = _collect()
+    _assert_order(frames)
+    assert _deltas(frames) == "Ответ текстом"
+
+    llm("application/json", [json.dumps({"answer": "Ответ целиком"})])
+    frames = _collect()
+    _assert_order(frames)
+    assert [frame["delta"] for frame in frames[1:-1]] == ["Ответ целиком"]
+
+
+def test_first_delta_sent_before_stream_ends(llm):
+    """Первый фрейм chat_message_delta уходит клиенту, пока LLM ещё генерирует ответ."""
+    first_delta_seen = asyncio.Event()
+
+    async def wait_for_client():
+        await asyncio.wait_for(first_delta_seen.wait(), timeout=5)
+
+    llm("text/event-stream", ['data: {"token": "начало"}\n\n', wait_for_client, 'data: {"token": " конец"}\n\n'])
+    frames = _collect(lambda frame: frame["type"] == "chat_message_delta" and first_delta_seen.set())
+
+    _assert_order(frames)
+    assert _deltas(frames) == "начало конец"
+
+
+def test_failure_after_deltas_keeps_partial_answer(llm):
+    async def disconnect():
+        raise httpx.ReadError("соединение разорвано")
+
+    state = llm("text/event-stream", ['data: {"token": "Половина ответа"}\n\n', disconnect])
+    frames = _collect()
+
+    _assert_order(frames)
+    end = frames[-1]
+    assert end["truncated"] is True
+    assert end["content"].startswith("Половина ответа\n\nИсточники:")
+    # оборванный ответ не кэшируется
+    assert state["cached"] == []
+
+
+def test_unexpected_json_shape_after_deltas(llm):
+    # delta – строка, а не объект: разбор строки падает с AttributeError уже после первого фрейма
+    llm("application/x-ndjson", ['{"token": "Начало"}\n', '{"choices": [{"delta": "строка"}]}\n', '{"token": "!"}\n'])
+    frames = _collect()
+
+    _assert_order(frames)
+    assert _deltas(frames) == "Начало"
+    assert frames[-1]["truncated"] is True
+    assert frames[-1]["content"].startswith("Начало\n\nИсточники:")
+
+
+@pytest.mark.parametrize("content_type, parts", [
+    ("text/event-stream", ["disconnect"]),
+    # цельный JSON, но не объект
+    ("application/json", ["[1, 2]"]),
+])
+def test_failure_before_deltas_falls_back(llm, content_type, parts):
+    async def disconnect():
+        raise httpx.ReadError("соединение разорвано")
+
+    llm(content_type, [disconnect if part == "disconnect" else part for part in parts])
+    frames = _collect()
+
+    assert [frame["type"] for frame in frames] == ["retrieval", "chat_message_end"]
+    assert frames[-1]["truncated"] is False
+    assert frames[-1]["content"].startswith("Не удалось получить итоговый ответ от LLM")